@@ -0,0 +1,44 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import datetime
+
+from django.contrib import admin
+
+from linz2osm.convert.models import OverpassEndpoint
+
+class OverpassEndpointAdmin(admin.ModelAdmin):
+    list_display = ('url', 'enabled', 'concurrency', 'latency_ms', 'requests', 'failures', 'failure_rate', 'healthy', 'last_used_at',)
+    list_editable = ('enabled', 'concurrency',)
+    readonly_fields = ('requests', 'failures', 'consecutive_failures', 'latency_ms', 'last_used_at', 'unhealthy_until',)
+    save_on_top = True
+
+    def latency_ms(self, obj):
+        if obj.latency is None:
+            return "-"
+        return "%d ms" % (obj.latency * 1000)
+    latency_ms.short_description = 'Latency'
+
+    def failure_rate(self, obj):
+        if not obj.requests:
+            return "-"
+        return "%.1f%%" % (100.0 * obj.failures / obj.requests)
+
+    def healthy(self, obj):
+        return obj.unhealthy_until is None or obj.unhealthy_until < datetime.now()
+    healthy.boolean = True
+
+admin.site.register(OverpassEndpoint, OverpassEndpointAdmin)
@@ -0,0 +1,165 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A table in each dataset database counting each layer's features, and how
+# many of them are checked out, per cell of the workslice selector's grid at
+# a few cells-per-degree resolutions. A feature is in the cell its WGS84
+# centroid falls in. Counting a selection is then a sum over its cells,
+# rather than testing every feature in the layer against the selection.
+
+from django.conf import settings
+from django.db import connections
+
+CELL_COUNTS_TABLE = 'linz2osm_cell_counts'
+
+# Databases the table has been seen in, so it's looked up once per process
+tables_seen = set()
+
+def enabled():
+    return getattr(settings, 'LINZ2OSM_CELL_COUNTS', False)
+
+def resolutions():
+    return list(getattr(settings, 'LINZ2OSM_CELL_COUNT_RESOLUTIONS', (1, 4, 16, 64, 256)))
+
+def has_table(cursor):
+    if cursor.db.alias in tables_seen:
+        return True
+    cursor.execute('SELECT 1 FROM information_schema.tables WHERE table_name=%s;', [CELL_COUNTS_TABLE])
+    if cursor.fetchone() is None:
+        return False
+    tables_seen.add(cursor.db.alias)
+    return True
+
+def create_table(cursor):
+    cursor.execute("""
+        CREATE TABLE %s (
+            layer_name varchar(255) NOT NULL,
+            cpd integer NOT NULL,
+            x integer NOT NULL,
+            y integer NOT NULL,
+            feature_count integer NOT NULL,
+            allocated_count integer NOT NULL,
+            PRIMARY KEY (layer_name, cpd, x, y)
+        );""" % CELL_COUNTS_TABLE)
+
+def cell_features_sql(layer, where=''):
+    """
+    SQL selecting (cpd, x, y, feature id) for each feature and resolution,
+    taking the resolutions as an array parameter after any in where.
+    """
+    # longitudes past the antimeridian are counted west of it, as
+    # get_layer_feature_count does by translating the selection
+    return """
+        SELECT cpd, floor(lon * cpd)::integer AS x, floor(lat * cpd)::integer AS y, fid
+        FROM (
+            SELECT CASE WHEN ST_X(centroid) > 180.0 THEN ST_X(centroid) - 360.0 ELSE ST_X(centroid) END AS lon, ST_Y(centroid) AS lat, fid
+            FROM (
+                SELECT ST_Transform(ST_Centroid(%(geometry_expression)s), 4326) AS centroid, %(layer_name)s.%(pkey_name)s AS fid
+                FROM %(layer_name)s
+                %(join_sql)s
+                %(where)s
+            ) AS features
+        ) AS centroids, unnest(%%s::integer[]) AS cpd
+        WHERE lon IS NOT NULL
+        """ % {
+            'geometry_expression': layer.geometry_expression,
+            'layer_name': layer.name,
+            'pkey_name': layer.pkey_name,
+            'join_sql': layer.join_sql,
+            'where': where,
+        }
+
+def refresh(layer_in_dataset):
+    """ Recounts every cell of the layer. Returns the number of cells with features in. """
+    from linz2osm.workslices.models import WorksliceFeature
+
+    layer = layer_in_dataset.layer
+    allocated = list(WorksliceFeature.objects.filter(layer_in_dataset=layer_in_dataset, dirty=0).values_list('feature_id', flat=True))
+
+    cursor = connections[layer_in_dataset.dataset.name].cursor()
+    if not has_table(cursor):
+        create_table(cursor)
+
+    cursor.execute('DELETE FROM %s WHERE layer_name = %%s;' % CELL_COUNTS_TABLE, [layer.name])
+    cursor.execute("""
+        INSERT INTO %s (layer_name, cpd, x, y, feature_count, allocated_count)
+        SELECT %%s, cpd, x, y, count(*), sum(CASE WHEN fid = ANY(%%s) THEN 1 ELSE 0 END)
+        FROM (%s) AS cell_features
+        GROUP BY cpd, x, y;""" % (CELL_COUNTS_TABLE, cell_features_sql(layer)),
+        [layer.name, allocated, resolutions()])
+    return cursor.rowcount
+
+def adjust_allocated(layer_in_dataset, feature_ids, delta):
+    """ Adds delta to the allocated count of the cells feature_ids are in. """
+    if not enabled() or not feature_ids:
+        return
+    layer = layer_in_dataset.layer
+    cursor = connections[layer_in_dataset.dataset.name].cursor()
+    if not has_table(cursor):
+        return
+
+    where = 'WHERE %s.%s = ANY(%%s)' % (layer.name, layer.pkey_name)
+    cursor.execute("""
+        UPDATE %s AS counts
+        SET allocated_count = counts.allocated_count + %%s * changed.n
+        FROM (
+            SELECT cpd, x, y, count(*) AS n
+            FROM (%s) AS cell_features
+            GROUP BY cpd, x, y
+        ) AS changed
+        WHERE counts.layer_name = %%s AND counts.cpd = changed.cpd AND counts.x = changed.x AND counts.y = changed.y;""" % (CELL_COUNTS_TABLE, cell_features_sql(layer, where)),
+        [delta, list(feature_ids), resolutions(), layer.name])
+
+def count(layer_in_dataset, cells):
+    """
+    (feature count, allocated count) for the features in cells, or None if
+    they can't be counted from the table: the layer hasn't been counted, or
+    the cells aren't all the same size, or are smaller than any resolution
+    counted.
+    """
+    if not enabled() or not cells:
+        return None
+    cpds = set(cell.cpd for cell in cells)
+    if len(cpds) != 1:
+        return None
+    cpd = cpds.pop()
+    # the coarsest resolution whose cells fit exactly into the selected ones
+    fitting = [r for r in resolutions() if r % cpd == 0]
+    if not fitting:
+        return None
+    resolution = min(fitting)
+    span = resolution / cpd
+
+    cursor = connections[layer_in_dataset.dataset.name].cursor()
+    if not has_table(cursor):
+        return None
+
+    layer_name = layer_in_dataset.layer.name
+    cells = set((cell.x, cell.y) for cell in cells)
+    cursor.execute("""
+        SELECT
+            EXISTS (SELECT 1 FROM %(table)s WHERE layer_name = %%s),
+            coalesce(sum(counts.feature_count), 0),
+            coalesce(sum(counts.allocated_count), 0)
+        FROM %(table)s AS counts
+        JOIN (SELECT unnest(%%s::integer[]) * %%s AS x, unnest(%%s::integer[]) * %%s AS y) AS selected
+        ON counts.x >= selected.x AND counts.x < selected.x + %%s AND counts.y >= selected.y AND counts.y < selected.y + %%s
+        WHERE counts.layer_name = %%s AND counts.cpd = %%s;""" % {'table': CELL_COUNTS_TABLE},
+        [layer_name, [x for (x, y) in cells], span, [y for (x, y) in cells], span, span, span, layer_name, resolution])
+    counted, feature_count, allocated_count = cursor.fetchone()
+    if not counted:
+        return None
+    return (int(feature_count), int(allocated_count))
@@ -0,0 +1,157 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Generated osmChange files, kept on disk under a digest of everything that
+# goes into them, so exporting the same features again is a file copy. The
+# least recently used files go when the cache grows past its size limit.
+
+import hashlib
+import json
+import os
+
+from django.conf import settings
+
+from linz2osm.data_dict import tag_code
+
+# bump when the export code changes what it writes for the same inputs
+EXPORT_CACHE_VERSION = 1
+COPY_CHUNK_SIZE = 65536
+
+def cache_dir():
+    return getattr(settings, 'LINZ2OSM_EXPORT_CACHE_DIR', None)
+
+def _layer_inputs(layer_in_dataset, workslice_id):
+    """ The parts of the key for one layer, or None if its export can't be cached. """
+    layer = layer_in_dataset.layer
+    # node and way reuse depends on what's in OSM at the time
+    if layer.special_node_reuse_logic or layer.special_way_reuse_logic:
+        return None
+    tags = []
+    for tag in layer_in_dataset.get_all_tags():
+        field_names = tag_code.memo_fields(tag.code)
+        if field_names is None:
+            return None
+        tags.append((tag.tag, tag.apply_to, tag.code, workslice_id if 'workslice_id' in field_names else None))
+    return (layer.name, layer.geometry_type, layer.pkey_name, layer.processors, layer.output_coordinate_precision, tags)
+
+def export_key(layer_in_dataset, feature_ids, workslice_id):
+    """
+    A digest of everything export_custom's output depends on, or None if it
+    depends on something else too (OSM itself, or impure tag code).
+    """
+    if not cache_dir():
+        return None
+    dataset = layer_in_dataset.dataset
+    layer = layer_in_dataset.layer
+    inputs = [EXPORT_CACHE_VERSION, dataset.name, dataset.version, dataset.srid,
+              getattr(settings, 'LINZ2OSM_EXPORT_PROCESSES', 1), feature_ids]
+    layer_inputs = _layer_inputs(layer_in_dataset, workslice_id)
+    if layer_inputs is None:
+        return None
+    inputs.append(layer_inputs)
+    for m in layer.members.select_related('member_layer').all():
+        member_inputs = _layer_inputs(dataset.layerindataset_set.get(layer=m.member_layer), workslice_id)
+        if member_inputs is None:
+            return None
+        inputs.append((m.role, m.join_condition, member_inputs))
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+def path_for(key):
+    return os.path.join(cache_dir(), key + '.osc')
+
+def _meta_path(key):
+    return os.path.join(cache_dir(), key + '.json')
+
+def get(key):
+    """ (path of the cached export, its metadata), or None if it isn't cached. """
+    path = path_for(key)
+    try:
+        with open(_meta_path(key)) as f:
+            meta = json.load(f)
+        # mark them recently used
+        os.utime(path, None)
+        os.utime(_meta_path(key), None)
+    except (IOError, OSError, ValueError):
+        return None
+    return path, meta
+
+class CachedExport(object):
+    """ Stands in for the writer export_custom returns, for an export that came from the cache. """
+    def __init__(self, meta):
+        self.bytes_saved = meta.get('bytes_saved', 0)
+
+def copy_to(path, stream):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(COPY_CHUNK_SIZE)
+            if not data:
+                break
+            stream.write(data)
+
+class CacheWriter(object):
+    """ A stream that passes everything on to another and keeps a copy for the cache. """
+    def __init__(self, key, stream=None):
+        self.key = key
+        self.stream = stream
+        if not os.path.isdir(cache_dir()):
+            os.makedirs(cache_dir())
+        self.partial_path = '%s.%d.partial' % (path_for(key), os.getpid())
+        self.f = open(self.partial_path, 'wb')
+
+    def write(self, data):
+        self.f.write(data)
+        if self.stream is not None:
+            self.stream.write(data)
+
+    def commit(self, meta):
+        self.f.close()
+        with open(_meta_path(self.key), 'w') as f:
+            json.dump(meta, f)
+        os.rename(self.partial_path, path_for(self.key))
+        evict()
+
+    def discard(self):
+        self.f.close()
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+def evict(max_size=None):
+    """ Removes the least recently used exports until the cache fits in max_size bytes. """
+    if max_size is None:
+        max_size = getattr(settings, 'LINZ2OSM_EXPORT_CACHE_SIZE', 1024 ** 3)
+    entries = {}
+    for file_name in os.listdir(cache_dir()):
+        key, ext = os.path.splitext(file_name)
+        if ext not in ('.osc', '.json'):
+            continue
+        try:
+            st = os.stat(os.path.join(cache_dir(), file_name))
+        except OSError:
+            continue
+        used, size = entries.get(key, (0, 0))
+        entries[key] = (max(used, st.st_mtime), size + st.st_size)
+
+    total = sum([size for (used, size) in entries.values()])
+    for key, (used, size) in sorted(entries.items(), key=lambda (key, (used, size)): used):
+        if total <= max_size:
+            break
+        for path in (path_for(key), _meta_path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
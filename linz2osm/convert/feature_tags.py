@@ -0,0 +1,159 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# A table in each dataset database holding the evaluated tags per feature, so
+# exports can skip evaluating them. Each value is stored with a hash of the
+# code that produced it; rows whose hash no longer matches are ignored, so an
+# edited tag falls back to being evaluated until its rows are refreshed.
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import connections
+
+from linz2osm.data_dict import tag_code
+
+FEATURE_TAGS_TABLE = 'linz2osm_feature_tags'
+REFRESH_CHUNK_SIZE = 1000
+
+def enabled():
+    return getattr(settings, 'LINZ2OSM_FEATURE_TAG_CACHE', False)
+
+def cacheable(tag):
+    """ Only tags whose value depends on nothing but the feature itself can be stored. """
+    field_names = tag_code.memo_fields(tag.code)
+    return (field_names is not None) and ('workslice_id' not in field_names)
+
+def tag_hash(tag, dataset):
+    h = hashlib.sha1(tag.code.encode('utf8'))
+    if 'dataset_version' in tag_code.memo_fields(tag.code):
+        h.update('\0' + dataset.version.encode('utf8'))
+    return h.hexdigest()
+
+def has_table(cursor):
+    cursor.execute('SELECT 1 FROM information_schema.tables WHERE table_name=%s;', [FEATURE_TAGS_TABLE])
+    return cursor.fetchone() is not None
+
+def create_table(cursor):
+    cursor.execute("""
+        CREATE TABLE %s (
+            layer_name varchar(255) NOT NULL,
+            tag_id integer NOT NULL,
+            feature_id bigint NOT NULL,
+            code_hash char(40) NOT NULL,
+            value text NOT NULL,
+            PRIMARY KEY (layer_name, tag_id, feature_id)
+        );""" % FEATURE_TAGS_TABLE)
+
+def refresh(layer_in_dataset, tags=None, feature_ids=None):
+    """
+    Evaluates tags (default: all of the layer's) for feature_ids (default:
+    every feature) and stores the results. Returns the number of values stored.
+    """
+    from linz2osm.convert import osm
+
+    dataset = layer_in_dataset.dataset
+    layer = layer_in_dataset.layer
+
+    if tags is None:
+        tags = layer_in_dataset.get_all_tags()
+    tags = [t for t in tags if cacheable(t)]
+    if not tags:
+        return 0
+    if feature_ids is None:
+        feature_ids = osm.get_layer_feature_ids(layer_in_dataset)
+
+    cursor = connections[dataset.name].cursor()
+    if not has_table(cursor):
+        create_table(cursor)
+
+    tag_ids = [t.pk for t in tags]
+    hashes = dict([(t.pk, tag_hash(t, dataset)) for t in tags])
+    columns = osm.get_needed_columns(layer, tags=tags)
+
+    stored = 0
+    for start in range(0, len(feature_ids), REFRESH_CHUNK_SIZE):
+        chunk = feature_ids[start:start + REFRESH_CHUNK_SIZE]
+        data_table = osm.get_data_table(layer_in_dataset, chunk, tags=tags, columns=columns)
+        rows = [row_data for (row_data, row_geom) in data_table]
+        row_fids = [row_data[layer.pkey_name] for row_data in rows]
+
+        values = []
+        for tag in tags:
+            # features get_data_table skips (no geometry) get null, so the chunk is complete
+            tag_values = dict([(fid, None) for fid in chunk])
+            tag_values.update(zip(row_fids, osm.evaluate_tag(tag, rows)))
+            for fid, v in tag_values.iteritems():
+                values.append((layer.name, tag.pk, fid, hashes[tag.pk], json.dumps(v)))
+
+        cursor.execute('DELETE FROM %s WHERE layer_name = %%s AND tag_id = ANY(%%s) AND feature_id = ANY(%%s);' % FEATURE_TAGS_TABLE,
+                       [layer.name, tag_ids, list(chunk)])
+        cursor.executemany('INSERT INTO %s (layer_name, tag_id, feature_id, code_hash, value) VALUES (%%s, %%s, %%s, %%s, %%s);' % FEATURE_TAGS_TABLE,
+                           values)
+        stored += len(values)
+    return stored
+
+def load(layer_in_dataset, tags, feature_ids):
+    """
+    Returns {tag id: {feature id: value}} for the tags whose stored values
+    are current for every one of feature_ids. Other tags are left out.
+    """
+    if not enabled() or not tags or not feature_ids:
+        return {}
+    dataset = layer_in_dataset.dataset
+    tags = [t for t in tags if cacheable(t)]
+    if not tags:
+        return {}
+
+    cursor = connections[dataset.name].cursor()
+    if not has_table(cursor):
+        return {}
+
+    hashes = dict([(t.pk, tag_hash(t, dataset)) for t in tags])
+    cursor.execute('SELECT tag_id, feature_id, code_hash, value FROM %s WHERE layer_name = %%s AND tag_id = ANY(%%s) AND feature_id = ANY(%%s);' % FEATURE_TAGS_TABLE,
+                   [layer_in_dataset.layer.name, hashes.keys(), list(feature_ids)])
+    stored = {}
+    for tag_id, feature_id, code_hash, value in cursor:
+        if code_hash == hashes[tag_id]:
+            stored.setdefault(tag_id, {})[feature_id] = json.loads(value)
+
+    wanted = len(set(feature_ids))
+    return dict([(tag_id, values) for (tag_id, values) in stored.iteritems() if len(values) == wanted])
+
+def add_tag_values(layer, data_table, stored):
+    """ Puts values from load() into row_data['tag_values'] for evaluate_tags. """
+    if not stored:
+        return
+    for row_data, row_geom in data_table:
+        feature_id = row_data[layer.pkey_name]
+        tag_values = row_data.setdefault('tag_values', {})
+        for tag_id, values in stored.iteritems():
+            tag_values[tag_id] = values[feature_id]
+
+def forget_features(layer_in_dataset, feature_ids):
+    if not feature_ids:
+        return
+    cursor = connections[layer_in_dataset.dataset.name].cursor()
+    if has_table(cursor):
+        cursor.execute('DELETE FROM %s WHERE layer_name = %%s AND feature_id = ANY(%%s);' % FEATURE_TAGS_TABLE,
+                       [layer_in_dataset.layer.name, list(feature_ids)])
+
+def forget_tag(dataset, tag_id):
+    cursor = connections[dataset.name].cursor()
+    if has_table(cursor):
+        cursor.execute('DELETE FROM %s WHERE tag_id = %%s;' % FEATURE_TAGS_TABLE, [tag_id])
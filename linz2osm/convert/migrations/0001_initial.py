@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#  LINZ-2-OSM
+#  Copyright (C) 2010-2012 Koordinates Ltd.
+# 
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'OverpassEndpoint'
+        db.create_table('convert_overpassendpoint', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('url', self.gf('django.db.models.fields.URLField')(unique=True, max_length=200)),
+            ('enabled', self.gf('django.db.models.fields.BooleanField')(default=True)),
+            ('concurrency', self.gf('django.db.models.fields.PositiveIntegerField')(default=2)),
+            ('requests', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('failures', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('consecutive_failures', self.gf('django.db.models.fields.IntegerField')(default=0)),
+            ('latency', self.gf('django.db.models.fields.FloatField')(null=True)),
+            ('last_used_at', self.gf('django.db.models.fields.DateTimeField')(null=True)),
+            ('unhealthy_until', self.gf('django.db.models.fields.DateTimeField')(null=True)),
+        ))
+        db.send_create_signal('convert', ['OverpassEndpoint'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'OverpassEndpoint'
+        db.delete_table('convert_overpassendpoint')
+
+
+    models = {
+        'convert.overpassendpoint': {
+            'Meta': {'ordering': "('url',)", 'object_name': 'OverpassEndpoint'},
+            'concurrency': ('django.db.models.fields.PositiveIntegerField', [], {'default': '2'}),
+            'consecutive_failures': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'failures': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_used_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'latency': ('django.db.models.fields.FloatField', [], {'null': 'True'}),
+            'requests': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'unhealthy_until': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            'url': ('django.db.models.fields.URLField', [], {'unique': 'True', 'max_length': '200'})
+        }
+    }
+
+    complete_apps = ['convert']
@@ -0,0 +1,85 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from datetime import datetime
+
+from django.db import models
+from django.db.models import F
+
+class OverpassEndpoint(models.Model):
+    """
+    An Overpass server to send queries to. The client spreads queries over
+    the enabled ones, favouring the quickest, and keeps away from one for a
+    while after it fails a few times running.
+    """
+    url = models.URLField(unique=True, help_text="Interpreter URL, e.g. http://overpass-api.de/api/interpreter")
+    enabled = models.BooleanField(default=True)
+    concurrency = models.PositiveIntegerField(default=2, help_text="How many queries may run on this server at once")
+
+    requests = models.IntegerField(default=0, editable=False)
+    failures = models.IntegerField(default=0, editable=False)
+    consecutive_failures = models.IntegerField(default=0, editable=False)
+    latency = models.FloatField(null=True, editable=False, help_text="Moving average of seconds per query")
+    last_used_at = models.DateTimeField(null=True, editable=False)
+    unhealthy_until = models.DateTimeField(null=True, editable=False)
+
+    class Meta:
+        ordering = ('url',)
+
+    def __unicode__(self):
+        return self.url
+
+    @property
+    def unhealthy_until_time(self):
+        if self.unhealthy_until is None:
+            return None
+        return time.mktime(self.unhealthy_until.timetuple())
+
+    def record(self, requests, failures, latency, consecutive_failures, unhealthy_until):
+        """ Add a client's counts to the stored ones; unhealthy_until is a time.time() value or None. """
+        OverpassEndpoint.objects.filter(pk=self.pk).update(
+            requests=F('requests') + requests,
+            failures=F('failures') + failures,
+            latency=latency,
+            consecutive_failures=consecutive_failures,
+            last_used_at=datetime.now(),
+            unhealthy_until=datetime.fromtimestamp(unhealthy_until) if unhealthy_until else None,
+            )
+
+class OverpassCacheStats(models.Model):
+    """
+    How often Overpass queries have been answered from the response cache.
+    There's only the one row, kept here rather than in the cache itself so
+    culling can't throw the counts away.
+    """
+    hits = models.IntegerField(default=0)
+    misses = models.IntegerField(default=0)
+
+    @classmethod
+    def current(cls):
+        return cls.objects.get_or_create(pk=1)[0]
+
+    @classmethod
+    def record(cls, hits, misses):
+        """ Add a client's counts to the stored ones. """
+        cls.current()
+        cls.objects.filter(pk=1).update(hits=F('hits') + hits, misses=F('misses') + misses)
+
+    @classmethod
+    def reset(cls):
+        cls.objects.filter(pk=1).update(hits=0, misses=0)
@@ -28,9 +28,14 @@ from django.contrib.gis import geos
 from django.core.cache import cache
 from django.db import connection, connections
 
-from linz2osm.convert import overpass
+from linz2osm.convert import cell_counts, export_cache, feature_tags, overpass
+from linz2osm.data_dict import tag_memo, tag_sql
 
 
+# Rows exported by each process in a parallel export, and the ids set aside for them
+EXPORT_PARTITION_SIZE = 2000
+EXPORT_ID_RANGE = 10000000
+
 def get_srtext_from_srid(srid):
     cursor = connection.cursor()
     cursor.execute('SELECT srtext FROM spatial_ref_sys WHERE srid=%s;', [srid])
@@ -112,6 +117,29 @@ def get_layer_feature_ids(layer_in_dataset, extent=None, feature_limit=None):
         return None # FIXME: use exceptions - should have checked feature count before approving workslice
     return [r[0] for r in cursor.fetchall()]
 
+def get_feature_extents(layer_in_dataset, feature_ids):
+    """ {feature_id: (minx, miny, maxx, maxy)} of the features' WGS84 envelopes, all in one query. """
+    if not feature_ids:
+        return {}
+    layer = layer_in_dataset.layer
+    cursor = connections[layer_in_dataset.dataset.name].cursor()
+    cursor.execute("""
+        SELECT fid, ST_XMin(envelope), ST_YMin(envelope), ST_XMax(envelope), ST_YMax(envelope)
+        FROM (
+            SELECT %(layer_name)s.%(pkey_name)s AS fid, ST_Envelope(ST_Transform(%(geometry_expression)s, 4326)) AS envelope
+            FROM %(layer_name)s
+            %(join_sql)s
+            WHERE %(layer_name)s.%(pkey_name)s IN (%(feature_ids)s)
+        ) AS envelopes
+        """ % {
+            'layer_name': layer.name,
+            'pkey_name': layer.pkey_name,
+            'geometry_expression': layer.geometry_expression,
+            'join_sql': layer.join_sql,
+            'feature_ids': ",".join([str(int(fid)) for fid in feature_ids]),
+    })
+    return dict((r[0], tuple(r[1:])) for r in cursor.fetchall())
+
 def feature_selection_geojson(workslice_features, centroids_only=False):
     return dedent("""
             { "type": "FeatureCollection",
@@ -245,12 +273,16 @@ def clean_data(cell):
         return cell
 
 def featureset_conflicts(layer_in_dataset, workslice_features):
-    data_table = get_data_table(layer_in_dataset, [wf.feature_id for wf in workslice_features])
-    return overpass.featureset_conflicts_for_data(layer_in_dataset, workslice_features, data_table)
+    columns = get_needed_columns(layer_in_dataset.layer, tags=layer_in_dataset.get_conflict_tags())
+    data_table = get_data_table(layer_in_dataset, [wf.feature_id for wf in workslice_features], columns=columns)
+    with tag_memo.memoised():
+        return overpass.featureset_conflicts_for_data(layer_in_dataset, workslice_features, data_table)
 
 def featureset_matches(layer_in_dataset, workslice_features):
-    data_table = get_data_table(layer_in_dataset, [wf.feature_id for wf in workslice_features])
-    return overpass.featureset_matches_for_data(layer_in_dataset, workslice_features, data_table)
+    columns = get_needed_columns(layer_in_dataset.layer, tags=layer_in_dataset.get_match_tags())
+    data_table = get_data_table(layer_in_dataset, [wf.feature_id for wf in workslice_features], columns=columns)
+    with tag_memo.memoised():
+        return overpass.featureset_matches_for_data(layer_in_dataset, workslice_features, data_table)
 
 def apply_changeset_to_dataset(dataset_update, table_name, lid):
     database_id = dataset_update.dataset.name
@@ -330,6 +362,18 @@ def apply_changeset_to_dataset(dataset_update, table_name, lid):
 
         # TODO: Create deletion workslice
 
+    # dirty features are free to be checked out again
+    from linz2osm.workslices.models import WorksliceFeature
+    WorksliceFeature.objects.forget_allocated_features(lid)
+
+    # stored tags of changed features are stale even while the cache is off,
+    # as they'd be used again once it's turned back on
+    feature_tags.forget_features(lid, [row[lid.layer.pkey_name] for row in delete_table + update_table])
+    if feature_tags.enabled():
+        feature_tags.refresh(lid, feature_ids=[row[lid.layer.pkey_name] for row in insert_table + update_table])
+    if cell_counts.enabled():
+        cell_counts.refresh(lid)
+
     stats = get_layer_stats(lid.dataset.name, lid.layer)
     lid.features_total = stats['feature_count']
     lid.extent = lid.extent.union(stats['extent']).envelope
@@ -338,10 +382,10 @@ def apply_changeset_to_dataset(dataset_update, table_name, lid):
     lid.save()
 
 
-def export(workslice):
+def export(workslice, stream=None):
     layer_in_dataset = workslice.layer_in_dataset
     feature_ids = [wf.feature_id for wf in workslice.workslicefeature_set.all()]
-    return export_custom(layer_in_dataset, feature_ids, workslice.id)
+    return export_custom(layer_in_dataset, feature_ids, workslice.id, stream)
 
 def get_data_columns(cursor, layer_name):
     cursor.execute('SELECT column_name, udt_name FROM information_schema.columns WHERE table_name=%s;', [layer_name])
@@ -355,7 +399,39 @@ def get_data_columns(cursor, layer_name):
 
     return data_columns, geom_column
 
-def get_data_table(layer_in_dataset, feature_ids = None, workslice_id = None):
+def get_data_column_types(cursor, layer_name):
+    cursor.execute('SELECT column_name, udt_name FROM information_schema.columns WHERE table_name=%s;', [layer_name])
+    return dict(cursor.fetchall())
+
+def get_needed_columns(layer, tags=(), processors=()):
+    """
+    The names of the fields that tags, processors and the layer's special
+    reuse logic read, or None if we can't tell and need all of them.
+    """
+    needed = set([layer.pkey_name])
+    for field_name in (layer.special_start_node_field_name, layer.special_end_node_field_name, layer.special_way_field_name):
+        if field_name:
+            needed.add(field_name)
+    for p in processors:
+        if p.field_names is None:
+            return None
+        needed.update(p.field_names)
+    for tag in tags:
+        field_names = tag.field_dependencies
+        if field_names is None:
+            return None
+        needed.update(field_names)
+    return needed
+
+def get_data_table(layer_in_dataset, feature_ids = None, workslice_id = None, tags = None, columns = None):
+    """
+    Returns [(row_data, row_geom), ...] for the features. If tags are given,
+    any that can be computed in SQL are, and row_data['tag_values'] maps
+    their ids to the values for that row.
+
+    columns limits row_data to the named fields (see get_needed_columns) plus
+    whatever the tags not computed in SQL read. None fetches every column.
+    """
     dataset = layer_in_dataset.dataset
     layer = layer_in_dataset.layer
 
@@ -363,18 +439,51 @@ def get_data_table(layer_in_dataset, feature_ids = None, workslice_id = None):
     cursor = connections[database_id].cursor()
 
     data_columns, geom_column = get_data_columns(cursor, layer.name)
-    columns = ['st_asbinary(st_transform(st_setsrid(%s, %d), 4326)) AS geom' % (layer.geometry_expression, dataset.srid)]
-    columns += ['"%s"."%s"' % (layer.name, c) for c in data_columns]
+
+    # Relations have member columns mixed in, so leave their tags to evaluate_tags
+    tag_expressions = []
+    if tags and layer.geometry_type != 'RELATION' and getattr(settings, 'LINZ2OSM_TAG_SQL', True):
+        constants = {
+            'layer_name': layer.name,
+            'dataset_name': dataset.name,
+            'dataset_version': dataset.version,
+            }
+        if workslice_id is not None:
+            constants['workslice_id'] = workslice_id
+        column_types = get_data_column_types(cursor, layer.name)
+        for tag in tags:
+            tag_expression = tag_sql.translate_tag(tag.code, layer.name, column_types, constants)
+            if tag_expression is not None:
+                tag_expressions.append((tag, tag_expression))
+    tag_ids = [tag.pk for (tag, tag_expression) in tag_expressions]
+
+    if columns is not None:
+        needed = set(columns)
+        for tag in (tags or []):
+            if tag.pk not in tag_ids:
+                field_names = tag.field_dependencies
+                if field_names is None:
+                    needed = None
+                    break
+                needed.update(field_names)
+        if needed is not None:
+            data_columns = [c for c in data_columns if c in needed]
+
+    select_columns = ['st_asbinary(st_transform(st_setsrid(%s, %d), 4326)) AS geom' % (layer.geometry_expression, dataset.srid)]
+    select_columns += ['"%s"."%s"' % (layer.name, c) for c in data_columns]
     feature_id_columns = {}
     attr_columns = list(data_columns)
     if layer.geometry_type == 'RELATION':
         for m in layer.members.select_related('member_layer').all():
             fid_col_name = "%s_feature_id" % m.table_alias
-            columns.append('"%s"."%s" AS %s' % (m.table_alias, m.member_layer.pkey_name, fid_col_name))
+            select_columns.append('"%s"."%s" AS %s' % (m.table_alias, m.member_layer.pkey_name, fid_col_name))
             feature_id_columns[fid_col_name] = m.pk
             attr_columns.append(fid_col_name)
 
-    sql_base = 'SELECT %s FROM "%s" %s' % (",".join(columns), layer.name, layer.join_sql)
+    for i, (tag, tag_expression) in enumerate(tag_expressions):
+        select_columns.append('%s AS "__tag_%d"' % (tag_expression, i))
+
+    sql_base = 'SELECT %s FROM "%s" %s' % (",".join(select_columns), layer.name, layer.join_sql)
 
     if feature_ids is not None:
         if len(feature_ids) > 0:
@@ -394,11 +503,14 @@ def get_data_table(layer_in_dataset, feature_ids = None, workslice_id = None):
         if row_geom.empty:
             continue
 
-        row_data = dict(zip(attr_columns,[clean_data(c) for c in row[1:] ]))
+        row_data = dict(zip(attr_columns,[clean_data(c) for c in row[1:len(attr_columns) + 1] ]))
         row_data['layer_name'] = layer.name
         row_data['dataset_name'] = dataset.name
         row_data['dataset_version'] = dataset.version
 
+        if tag_ids:
+            row_data['tag_values'] = dict(zip(tag_ids, [tag_sql.result_value(v) for v in row[len(attr_columns) + 1:]]))
+
         if feature_id_columns:
             r = {}
             for col_name, member_id in feature_id_columns.iteritems():
@@ -412,46 +524,94 @@ def get_data_table(layer_in_dataset, feature_ids = None, workslice_id = None):
 
     return data_table
 
+def get_tagged_data_table(layer_in_dataset, feature_ids, workslice_id, tags, columns):
+    """
+    get_data_table, with the values of tags already stored in the feature
+    tags table (see feature_tags) put in row_data['tag_values'] rather than
+    being computed again.
+    """
+    stored = feature_tags.load(layer_in_dataset, tags, feature_ids)
+    data_table = get_data_table(layer_in_dataset, feature_ids, workslice_id, tags=[t for t in tags if t.pk not in stored], columns=columns)
+    feature_tags.add_tag_values(layer_in_dataset.layer, data_table, stored)
+    return data_table
 
 def _add_osm_nodes_from_overpass(layer, lid, data_table, osm_nodes):
     if layer.special_node_reuse_logic:
-        node_match_json = overpass.osm_node_match_json(lid, data_table)['elements']
-        for node in node_match_json:
+        for node in overpass.osm_node_match_elements(lid, data_table):
             fid = node.get('tags', {}).get(layer.special_node_tag_name)
             if fid:
                 osm_nodes[fid] = str(node['id'])
 
 def _add_osm_ways_from_overpass(layer, lid, data_table, osm_nodes, osm_ways):
     if layer.special_way_reuse_logic:
-        way_match_json = overpass.osm_way_match_json(lid, data_table)['elements']
-
-        nodes = [e for e in way_match_json if e['type'] == 'node']
-        ways = [e for e in way_match_json if e['type'] == 'way']
-
-        for node in nodes:
-            fid = node.get('tags', {}).get(layer.special_node_tag_name)
-            if fid:
-                osm_nodes[fid] = str(node['id'])
-
         reverse_osm_nodes = dict([(osm_id, fid) for (fid, osm_id) in osm_nodes.iteritems()])
 
-        for way in ways:
-            node_start = reverse_osm_nodes.get(str(way['nodes'][0]))
-            node_end = reverse_osm_nodes.get(str(way['nodes'][-1]))
-            way_name = way.get('tags', {}).get(layer.special_way_tag_name)
-            if node_start and node_end and way_name:
-                osm_ways[(node_start, way_name, node_end)] = str(way['id'])
-            else:
-                print "Failed to add: %s, %s, %s" % (node_start, way_name, node_end)
-
-def export_custom(layer_in_dataset, feature_ids = None, workslice_id = None):
+        # Overpass puts a response's nodes before its ways, and each way's
+        # nodes come in the same response, so by the time a way arrives its
+        # end nodes are already known
+        for element in overpass.osm_way_match_elements(lid, data_table):
+            if element['type'] == 'node':
+                fid = element.get('tags', {}).get(layer.special_node_tag_name)
+                if fid:
+                    osm_nodes[fid] = str(element['id'])
+                    reverse_osm_nodes[str(element['id'])] = fid
+            elif element['type'] == 'way':
+                node_start = reverse_osm_nodes.get(str(element['nodes'][0]))
+                node_end = reverse_osm_nodes.get(str(element['nodes'][-1]))
+                way_name = element.get('tags', {}).get(layer.special_way_tag_name)
+                if node_start and node_end and way_name:
+                    osm_ways[(node_start, way_name, node_end)] = str(element['id'])
+                else:
+                    print "Failed to add: %s, %s, %s" % (node_start, way_name, node_end)
+
+def export_custom(layer_in_dataset, feature_ids = None, workslice_id = None, stream = None):
+    """
+    Returns the osmChange XML for the features, or if stream is given writes
+    it there as it goes and returns the writer (which has bytes_saved).
+    Exports that can be are kept in export_cache, and come from there next time.
+    """
+    key = export_cache.export_key(layer_in_dataset, feature_ids, workslice_id)
+    if key is None:
+        return _write_export(layer_in_dataset, feature_ids, workslice_id, stream)
+
+    cached = export_cache.get(key)
+    if cached is not None:
+        path, meta = cached
+        if stream is None:
+            with open(path, 'rb') as f:
+                return f.read()
+        export_cache.copy_to(path, stream)
+        return export_cache.CachedExport(meta)
+
+    buf = StringIO() if stream is None else None
+    cache_writer = export_cache.CacheWriter(key, stream if stream is not None else buf)
+    try:
+        writer = _write_export(layer_in_dataset, feature_ids, workslice_id, cache_writer)
+    except:
+        cache_writer.discard()
+        raise
+    cache_writer.commit({'bytes_saved': writer.bytes_saved})
+    if stream is None:
+        return buf.getvalue()
+    return writer
+
+def _write_export(layer_in_dataset, feature_ids, workslice_id, stream):
+    with tag_memo.memoised():
+        writer = _export_custom(layer_in_dataset, feature_ids, workslice_id, stream)
+    if stream is None:
+        return writer.xml()
+    writer.close()
+    return writer
+
+def _export_custom(layer_in_dataset, feature_ids, workslice_id, stream):
     dataset = layer_in_dataset.dataset
     layer = layer_in_dataset.layer
 
     layer_tags = layer_in_dataset.get_all_tags()
     processors = layer.get_processors()
 
-    data_table = get_data_table(layer_in_dataset, feature_ids, workslice_id)
+    columns = get_needed_columns(layer, processors=processors)
+    data_table = get_tagged_data_table(layer_in_dataset, feature_ids, workslice_id, tags=layer_tags, columns=columns)
     member_data_tables = {}
     member_tags = {}
 
@@ -463,19 +623,23 @@ def export_custom(layer_in_dataset, feature_ids = None, workslice_id = None):
     for m in layer.members.select_related('member_layer').all():
         member_lid = dataset.layerindataset_set.get(layer=m.member_layer)
         member_feature_ids = [row_data['member_feature_ids'][m.pk] for (row_data, row_geom) in data_table]
-        m_dt = get_data_table(member_lid, member_feature_ids, workslice_id)
-        member_data_tables[m.pk] = m_dt
         member_tags[m.pk] = member_lid.get_all_tags()
+        m_columns = get_needed_columns(m.member_layer, processors=m.member_layer.get_processors())
+        m_dt = get_tagged_data_table(member_lid, member_feature_ids, workslice_id, tags=member_tags[m.pk], columns=m_columns)
+        member_data_tables[m.pk] = m_dt
         _add_osm_nodes_from_overpass(m.member_layer, member_lid, m_dt, osm_nodes)
         _add_osm_ways_from_overpass(m.member_layer, member_lid, m_dt, osm_nodes, osm_ways)
 
-    writer = OSMCreateWriter(id_hash=(dataset.name, layer.name, feature_ids),
-                       osm_nodes=osm_nodes,
-                       osm_ways=osm_ways,
-                       special_start_node_field_name=layer.special_start_node_field_name,
-                       special_end_node_field_name=layer.special_end_node_field_name,
-                       special_way_field_name=layer.special_way_field_name
-                       )
+    writer_args = {
+        'id_hash': (dataset.name, layer.name, feature_ids),
+        'osm_nodes': osm_nodes,
+        'osm_ways': osm_ways,
+        'special_start_node_field_name': layer.special_start_node_field_name,
+        'special_end_node_field_name': layer.special_end_node_field_name,
+        'special_way_field_name': layer.special_way_field_name,
+        'precision': layer.output_coordinate_precision,
+        }
+    writer = OSMCreateWriter(stream=stream, **writer_args)
 
     member_feature_map = {}
 
@@ -483,6 +647,7 @@ def export_custom(layer_in_dataset, feature_ids = None, workslice_id = None):
     for m in layer.members.select_related('member_layer').all():
         m_layer = m.member_layer
         m_processors = m_layer.get_processors()
+        m_table_tags = evaluate_tags(member_tags[m.pk], member_data_tables[m.pk])
         for i, (row_data, row_geom) in enumerate(member_data_tables[m.pk]):
             db_feature_id = row_data[m_layer.pkey_name]
             db_table_name = m_layer.name
@@ -495,9 +660,15 @@ def export_custom(layer_in_dataset, feature_ids = None, workslice_id = None):
             key = (db_table_name, db_feature_id)
             # Reuse a member feature if already included as a different role.
             if key not in member_feature_map:
-                osm_feature_ids = _export_custom_data_row(writer, m_layer, member_tags[m.pk], m_processors, i, row_data, row_geom)
+                osm_feature_ids = _export_custom_data_row(writer, m_layer, m_table_tags[i], m_processors, i, row_data, row_geom)
                 member_feature_map[key] = (osm_feature_type, osm_feature_ids)
 
+    processes = export_processes(layer, processors, data_table)
+    if processes > 1:
+        _export_custom_parallel(writer, writer_args, layer, layer_tags, processors, data_table, processes)
+        return writer
+
+    table_tags = evaluate_tags(layer_tags, data_table)
     for i, (row_data, row_geom) in enumerate(data_table):
         member_refs = []
         for m in layer.members.select_related('member_layer').all():
@@ -508,23 +679,85 @@ def export_custom(layer_in_dataset, feature_ids = None, workslice_id = None):
             for fid in osm_feature_ids:
                 member_refs.append((m.role, osm_feature_type, fid))
 
-        _export_custom_data_row(writer, layer, layer_tags, processors, i, row_data, row_geom, member_refs=member_refs)
-
-    return writer.xml()
-
-def _export_custom_data_row(writer, layer, tags, processors, i, row_data, row_geom, member_refs=None):
-    row_tags = []
+        _export_custom_data_row(writer, layer, table_tags[i], processors, i, row_data, row_geom, member_refs=member_refs)
+
+    return writer
+
+def export_processes(layer, processors, data_table):
+    """ How many processes to export data_table with; 1 means export it here. """
+    processes = getattr(settings, 'LINZ2OSM_EXPORT_PROCESSES', 1)
+    if processes <= 1 or len(data_table) <= EXPORT_PARTITION_SIZE:
+        return 1
+    # relations refer to member ids from every partition, and reused nodes
+    # are shared by special node ref as features are written
+    if layer.geometry_type == 'RELATION' or layer.special_node_reuse_logic:
+        return 1
+    if not all([p.parallel_safe for p in processors]):
+        return 1
+    return processes
+
+def _export_custom_parallel(writer, writer_args, layer, tags, processors, data_table, processes):
+    """
+    Splits data_table into fixed-size partitions, exports each with its own
+    writer and range of ids in a pool of processes, and merges the results
+    into writer in order, so the output doesn't depend on the number of processes.
+    """
+    from billiard import Pool
+
+    partitions = []
+    for n, start in enumerate(range(0, len(data_table), EXPORT_PARTITION_SIZE)):
+        p_writer_args = dict(writer_args, id_offset=n * EXPORT_ID_RANGE)
+        partitions.append((p_writer_args, layer, tags, processors, start, data_table[start:start + EXPORT_PARTITION_SIZE]))
+
+    pool = Pool(processes)
+    try:
+        results = pool.map(_export_partition, partitions)
+    finally:
+        pool.close()
+        pool.join()
+
+    for result in results:
+        writer.merge(result)
+
+def _export_partition(args):
+    writer_args, layer, tags, processors, start, data_table = args
+    writer = OSMCreateWriter(**writer_args)
+    table_tags = evaluate_tags(tags, data_table)
+    for i, (row_data, row_geom) in enumerate(data_table):
+        _export_custom_data_row(writer, layer, table_tags[i], processors, start + i, row_data, row_geom)
+    return writer.partition()
+
+def tag_script_error_message(tag, e):
+    emsg = "Error evaluating '%s' tag against record:\n" % tag
+    emsg += json.dumps(e.data, indent=2) + "\n"
+    emsg += str(e)
+    return emsg
+
+def evaluate_tags(tags, data_table):
+    """
+    Returns a list of [(tag name, value, tag), ...] for each row, evaluating each tag over the whole table at once.
+    Values get_data_table already computed in SQL are used as they are.
+    """
+    rows = [row_data for (row_data, row_geom) in data_table]
+    table_tags = [[] for row_data in rows]
     for tag in tags:
-        try:
-            v = tag.eval(row_data)
-        except tag.ScriptError, e:
-            emsg = "Error evaluating '%s' tag against record:\n" % tag
-            emsg += json.dumps(e.data, indent=2) + "\n"
-            emsg += str(e)
-            raise ValueError(emsg)
-        if (v is not None) and (v != ""):
-            row_tags.append((tag.tag, v, tag,))
-
+        values = evaluate_tag(tag, rows)
+        for row_tags, v in zip(table_tags, values):
+            if (v is not None) and (v != ""):
+                row_tags.append((tag.tag, v, tag,))
+    return table_tags
+
+def evaluate_tag(tag, rows):
+    """ The value of tag for each of rows, using row_data['tag_values'] where every row has it. """
+    precomputed = [row_data.get('tag_values', {}) for row_data in rows]
+    if all([tag.pk in tag_values for tag_values in precomputed]):
+        return [tag_values[tag.pk] for tag_values in precomputed]
+    try:
+        return tag.eval_many(rows)
+    except tag.ScriptError, e:
+        raise ValueError(tag_script_error_message(tag, e))
+
+def _export_custom_data_row(writer, layer, row_tags, processors, i, row_data, row_geom, member_refs=None):
     # apply geometry processing
     for p in processors:
         row_geom = p.process(row_geom, fields=row_data, tags=row_tags, id=i)
@@ -553,6 +786,20 @@ def int_or_none(obj):
         return None
 
 class OSMWriter(object):
+    precision = None
+    bytes_saved = 0
+
+    def format_coordinate(self, value):
+        """ value to self.precision decimal places, counting the bytes that saves. """
+        s = format_coordinate(value, self.precision)
+        self.count_bytes_saved(value, s)
+        return s
+
+    def count_bytes_saved(self, value, s):
+        """ Counts s being written for value. """
+        if self.precision is not None:
+            self.bytes_saved += len(str(value)) - len(s)
+
     def xml(self):
         # prettify - ok to call more than once
         self._etree_indent(self.tree.getroot())
@@ -574,6 +821,25 @@ class OSMWriter(object):
         if level and (not elem.tail or not elem.tail.strip()):
             elem.tail = i
 
+# Nodes within 1e-7 degrees (OSM's own precision) are the same node
+NODE_KEY_SCALE = 10000000
+
+def node_key(lon, lat, scale=NODE_KEY_SCALE):
+    """ An int identifying the position, quantised to 1/scale degrees. """
+    # |lat| <= 90, so the quantised latitude fits in the low 32 bits
+    return (int(round(lon * scale)) << 32) + int(round(lat * scale))
+
+def format_coordinate(value, precision=None):
+    """ value rounded to precision decimal places, without trailing zeros. None gives str(value). """
+    if precision is None:
+        return str(value)
+    s = '%.*f' % (precision, value)
+    if '.' in s:
+        s = s.rstrip('0').rstrip('.')
+    if s == '-0':
+        s = '0'
+    return s
+
 def wrap_longitude(lon):
     wrapped = (lon + 180) % 360 - 180
     if wrapped == -180 and lon >= 180:
@@ -648,11 +914,23 @@ def coords_for_next_way(coords, way_split_size):
 class OSMCreateWriter(OSMWriter):
     WAY_SPLIT_SIZE = 495
 
-    def __init__(self, id_hash=None, processors=None, osm_nodes={}, osm_ways={}, special_start_node_field_name=None, special_end_node_field_name=None, special_way_field_name=None):
+    def __init__(self, id_hash=None, processors=None, osm_nodes={}, osm_ways={}, special_start_node_field_name=None, special_end_node_field_name=None, special_way_field_name=None, id_offset=0, stream=None, indent=True, precision=None):
         self.n_root = ElementTree.Element('osmChange', version="0.6", generator="linz2osm")
         self.n_create = ElementTree.SubElement(self.n_root, 'create', version="0.6", generator="linz2osm")
         self.tree = ElementTree.ElementTree(self.n_root)
+        # decimal places for node coordinates; nodes that round to the same
+        # position are the same node. None writes them in full
+        self.precision = precision
+        if precision is None:
+            self._node_key_scale = NODE_KEY_SCALE
+        else:
+            self._node_key_scale = 10 ** min(precision, 7)
+        # how much shorter rounding has made the coordinates we've written
+        self.bytes_saved = 0
+
+        # quantised position (see node_key) -> id, for untagged and tagged nodes
         self._nodes = {}
+        self._tagged_nodes = {}
         self._osm_nodes = osm_nodes
         self._osm_ways = osm_ways
         self.first_node_field = special_start_node_field_name
@@ -664,9 +942,45 @@ class OSMCreateWriter(OSMWriter):
         else:
             h = hashlib.sha1(unicode(id_hash).encode('utf8')).hexdigest()
             self._id = -1 * int(h[:6], 16)
+        # partitions of a parallel export each take their own range of ids
+        self._id -= id_offset
+        self._first_id = self._id
 
         self.processors = processors or []
 
+        # if given, elements are written to stream as they're finished instead
+        # of building up a tree, and close() ends the document
+        self._stream = stream
+        self._indent = indent
+        self._stream_started = False
+
+    def _emit(self, elem):
+        """ Adds a finished element to <create>. """
+        if self._stream is None:
+            self.n_create.append(elem)
+            return
+
+        # the same bytes xml() would give for the whole tree
+        if not self._stream_started:
+            self._stream.write('<osmChange generator="linz2osm" version="0.6">')
+            self._stream.write('\n  ' if self._indent else '')
+            self._stream.write('<create generator="linz2osm" version="0.6">')
+            self._stream_started = True
+        if self._indent:
+            self._etree_indent(elem, 2)
+            elem.tail = None
+            self._stream.write('\n    ')
+        self._stream.write(ElementTree.tostring(elem, 'utf-8'))
+
+    def close(self):
+        """ Ends a streamed document. """
+        if self._stream_started:
+            self._stream.write('\n  </create>\n' if self._indent else '</create>')
+        else:
+            self._stream.write('<osmChange generator="linz2osm" version="0.6">')
+            self._stream.write('\n  <create generator="linz2osm" version="0.6" />\n' if self._indent else '<create generator="linz2osm" version="0.6" />')
+        self._stream.write('</osmChange>\n')
+
     def add_feature(self, geom, tags=None, first_node_ref=None, last_node_ref=None, way_ref=None):
         return self.build_geom(geom, tags, first_node_ref, last_node_ref, way_ref)
 
@@ -699,7 +1013,7 @@ class OSMCreateWriter(OSMWriter):
                     ElementTree.SubElement(r, 'member', type="way", ref=w_id, role=('outer' if (i == 0) else 'inner'))
 
         if root is None:
-            self.n_create.append(r)
+            self._emit(r)
         return [r.get('id')]
 
 
@@ -722,6 +1036,7 @@ class OSMCreateWriter(OSMWriter):
             cur_coords, rem_coords = coords_for_next_way(rem_coords, self.WAY_SPLIT_SIZE)
 
             cur_coords_last_idx = len(cur_coords) - 1
+            node_refs = []
             for i,c in enumerate(cur_coords):
                 # Handle tagging special node types
                 if tag_nodes_at_ends and not rem_coords:
@@ -743,11 +1058,21 @@ class OSMCreateWriter(OSMWriter):
                 else:
                     n_id = self._node(c, None, True)
                 special_node_type = None
-
-                # Actually generate some XML now
+                node_refs.append(n_id)
+
+            # vertices closer than the precision round to the same node,
+            # unless that would leave too few for a way (or a closed one)
+            if self.precision is not None:
+                deduped = [n_id for (i, n_id) in enumerate(node_refs) if i == 0 or n_id != node_refs[i - 1]]
+                min_refs = 4 if node_refs[0] == node_refs[-1] else 2
+                if len(deduped) >= min_refs:
+                    node_refs = deduped
+
+            # Actually generate some XML now
+            for n_id in node_refs:
                 ElementTree.SubElement(w, 'nd', ref=n_id)
             self.build_tags(w, tags, "geometry")
-            self.n_create.append(w)
+            self._emit(w)
             ids.append(w.get('id'))
 
             if len(rem_coords) < 2:
@@ -758,15 +1083,30 @@ class OSMCreateWriter(OSMWriter):
     def _node(self, coords, tags, map_node=True, special_node_type=None, osm_node=None):
         lat = coords[1]
         lon = wrap_longitude(coords[0])
-        k = (str(lon), str(lat), id(tags) if tags else None)
-        n = self._nodes.get(k)
+        lat_s = format_coordinate(lat, self.precision)
+        lon_s = format_coordinate(lon, self.precision)
+        if self.precision is None:
+            k = node_key(lon, lat, self._node_key_scale)
+        else:
+            # keyed by the coordinates as written, so nodes that are written
+            # at the same position are the same node
+            k = node_key(float(lon_s), float(lat_s), self._node_key_scale)
+        if tags:
+            nodes, k = self._tagged_nodes, (k, id(tags))
+        else:
+            nodes = self._nodes
+        n_id = nodes.get(k)
 
-        if (not map_node) or (n is None):
-            n = ElementTree.SubElement(self.n_create, 'node', id=self.next_id, lat=str(lat), lon=str(lon))
+        if (not map_node) or (n_id is None):
+            n = ElementTree.Element('node', id=self.next_id, lat=lat_s, lon=lon_s)
+            self.count_bytes_saved(lat, lat_s)
+            self.count_bytes_saved(lon, lon_s)
             self.build_tags(n, tags, special_node_type)
+            self._emit(n)
+            n_id = self._id
             if map_node:
-                self._nodes[k] = n
-        return n.get('id')
+                nodes[k] = n_id
+        return str(n_id)
 
     def build_node(self, geom, tags, map_node=True, node_ref=None):
         if node_ref:
@@ -811,9 +1151,46 @@ class OSMCreateWriter(OSMWriter):
             ElementTree.SubElement(r, 'member', type=ftype, ref=ref, role=role)
 
         self.build_tags(r, tags, "relation")
-        self.n_create.append(r)
+        self._emit(r)
         return [r.get('id')]
 
+    def partition(self):
+        """
+        What merge() needs to combine this writer's output with others':
+        (<create> XML, {untagged node key: id}, bytes saved).
+        """
+        if self._first_id - self._id > EXPORT_ID_RANGE:
+            raise ValueError("Export partition used %d ids, more than its range of %d" % (self._first_id - self._id, EXPORT_ID_RANGE))
+        return (ElementTree.tostring(self.n_create, 'utf-8'), self._nodes, self.bytes_saved)
+
+    def merge(self, partition):
+        """
+        Appends the elements from another writer's partition(). Untagged
+        nodes it created at the same position as one of ours are dropped and
+        references to them point at ours instead, as if one writer had done both.
+        """
+        create_xml, shared_nodes, bytes_saved = partition
+        n_create = ElementTree.fromstring(create_xml)
+        self.bytes_saved += bytes_saved
+
+        replaced = {}
+        for k, n_id in shared_nodes.iteritems():
+            existing_id = self._nodes.get(k)
+            if existing_id is None:
+                self._nodes[k] = n_id
+            else:
+                replaced[str(n_id)] = str(existing_id)
+
+        for e in n_create:
+            if e.tag == 'node' and e.get('id') in replaced:
+                continue
+            for child in e:
+                if child.tag == 'nd' and child.get('ref') in replaced:
+                    child.set('ref', replaced[child.get('ref')])
+                elif child.tag == 'member' and child.get('type') == 'node' and child.get('ref') in replaced:
+                    child.set('ref', replaced[child.get('ref')])
+            self._emit(e)
+
     def build_tags(self, parent_node, tags, object_type):
         if tags:
             applied_tags = set()
@@ -829,7 +1206,7 @@ class OSMCreateWriter(OSMWriter):
                         ElementTree.SubElement(parent_node, 'tag', k=tn, v=tv)
 
 def export_delete(layer_in_dataset, nodes, ways, relations):
-    writer = OSMDeleteWriter()
+    writer = OSMDeleteWriter(precision=layer_in_dataset.layer.output_coordinate_precision)
     print "Deleting %d nodes, %d ways, %d relations..." % (len(nodes), len(ways), len(relations))
     for node in nodes:
         writer.remove_node(node)
@@ -840,13 +1217,14 @@ def export_delete(layer_in_dataset, nodes, ways, relations):
     return writer.xml()
 
 class OSMDeleteWriter(OSMWriter):
-    def __init__(self):
+    def __init__(self, precision=None):
+        self.precision = precision
         self.n_root = ElementTree.Element('osmChange', version="0.6", generator="linz2osm")
         self.n_delete = ElementTree.SubElement(self.n_root, 'delete', version="0.6", generator="linz2osm")
         self.tree = ElementTree.ElementTree(self.n_root)
 
     def remove_node(self, node):
-        ElementTree.SubElement(self.n_delete, 'node', version=str(node['version']), changeset=str(node['changeset']), id=str(node['id']), lat=str(node['lat']), lon=str(node['lon']))
+        ElementTree.SubElement(self.n_delete, 'node', version=str(node['version']), changeset=str(node['changeset']), id=str(node['id']), lat=self.format_coordinate(node['lat']), lon=self.format_coordinate(node['lon']))
         print "   ... node %s" % node['id']
 
     def remove_way(self, way):
@@ -0,0 +1,424 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Answering conflict and match queries from a local OSM extract rather than
+Overpass.
+
+load() reads an .osm file into an SQLite snapshot with R*Tree indexes of
+the bounding boxes of its nodes, ways and relations. ExtractClient then
+stands in for OverpassClient: it runs the part of Overpass QL that
+overpass.py and WorksliceFeature write (unions of type, tag filter and bbox
+queries, "._" and ">" recursion, and out with meta, geom or count)
+against the snapshot, and
+returns what Overpass would.
+
+Like the batched Overpass queries, a way or relation is taken to be in a
+bbox when its own bounding box meets it.
+"""
+
+import bz2
+import gzip
+import json
+import re
+import sqlite3
+
+from xml.etree import cElementTree
+
+from linz2osm.convert.overpass import tags_match
+
+LOAD_BATCH_SIZE = 10000
+
+ELEMENT_TYPES = ('node', 'way', 'relation')
+QL_TYPES = {
+    'node': 'node',
+    'way': 'way',
+    'rel': 'relation',
+    'relation': 'relation',
+}
+META_ATTRIBUTES = ('version', 'timestamp', 'changeset', 'uid', 'user')
+
+QL_TOKEN_RE = re.compile(r'\s*("(?:[^"\\]|\\.)*"|-?[0-9]+(?:\.[0-9]+)?|[A-Za-z_][A-Za-z0-9_]*|[()\[\];,:=~>.])')
+QL_ESCAPE_RE = re.compile(r'\\(.)')
+
+SCHEMA = """
+CREATE TABLE nodes (id INTEGER PRIMARY KEY, lat REAL, lon REAL, tags TEXT, meta TEXT);
+CREATE TABLE ways (id INTEGER PRIMARY KEY, nodes TEXT, tags TEXT, meta TEXT);
+CREATE TABLE relations (id INTEGER PRIMARY KEY, members TEXT, tags TEXT, meta TEXT);
+CREATE TABLE way_nodes (way_id INTEGER, node_id INTEGER);
+CREATE TABLE relation_members (relation_id INTEGER, type TEXT, ref INTEGER);
+CREATE VIRTUAL TABLE node_index USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+CREATE VIRTUAL TABLE way_index USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+CREATE VIRTUAL TABLE relation_index USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+"""
+
+# ways and relations have the box around their nodes; relations only look
+# one level down, as the Overpass queries we make do
+BUILD_INDEXES = """
+INSERT INTO node_index SELECT id, lat, lat, lon, lon FROM nodes;
+INSERT INTO way_index
+    SELECT way_id, min(lat), max(lat), min(lon), max(lon)
+    FROM way_nodes JOIN nodes ON nodes.id = way_nodes.node_id
+    GROUP BY way_id;
+INSERT INTO relation_index
+    SELECT relation_id, min(min_lat), max(max_lat), min(min_lon), max(max_lon)
+    FROM (
+        SELECT relation_id, min_lat, max_lat, min_lon, max_lon
+        FROM relation_members JOIN node_index ON node_index.id = relation_members.ref
+        WHERE relation_members.type = 'node'
+        UNION ALL
+        SELECT relation_id, min_lat, max_lat, min_lon, max_lon
+        FROM relation_members JOIN way_index ON way_index.id = relation_members.ref
+        WHERE relation_members.type = 'way'
+    )
+    GROUP BY relation_id;
+DROP TABLE way_nodes;
+DROP TABLE relation_members;
+"""
+
+class QueryError(Exception):
+    pass
+
+def open_osm(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    elif path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    else:
+        return open(path, 'rb')
+
+def _tags(elem):
+    return json.dumps(dict((t.get('k'), t.get('v')) for t in elem.findall('tag')))
+
+def _meta(elem):
+    return json.dumps(dict((a, elem.get(a)) for a in META_ATTRIBUTES if elem.get(a) is not None))
+
+def load(osm_path, db_path):
+    """ Build the snapshot at db_path from the .osm (or .osm.gz, .osm.bz2) file at osm_path. Returns the number of elements loaded. """
+    db = sqlite3.connect(db_path)
+    try:
+        db.executescript(SCHEMA)
+        rows = dict((t, []) for t in ('nodes', 'ways', 'relations', 'way_nodes', 'relation_members'))
+        inserts = {
+            'nodes': "INSERT INTO nodes VALUES (?, ?, ?, ?, ?)",
+            'ways': "INSERT INTO ways VALUES (?, ?, ?, ?)",
+            'relations': "INSERT INTO relations VALUES (?, ?, ?, ?)",
+            'way_nodes': "INSERT INTO way_nodes VALUES (?, ?)",
+            'relation_members': "INSERT INTO relation_members VALUES (?, ?, ?)",
+        }
+        count = 0
+        f = open_osm(osm_path)
+        try:
+            for event, elem in cElementTree.iterparse(f):
+                if elem.tag == 'node':
+                    rows['nodes'].append((int(elem.get('id')), float(elem.get('lat')), float(elem.get('lon')), _tags(elem), _meta(elem)))
+                elif elem.tag == 'way':
+                    way_id = int(elem.get('id'))
+                    nodes = [int(nd.get('ref')) for nd in elem.findall('nd')]
+                    rows['ways'].append((way_id, json.dumps(nodes), _tags(elem), _meta(elem)))
+                    rows['way_nodes'].extend((way_id, n) for n in nodes)
+                elif elem.tag == 'relation':
+                    relation_id = int(elem.get('id'))
+                    members = [{'type': m.get('type'), 'ref': int(m.get('ref')), 'role': m.get('role', '')} for m in elem.findall('member')]
+                    rows['relations'].append((relation_id, json.dumps(members), _tags(elem), _meta(elem)))
+                    rows['relation_members'].extend((relation_id, m['type'], m['ref']) for m in members)
+                else:
+                    continue
+                elem.clear()
+                count += 1
+                if count % LOAD_BATCH_SIZE == 0:
+                    _flush(db, inserts, rows)
+        finally:
+            f.close()
+        _flush(db, inserts, rows)
+        db.executescript(BUILD_INDEXES)
+        db.commit()
+    finally:
+        db.close()
+    return count
+
+def _flush(db, inserts, rows):
+    for table, table_rows in rows.iteritems():
+        if table_rows:
+            db.executemany(inserts[table], table_rows)
+            del table_rows[:]
+
+def tokenise(query):
+    tokens = []
+    pos = 0
+    query = query.rstrip()
+    while pos < len(query):
+        m = QL_TOKEN_RE.match(query, pos)
+        if not m:
+            raise QueryError("Can't read query at %r" % query[pos:pos + 20])
+        tokens.append(m.group(1))
+        pos = m.end()
+    return tokens
+
+class Parser(object):
+    """
+    Reads the Overpass QL we generate into statements:
+    ('query', type, tag filters, bbox or None), ('union', [statements]),
+    ('recurse_down',), ('set',) and ('out', set of modes).
+    """
+    def __init__(self, query):
+        self.tokens = tokenise(query)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise QueryError("Expected %s, found %s" % (expected or 'more', token))
+        self.pos += 1
+        return token
+
+    def string(self):
+        token = self.take()
+        if not token.startswith('"'):
+            raise QueryError("Expected a string, found %s" % token)
+        return QL_ESCAPE_RE.sub(r'\1', token[1:-1])
+
+    def parse(self):
+        statements = []
+        while self.peek() is not None:
+            statement = self.statement()
+            if statement is not None:
+                statements.append(statement)
+        return statements
+
+    def statement(self):
+        token = self.take()
+        if token == '[':
+            # settings, like [out:json]
+            while self.take() != ']':
+                pass
+            self.take(';')
+            return None
+        elif token == '(':
+            statements = []
+            while self.peek() != ')':
+                statements.append(self.statement())
+            self.take(')')
+            self.take(';')
+            return ('union', statements)
+        elif token == '>':
+            self.take(';')
+            return ('recurse_down',)
+        elif token == '.':
+            self.take('_')
+            self.take(';')
+            return ('set',)
+        elif token == 'out':
+            words = []
+            while self.peek() != ';':
+                words.append(self.take())
+            self.take(';')
+            return ('out', set(words))
+        elif token in QL_TYPES:
+            tag_filters = []
+            bbox = None
+            while self.peek() == '[':
+                tag_filters.append(self.tag_filter())
+            if self.peek() == '(':
+                self.take('(')
+                bbox = [float(self.take())]
+                for i in range(3):
+                    self.take(',')
+                    bbox.append(float(self.take()))
+                self.take(')')
+            self.take(';')
+            return ('query', QL_TYPES[token], tag_filters, tuple(bbox) if bbox else None)
+        else:
+            raise QueryError("Unsupported statement starting %s" % token)
+
+    def tag_filter(self):
+        self.take('[')
+        key = self.string()
+        if self.peek() == ']':
+            self.take(']')
+            return (key, None, None)
+        op = self.take()
+        if op not in ('=', '~'):
+            raise QueryError("Unsupported tag filter operator %s" % op)
+        value = self.string()
+        self.take(']')
+        return (key, op, value)
+
+class ExtractClient(object):
+    """ An OverpassClient that reads an extract snapshot made by load(). """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path)
+        self._elements = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def query_many(self, queries):
+        return [self.query(q) for q in queries]
+
+    def query_elements(self, query):
+        return iter(self.query(query)['elements'])
+
+    def query(self, query):
+        current = set()
+        output = None
+        modes = set()
+        for statement in Parser(query).parse():
+            if statement[0] == 'out':
+                output, modes = current, statement[1]
+            else:
+                current = self.run(statement, current)
+        keys = sorted([k for k in output or () if self.load(k)], key=lambda (t, i): (ELEMENT_TYPES.index(t), i))
+        if 'count' in modes:
+            counts = dict((t, len([k for k in keys if k[0] == t])) for t in ELEMENT_TYPES)
+            elements = [{'type': 'count', 'id': 0, 'tags': {
+                'nodes': str(counts['node']),
+                'ways': str(counts['way']),
+                'relations': str(counts['relation']),
+                'areas': '0',
+                'total': str(len(keys)),
+            }}]
+        else:
+            elements = [self.element(key, 'meta' in modes, 'geom' in modes) for key in keys]
+        return {
+            'version': 0.6,
+            'generator': "linz2osm extract %s" % self.db_path,
+            'elements': elements,
+            }
+
+    def run(self, statement, current):
+        """ Run a statement with current as "_", returning the new "_". """
+        if statement[0] == 'query':
+            return self.select(*statement[1:])
+        elif statement[0] == 'union':
+            result = set()
+            for sub in statement[1]:
+                current = self.run(sub, current)
+                result |= current
+            return result
+        elif statement[0] == 'recurse_down':
+            return self.recurse_down(current)
+        elif statement[0] == 'set':
+            return current
+        else:
+            raise QueryError("Unsupported statement %s" % statement[0])
+
+    def select(self, element_type, tag_filters, bbox):
+        cursor = self.db.cursor()
+        if bbox is None:
+            cursor.execute("SELECT id FROM %ss" % element_type)
+        else:
+            s, w, n, e = bbox
+            cursor.execute("""
+                SELECT id FROM %s_index
+                WHERE min_lat <= ? AND max_lat >= ? AND min_lon <= ? AND max_lon >= ?
+                """ % element_type, (n, s, e, w))
+        keys = [(element_type, row[0]) for row in cursor.fetchall()]
+        return set(k for k in keys if tags_match(self.load(k).get('tags', {}), tag_filters))
+
+    def recurse_down(self, keys):
+        result = set()
+        for (element_type, element_id) in keys:
+            if element_type == 'way':
+                result.update(('node', n) for n in self.load((element_type, element_id))['nodes'])
+            elif element_type == 'relation':
+                for m in self.load((element_type, element_id))['members']:
+                    if m['type'] == 'relation':
+                        continue
+                    result.add((m['type'], m['ref']))
+                    if m['type'] == 'way':
+                        way = self.load(('way', m['ref']))
+                        if way:
+                            result.update(('node', n) for n in way['nodes'])
+        return result
+
+    def load(self, key):
+        """ The element for a key as Overpass would return it, without meta, or {} if the extract hasn't got it. """
+        if key not in self._elements:
+            element_type, element_id = key
+            columns = {
+                'node': 'lat, lon, tags, meta',
+                'way': 'nodes, tags, meta',
+                'relation': 'members, tags, meta',
+            }[element_type]
+            row = self.db.execute("SELECT %s FROM %ss WHERE id = ?" % (columns, element_type), (element_id,)).fetchone()
+            if row is None:
+                element = {}
+            else:
+                element = {'type': element_type, 'id': element_id}
+                if element_type == 'node':
+                    element['lat'], element['lon'] = row[0], row[1]
+                elif element_type == 'way':
+                    element['nodes'] = json.loads(row[0])
+                else:
+                    element['members'] = json.loads(row[0])
+                tags = json.loads(row[-2])
+                if tags:
+                    element['tags'] = tags
+                element['meta'] = json.loads(row[-1])
+            self._elements[key] = element
+        return self._elements[key]
+
+    def element(self, key, meta=False, geom=False):
+        element = dict(self.load(key))
+        element_meta = element.pop('meta')
+        if meta:
+            for a in META_ATTRIBUTES:
+                if a in element_meta:
+                    element[a] = int(element_meta[a]) if a in ('version', 'changeset', 'uid') else element_meta[a]
+        if geom and element['type'] == 'way':
+            element['geometry'] = self.way_geometry(element)
+            element['bounds'] = self.geometry_bounds(element['geometry'])
+        elif geom and element['type'] == 'relation':
+            members = []
+            geometry = []
+            for m in element['members']:
+                m = dict(m)
+                child = self.load((m['type'], m['ref']))
+                if m['type'] == 'node' and child:
+                    m['lat'], m['lon'] = child['lat'], child['lon']
+                    geometry.append(m)
+                elif m['type'] == 'way' and child:
+                    m['geometry'] = self.way_geometry(child)
+                    geometry.extend(m['geometry'])
+                members.append(m)
+            element['members'] = members
+            if geometry:
+                element['bounds'] = self.geometry_bounds(geometry)
+        return element
+
+    def way_geometry(self, way):
+        nodes = [self.load(('node', n)) for n in way['nodes']]
+        return [{'lat': n['lat'], 'lon': n['lon']} for n in nodes if n]
+
+    def geometry_bounds(self, geometry):
+        return {
+            'minlat': min(p['lat'] for p in geometry),
+            'minlon': min(p['lon'] for p in geometry),
+            'maxlat': max(p['lat'] for p in geometry),
+            'maxlon': max(p['lon'] for p in geometry),
+            }
@@ -14,23 +14,110 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
-import requests
+import math
+import re
 
+from django.conf import settings
 from django.contrib.gis.geos import Point, LineString
 from textwrap import dedent
 
+from linz2osm.convert.models import OverpassEndpoint
+from linz2osm.convert.overpass_client import OverpassClient
+
 OVERPASS_API_URL = "http://overpass.osm.rambler.ru/cgi/interpreter?data="
 OVERPASS_PROXIMITY = 0.001
+# conflict previews query one box per grid cell of this size (in degrees)
+# covering the features whose centres are in it
+CONFLICT_CLUSTER_CELL_SIZE = 0.01
 
-def str_bounds_for(geobounds, proximity = OVERPASS_PROXIMITY):
-    return "(%f,%f,%f,%f)" % (
+# ["key"], ["key"="value"] or ["key"~"regex"], as the tag filters write them
+TAG_FILTER_RE = re.compile(r'\["((?:[^"\\]|\\.)*)"(?:([=~])"((?:[^"\\]|\\.)*)")?\]')
+QL_ESCAPE_RE = re.compile(r'\\(.)')
+
+# the tag of an "out count" element counting what each geometry type's
+# conflict query looks for
+CONFLICT_COUNT_TAGS = {
+    'POINT': 'nodes',
+    'LINESTRING': 'ways',
+    'POLYGON': 'ways',
+    'RELATION': 'relations',
+}
+
+# the element types each geometry type's conflict query selects directly;
+# everything else in a response is there through recursion
+CONFLICT_QUERY_TYPES = {
+    'POINT': ('node',),
+    'LINESTRING': ('way',),
+    'POLYGON': ('relation', 'way'),
+    'RELATION': ('relation',),
+}
+
+def bounds_for(geobounds, proximity = OVERPASS_PROXIMITY):
+    """ (south, west, north, east) around (minx, miny, maxx, maxy), as Overpass takes a bbox. """
+    return (
         geobounds[1] - proximity,
         geobounds[0] - proximity,
         geobounds[3] + proximity,
         geobounds[2] + proximity,
         )
 
+def str_bounds(bounds):
+    return "(%f,%f,%f,%f)" % bounds
+
+def str_bounds_for(geobounds, proximity = OVERPASS_PROXIMITY):
+    return str_bounds(bounds_for(geobounds, proximity))
+
+def batch_size():
+    return getattr(settings, 'LINZ2OSM_OVERPASS_BATCH_SIZE', 1)
+
+def overpass_client():
+    extract = getattr(settings, 'LINZ2OSM_OSM_EXTRACT', None)
+    if extract:
+        from linz2osm.convert.osm_extract import ExtractClient
+        return ExtractClient(extract)
+    # mirrors set up in the admin, or failing that the one in settings
+    endpoints = list(OverpassEndpoint.objects.filter(enabled=True))
+    return OverpassClient(endpoints or getattr(settings, 'LINZ2OSM_OVERPASS_API_URL', OVERPASS_API_URL))
+
+def feature_extents(workslice_features):
+    """
+    The WGS84 extent of each of workslice_features (all from one layer), as
+    wf.wgs_bounds().extent would give, fetched together.
+    """
+    if not workslice_features:
+        return []
+    # osm imports this module, so it has to wait until we need it
+    from linz2osm.convert import osm
+    extents = osm.get_feature_extents(workslice_features[0].layer_in_dataset, [wf.feature_id for wf in workslice_features])
+    return [extents[wf.feature_id] for wf in workslice_features]
+
+def merge_responses(responses):
+    """ One response with the elements of all of responses, each element once. """
+    result = dict(responses[0])
+    seen = set()
+    elements = []
+    for response in responses:
+        for e in response['elements']:
+            key = (e['type'], e['id'])
+            if key not in seen:
+                seen.add(key)
+                elements.append(e)
+    result['elements'] = elements
+    return result
+
+def osm_match_json(make_query, layer_in_dataset, data_table):
+    """
+    Run the match query make_query builds for data_table, split into queries
+    of batch_size() rows which are sent side by side.
+    """
+    size = batch_size()
+    if size > 1 and len(data_table) > size:
+        chunks = [data_table[i:i + size] for i in range(0, len(data_table), size)]
+    else:
+        chunks = [data_table]
+    with overpass_client() as client:
+        return merge_responses(client.query_many([make_query(layer_in_dataset, chunk) for chunk in chunks]))
+
 def osm_way_match_query(layer_in_dataset, data_table):
     return dedent("""
         [out:json];
@@ -54,27 +141,37 @@ def osm_node_match_query(layer_in_dataset, data_table):
         "\n".join([osm_node_match_query_ql(layer_in_dataset, row_data) for row_data, row_geom in data_table])
     ))
 
+def osm_match_elements(make_query, layer_in_dataset, data_table):
+    """
+    The elements osm_match_json would return, one at a time as they're read,
+    so big responses needn't be held whole. The chunks' queries are run one
+    after another, and each element comes once.
+    """
+    size = batch_size()
+    if size > 1 and len(data_table) > size:
+        chunks = [data_table[i:i + size] for i in range(0, len(data_table), size)]
+    else:
+        chunks = [data_table]
+    seen = set()
+    with overpass_client() as client:
+        for chunk in chunks:
+            for e in client.query_elements(make_query(layer_in_dataset, chunk)):
+                key = (e['type'], e['id'])
+                if key not in seen:
+                    seen.add(key)
+                    yield e
+
+def osm_way_match_elements(layer_in_dataset, data_table):
+    return osm_match_elements(osm_way_match_query, layer_in_dataset, data_table)
+
+def osm_node_match_elements(layer_in_dataset, data_table):
+    return osm_match_elements(osm_node_match_query, layer_in_dataset, data_table)
+
 def osm_way_match_json(layer_in_dataset, data_table):
-    query = osm_way_match_query(layer_in_dataset, data_table)
-    #print "-----=====+++ < ( [ { XXX OVERPASS QUERY XXX } ] ) > +++=====-----"
-    #print query
-    r = requests.post(OVERPASS_API_URL, data={
-            'data': query
-            })
-    #print "RESPONSE"
-    #print r.json()
-    return r.json()
+    return osm_match_json(osm_way_match_query, layer_in_dataset, data_table)
 
 def osm_node_match_json(layer_in_dataset, data_table):
-    query = osm_node_match_query(layer_in_dataset, data_table)
-    #print "-----=====+++ < ( [ { XXX OVERPASS QUERY XXX } ] ) > +++=====-----"
-    #print query
-    r = requests.post(OVERPASS_API_URL, data={
-            'data': query
-            })
-    #print "RESPONSE"
-    #print r.json()
-    return r.json()
+    return osm_match_json(osm_node_match_query, layer_in_dataset, data_table)
 
 def osm_way_match_query_ql(layer_in_dataset, row_data):
     layer = layer_in_dataset.layer
@@ -126,27 +223,257 @@ def osm_node_match_query_ql_for_field(layer_in_dataset, field_tag_name, field_va
             'str_bounds': str_bounds_for(layer_in_dataset.extent.extent),
             })
 
-def osm_conflicts_query(workslice_features, tags_ql):
+def osm_conflicts_query(workslice_features, tags_ql, feature_bounds=None, geometry=False):
+    """
+    One query for OSM features near any of workslice_features. Rather than a
+    bbox each, nearby features share one covering bbox (see cluster_bounds),
+    so this finds more than that: osm_conflicts_json narrows it back down.
+
+    With geometry, ways and relations come with their geometry inline
+    ("out geom") rather than followed by their nodes.
+    """
+    if feature_bounds is None:
+        feature_bounds = [wf.osm_conflicts_bounds(extent=e) for (wf, e) in zip(workslice_features, feature_extents(workslice_features))]
     return "".join(("[out:json];\n(\n",
-                    "\n".join([wf.osm_conflicts_query_ql(tags_ql) for wf in workslice_features]),
-                    "\n);\nout;\n",))
+                    "\n".join([workslice_features[members[0]].osm_conflicts_query_ql(tags_ql, bounds=bounds, recurse=not geometry) for (bounds, members) in cluster_bounds(feature_bounds)]),
+                    "\n);\nout geom;\n" if geometry else "\n);\nout;\n",))
 
-def osm_conflicts_json(workslice_features, tags_ql):
-    r = requests.post(OVERPASS_API_URL, data={
-            'data': osm_conflicts_query(workslice_features, tags_ql)
-            })
-    return r.json()
+def osm_conflicts_json(workslice_features, tags_ql, geometry=False):
+    feature_bounds = [wf.osm_conflicts_bounds(extent=e) for (wf, e) in zip(workslice_features, feature_extents(workslice_features))]
+    with overpass_client() as client:
+        response = client.query(osm_conflicts_query(workslice_features, tags_ql, feature_bounds, geometry))
+    if workslice_features:
+        response = dict(response)
+        response['elements'] = elements_near(workslice_features[0].layer_in_dataset.layer.geometry_type, feature_bounds, response['elements'])
+    return response
 
-def osm_individual_conflicts_query(layer_in_dataset, workslice_feature, query_data):
+def osm_conflicts_elements(workslice_features, tags_ql):
+    """
+    The elements osm_conflicts_json(geometry=True) would return, one at a
+    time as they're read from Overpass.
+    """
+    if not workslice_features:
+        return
+    feature_bounds = [wf.osm_conflicts_bounds(extent=e) for (wf, e) in zip(workslice_features, feature_extents(workslice_features))]
+    near = FeatureBoundsIndex(feature_bounds)
+    geotype = workslice_features[0].layer_in_dataset.layer.geometry_type
+    with overpass_client() as client:
+        for e in client.query_elements(osm_conflicts_query(workslice_features, tags_ql, feature_bounds, geometry=True)):
+            # with geometry there's no recursion, and everything has its bounds
+            if is_conflict_candidate(geotype, e) and near.meets(element_bounds(e, {})):
+                yield e
+
+def osm_conflicts_count_query(workslice_features, tags_ql, feature_bounds=None):
+    """ Like osm_conflicts_query, but asking only how many there are, so each feature keeps its own bbox. """
+    if feature_bounds is None:
+        feature_bounds = [wf.osm_conflicts_bounds(extent=e) for (wf, e) in zip(workslice_features, feature_extents(workslice_features))]
     return "".join(("[out:json];\n(\n",
-                    workslice_feature.osm_individual_conflict_query_ql(query_data),
+                    "\n".join([wf.osm_conflicts_query_ql(tags_ql, bounds=bounds, recurse=False) for (wf, bounds) in zip(workslice_features, feature_bounds)]),
+                    "\n);\nout count;\n",))
+
+def osm_conflicts_count(workslice_features, tags_ql):
+    """ The number of OSM features of the layer's type that osm_conflicts_json would find, near enough. """
+    if not workslice_features:
+        return 0
+    with overpass_client() as client:
+        response = client.query(osm_conflicts_count_query(workslice_features, tags_ql))
+    counts = [e for e in response['elements'] if e['type'] == 'count']
+    if not counts:
+        raise ValueError("Overpass didn't return a count")
+    return int(counts[0]['tags'][CONFLICT_COUNT_TAGS[workslice_features[0].layer_in_dataset.layer.geometry_type]])
+
+def osm_individual_conflicts_query(layer_in_dataset, workslice_feature, query_data, bounds=None):
+    return "".join(("[out:json];\n(\n",
+                    workslice_feature.osm_individual_conflict_query_ql(query_data, bounds),
                     "\n);\nout meta;\n"))
 
-def osm_individual_conflicts_json(requests_manager, layer_in_dataset, workslice_feature, query_data):
-    r = requests_manager.post(OVERPASS_API_URL, data={
-            'data': osm_individual_conflicts_query(layer_in_dataset, workslice_feature, query_data)
-            })
-    return r.json()
+def osm_individual_conflicts_json(client, layer_in_dataset, workslice_feature, query_data):
+    return client.query(osm_individual_conflicts_query(layer_in_dataset, workslice_feature, query_data))
+
+def osm_batched_conflicts_query(layer_in_dataset, searches):
+    return "".join(("[out:json];\n(\n",
+                    "\n".join([wf.osm_individual_conflict_query_ql(query_data, bounds) for (wf, query_data, bounds) in searches]),
+                    "\n);\nout meta;\n"))
+
+def osm_batched_conflicts_json(client, layer_in_dataset, searches):
+    """
+    Run the individual conflict queries for several workslice features as one
+    union request, and split the result back up into what each would have got
+    on its own.
+    """
+    return split_batched_conflicts(layer_in_dataset, searches, client.query(osm_batched_conflicts_query(layer_in_dataset, searches)))
+
+def split_batched_conflicts(layer_in_dataset, searches, response):
+    splits = demultiplex_elements(
+        layer_in_dataset.layer.geometry_type,
+        [(bounds, parse_tag_filters(query_data)) for (wf, query_data, bounds) in searches],
+        response['elements'])
+    results = []
+    for (wf, query_data, bounds), elements in zip(searches, splits):
+        result = dict(response)
+        result['elements'] = elements
+        results.append((wf, result,))
+    return results
+
+def parse_tag_filters(query_data):
+    """ [(key, op, value)] for the tag filters in a query; op and value are None for a bare ["key"]. """
+    return [(unescape_ql(k), op or None, unescape_ql(v) if op else None) for (k, op, v) in TAG_FILTER_RE.findall(query_data)]
+
+def unescape_ql(s):
+    return QL_ESCAPE_RE.sub(r'\1', s)
+
+def tags_match(tags, tag_filters):
+    for (key, op, value) in tag_filters:
+        if key not in tags:
+            return False
+        elif op == '=' and tags[key] != value:
+            return False
+        elif op == '~' and not re.search(value, tags[key]):
+            return False
+    return True
+
+def bounds_intersect(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def union_bounds(bounds_list):
+    return (min(b[0] for b in bounds_list), min(b[1] for b in bounds_list),
+            max(b[2] for b in bounds_list), max(b[3] for b in bounds_list))
+
+def grid_cells(bounds, cell_size):
+    """ The (row, column) of every grid cell a bbox touches. """
+    rows = range(int(math.floor(bounds[0] / cell_size)), int(math.floor(bounds[2] / cell_size)) + 1)
+    columns = range(int(math.floor(bounds[1] / cell_size)), int(math.floor(bounds[3] / cell_size)) + 1)
+    return [(r, c) for r in rows for c in columns]
+
+def cluster_bounds(bounds_list, cell_size = CONFLICT_CLUSTER_CELL_SIZE):
+    """
+    Group bboxes by the grid cell their centre is in. Returns
+    [(bbox covering the group, [indexes into bounds_list])], in grid order.
+    """
+    cells = {}
+    for i, b in enumerate(bounds_list):
+        cell = (int(math.floor((b[0] + b[2]) / 2 / cell_size)), int(math.floor((b[1] + b[3]) / 2 / cell_size)))
+        cells.setdefault(cell, []).append(i)
+    return [(union_bounds([bounds_list[i] for i in cells[cell]]), cells[cell]) for cell in sorted(cells)]
+
+def element_bounds(element, elements_by_key, depth=0):
+    """
+    (south, west, north, east) of an element, from its own bounds if it was
+    output with geometry, otherwise from the nodes in the same response; None
+    if it has neither.
+    """
+    if element['type'] == 'node':
+        return (element['lat'], element['lon'], element['lat'], element['lon'])
+    if 'bounds' in element:
+        b = element['bounds']
+        return (b['minlat'], b['minlon'], b['maxlat'], b['maxlon'])
+    children = [elements_by_key.get(k) for k in element_children(element)]
+    if element['type'] == 'relation' and depth < 2:
+        children_bounds = [element_bounds(c, elements_by_key, depth + 1) for c in children if c and c['type'] != 'relation']
+    else:
+        children_bounds = [element_bounds(c, elements_by_key, depth + 1) for c in children if c and c['type'] == 'node']
+    children_bounds = filter(None, children_bounds)
+    if not children_bounds:
+        return None
+    return (min(b[0] for b in children_bounds), min(b[1] for b in children_bounds),
+            max(b[2] for b in children_bounds), max(b[3] for b in children_bounds))
+
+def element_children(element):
+    if element['type'] == 'way':
+        return [('node', n) for n in element.get('nodes', [])]
+    elif element['type'] == 'relation':
+        return [(m['type'], m['ref']) for m in element.get('members', [])]
+    else:
+        return []
+
+def element_recurse_down(element, elements_by_key):
+    """ The keys of what Overpass's ">" adds for an element: its members, and the nodes of its member ways. """
+    keys = set()
+    for k in element_children(element):
+        if k[0] == 'relation':
+            continue
+        keys.add(k)
+        child = elements_by_key.get(k)
+        if child and child['type'] == 'way':
+            keys.update(element_children(child))
+    return keys
+
+def demultiplex_elements(geotype, searches, elements):
+    """
+    Work out which elements of a union response each of its sub-queries
+    matched. searches are (bounds, tag filters) pairs in sub-query order.
+
+    Bounds are compared against each element's bounding box, so a way or
+    relation that only passes near a bbox corner counts as matching it: for
+    conflict checks that errs on the side of caution.
+    """
+    elements_by_key = dict(((e['type'], e['id']), e) for e in elements)
+    candidates = conflict_candidates(geotype, elements, elements_by_key)
+
+    splits = []
+    for (bounds, tag_filters) in searches:
+        keys = set()
+        for (e, tags, e_bounds) in candidates:
+            if (e_bounds is None or bounds_intersect(bounds, e_bounds)) and tags_match(tags, tag_filters):
+                keys.add((e['type'], e['id']))
+                if geotype != 'POINT':
+                    keys.update(element_recurse_down(e, elements_by_key))
+        splits.append([e for e in elements if (e['type'], e['id']) in keys])
+    return splits
+
+def is_conflict_candidate(geotype, element):
+    """ Whether a conflict query for geotype selects element itself, rather than through recursion. """
+    types = CONFLICT_QUERY_TYPES.get(geotype)
+    if types is None:
+        raise ValueError("Unsupported geometry type %s" % geotype)
+    if element['type'] not in types:
+        return False
+    if geotype == 'POLYGON' and element['type'] == 'relation' and element.get('tags', {}).get('type') != 'multipolygon':
+        return False
+    return True
+
+def conflict_candidates(geotype, elements, elements_by_key):
+    """ [(element, tags, bounds)] for the elements a conflict query for geotype selects itself. """
+    return [(e, e.get('tags', {}), element_bounds(e, elements_by_key)) for e in elements if is_conflict_candidate(geotype, e)]
+
+class FeatureBoundsIndex(object):
+    """ A grid over some bboxes, for checking which an element's bounds meet. """
+    def __init__(self, bounds_list, cell_size = CONFLICT_CLUSTER_CELL_SIZE):
+        self.bounds_list = bounds_list
+        self.cell_size = cell_size
+        self.grid = {}
+        for i, b in enumerate(bounds_list):
+            for cell in grid_cells(b, cell_size):
+                self.grid.setdefault(cell, []).append(i)
+
+    def meets(self, bounds):
+        """ Whether bounds meets any of the bboxes; bounds of None (unknown) does. """
+        if bounds is None:
+            return True
+        cells = grid_cells(bounds, self.cell_size)
+        if len(cells) < len(self.bounds_list):
+            nearby = set(i for cell in cells for i in self.grid.get(cell, ()))
+        else:
+            nearby = range(len(self.bounds_list))
+        return any(bounds_intersect(self.bounds_list[i], bounds) for i in nearby)
+
+def elements_near(geotype, bounds_list, elements, cell_size = CONFLICT_CLUSTER_CELL_SIZE):
+    """
+    The elements of a clustered conflict query response that would have
+    been found with a bbox per feature: those whose bounding box meets one of
+    bounds_list, and what came with them through recursion.
+    """
+    elements_by_key = dict(((e['type'], e['id']), e) for e in elements)
+    near = FeatureBoundsIndex(bounds_list, cell_size)
+
+    keys = set()
+    for (e, tags, e_bounds) in conflict_candidates(geotype, elements, elements_by_key):
+        if not near.meets(e_bounds):
+            continue
+        keys.add((e['type'], e['id']))
+        if geotype != 'POINT':
+            keys.update(element_recurse_down(e, elements_by_key))
+    return [e for e in elements if (e['type'], e['id']) in keys]
 
 def osm_geojson(osm_features, nodes={}, ways={}):
     return dedent("""
@@ -174,7 +501,9 @@ def osm_feature_geojson(osm_feature, nodes={}, ways={}):
               } } """ % geom.geojson
 
 def geometry_for_osm_feature(osm_feature, nodes={}, ways={}):
-    if osm_feature['type'] == 'way':
+    if osm_feature['type'] == 'way' and 'geometry' in osm_feature:
+        return LineString([Point(p['lon'], p['lat']) for p in osm_feature['geometry']])
+    elif osm_feature['type'] == 'way':
         node_list = filter(None, [
                 node_point(node_id, nodes) for node_id in osm_feature['nodes']
                 ])
@@ -209,34 +538,41 @@ def featureset_tag_search_for_data(layer_in_dataset, workslice_features, data_ta
     workslice_feature_db = dict([(wf.feature_id, wf) for wf in workslice_features])
     # FIXME: use apply_to when searching
 
-    session = requests.session()
-    conflicts = []
+    rows = [row_data for (row_data, row_geom) in data_table]
+    tag_filters = []
+    for tag in search_tags:
+        try:
+            if eval_type == 'conflict':
+                tag_filters.append(tag.eval_many_for_conflict_filter(rows))
+            elif eval_type == 'match':
+                tag_filters.append(tag.eval_many_for_match_filter(rows))
+        except tag.ScriptError, e:
+            from linz2osm.convert import osm
+            raise ValueError(osm.tag_script_error_message(tag, e))
+
+    searches = []
     for i, (row_data, row_geom) in enumerate(data_table):
-        query_tags = []
-        for tag in search_tags:
-            try:
-                if eval_type == 'conflict':
-                    v = tag.eval_for_conflict_filter(row_data)
-                elif eval_type == 'match':
-                    v = tag.eval_for_match_filter(row_data)
-            except tag.ScriptError, e:
-                emsg = "Error evaluating '%s' tag against record:\n" % tag
-                emsg += json.dumps(e.data, indent=2) + "\n"
-                emsg += str(e)
-                raise ValueError(emsg)
-            if (v is not None) and (v != ""):
-                query_tags.append(v)
+        query_tags = [f[i] for f in tag_filters if (f[i] is not None) and (f[i] != "")]
         feature_id = row_data[layer_in_dataset.layer.pkey_name]
         wf = workslice_feature_db[feature_id]
         if wf:
-            query_text = "\n".join(query_tags)
-
-            conflicts_json = osm_individual_conflicts_json(session, layer_in_dataset, wf, query_text)
-            conflicts.append((wf, conflicts_json,))
-
-            print conflicts_json
+            searches.append((wf, "\n".join(query_tags)))
         else:
             print "WORKSLICE FEATURE NOT FOUND"
-    session.close()
+
+    # the queries don't depend on each other, so the client sends them side by side
+    size = batch_size()
+    conflicts = []
+    with overpass_client() as client:
+        if size > 1:
+            searches = [(wf, query_text, wf.osm_individual_conflict_bounds(e)) for ((wf, query_text), e) in zip(searches, feature_extents([wf for (wf, query_text) in searches]))]
+            batches = [searches[i:i + size] for i in range(0, len(searches), size)]
+            responses = client.query_many([osm_batched_conflicts_query(layer_in_dataset, batch) for batch in batches])
+            for batch, response in zip(batches, responses):
+                conflicts.extend(split_batched_conflicts(layer_in_dataset, batch, response))
+        else:
+            extents = feature_extents([wf for (wf, query_text) in searches])
+            responses = client.query_many([osm_individual_conflicts_query(layer_in_dataset, wf, query_text, wf.osm_individual_conflict_bounds(e)) for ((wf, query_text), e) in zip(searches, extents)])
+            conflicts = zip([wf for (wf, query_text) in searches], responses)
     return conflicts
 
@@ -0,0 +1,563 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Talking to Overpass: a client that keeps to a per-endpoint limit on how
+many requests are in flight and how often new ones start, times requests
+out, retries the failures Overpass asks to be retried, and can send
+several independent queries at once from a small thread pool.
+
+Given several endpoints (mirrors), the client picks one for each request
+at random, weighted towards the quickest. It fails over to another
+straight away when one fails, and leaves alone for a while any endpoint
+that has failed UNHEALTHY_AFTER times in a row.
+
+Responses are kept in the Django cache named by LINZ2OSM_OVERPASS_CACHE,
+keyed by the normalised query, so the TTL and size limit are that cache's
+TIMEOUT and MAX_ENTRIES. Responses over LINZ2OSM_OVERPASS_CACHE_MAX_SIZE
+bytes aren't kept. Hits and misses are counted in OverpassCacheStats.
+
+query_elements() is for responses too big to hold: it hands back the
+elements one at a time as they're read off the connection, and doesn't
+cache them. The request counts against its endpoint's limit until the
+stream is read to the end or closed.
+"""
+
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from django.conf import settings
+from django.core.cache import get_cache, InvalidCacheBackendError
+
+# Overpass answers 429 when we have too many queries running, and 504 when
+# it is too busy to start ours
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# bboxes are widened to this many decimal places (about a metre), so
+# queries for nearly the same area share a cache entry
+BBOX_PRECISION = 5
+
+QL_STRING_RE = re.compile(r'("(?:[^"\\]|\\.)*")')
+QL_SPACE_RE = re.compile(r'\s*([()\[\];,:=~>])\s*')
+QL_BBOX_RE = re.compile(r'\((-?[0-9.]+),(-?[0-9.]+),(-?[0-9.]+),(-?[0-9.]+)\)')
+
+# how many failures in a row make an endpoint unhealthy, and for how long
+# (in seconds) it's left alone then
+UNHEALTHY_AFTER = 3
+UNHEALTHY_FOR = 300
+# latency assumed for an endpoint we haven't timed yet, and how much each
+# new timing moves the average
+DEFAULT_LATENCY = 1.0
+LATENCY_WEIGHT = 0.2
+
+CACHE_KEY_PREFIX = 'overpass:'
+
+# bytes to read off a streamed response at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = ' \t\n\r'
+# inside an element: a whole string, a bracket, or the start of a string that
+# runs on into the next chunk
+ELEMENT_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]|"')
+
+class OverpassError(Exception):
+    pass
+
+class ElementStream(object):
+    """
+    Iterates over the elements of an Overpass JSON response as its chunks
+    come in, holding no more than an element and a chunk at a time. Once
+    it's done, meta has the rest of the response: version, osm3s, and any
+    remark Overpass added at the end. A remark reporting an error (Overpass
+    ran out of time or memory part way) raises OverpassError, as the
+    elements before it are only some of the answer.
+    """
+    def __init__(self, chunks, close=None):
+        self.chunks = iter(chunks)
+        self.close = close
+        self.meta = {}
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def read(self):
+        """ Add the next chunk to the buffer; False once there are no more. """
+        chunk = self.next_chunk()
+        if chunk is None:
+            return False
+        if self.pos > len(self.buf) / 2:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        self.buf += chunk
+        return True
+
+    def next_chunk(self):
+        """ The next non-empty chunk, or None once there are no more. """
+        if self.eof:
+            return None
+        for chunk in self.chunks:
+            if chunk:
+                return chunk
+        self.eof = True
+        return None
+
+    def skip_whitespace(self):
+        """ The next non-whitespace character, reading more as needed, or None at the end. """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read():
+                return None
+
+    def __iter__(self):
+        try:
+            for element in self._elements():
+                yield element
+        finally:
+            if self.close is not None:
+                self.close()
+
+    def _elements(self):
+        # everything up to "elements" is small: version, generator, osm3s
+        while True:
+            start = self.buf.find('"elements"', self.pos)
+            if start >= 0:
+                break
+            if not self.read():
+                self.meta = self._loads(self.buf[self.pos:])
+                self._check_remark()
+                return
+        self.meta = self._loads(self.buf[self.pos:start].rstrip(WHITESPACE + ',') + '}')
+        self.pos = start + len('"elements"')
+        for expected in ':[':
+            if self.skip_whitespace() != expected:
+                raise OverpassError("Expected '%s' after \"elements\" in Overpass response" % expected)
+            self.pos += 1
+
+        while True:
+            c = self.skip_whitespace()
+            if c == ']':
+                self.pos += 1
+                break
+            elif c == ',':
+                self.pos += 1
+                continue
+            elif c is None:
+                raise OverpassError("Overpass response ended in the middle of its elements")
+            elif c != '{':
+                raise OverpassError("Expected an element in Overpass response, got '%s'" % c)
+            yield self._loads(self._element_text())
+
+        while self.read():
+            pass
+        tail = self.buf[self.pos:].strip(WHITESPACE).lstrip(',')
+        self.meta.update(self._loads('{' + tail))
+        self._check_remark()
+
+    def _element_text(self):
+        """
+        The text of the object starting at pos, reading as much more as it
+        takes. Each chunk is scanned once for where the object ends and only
+        joined on at the end, so an element spread over many chunks (a
+        relation with its geometry, say) costs no more than one in one.
+        """
+        parts = []
+        text = self.buf
+        start = i = self.pos
+        depth = 0
+        while True:
+            for m in ELEMENT_TOKEN_RE.finditer(text, i):
+                token = m.group()
+                if token == '"':
+                    # the string isn't all here yet, so look at it again with the next chunk
+                    i = m.start()
+                    break
+                elif token in '{[':
+                    depth += 1
+                elif token in '}]':
+                    depth -= 1
+                    if depth == 0:
+                        end = m.end()
+                        if not parts:
+                            self.pos = end
+                            return text[start:end]
+                        self.buf = text
+                        self.pos = end
+                        return ''.join(parts) + text[:end]
+            else:
+                i = len(text)
+            chunk = self.next_chunk()
+            if chunk is None:
+                raise OverpassError("Couldn't read an element from the Overpass response")
+            parts.append(text[start:i])
+            text = text[i:] + chunk
+            start = i = 0
+
+    def _check_remark(self):
+        remark = self.meta.get('remark') or ''
+        if 'error' in remark:
+            raise OverpassError("Overpass gave up part way: %s" % remark)
+
+    def _loads(self, text):
+        try:
+            return json.loads(text)
+        except ValueError:
+            raise OverpassError("Couldn't read the Overpass response: %s" % text[:200])
+
+def normalise_query(query):
+    """
+    query with the whitespace outside strings squeezed out and its bboxes
+    widened to BBOX_PRECISION places. It asks for at least as much as query.
+    """
+    parts = QL_STRING_RE.split(query)
+    for i in range(0, len(parts), 2):
+        part = QL_SPACE_RE.sub(r'\1', re.sub(r'\s+', ' ', parts[i]))
+        parts[i] = QL_BBOX_RE.sub(_widen_bbox, part)
+    return ''.join(parts).strip()
+
+def _widen_bbox(match):
+    scale = 10 ** BBOX_PRECISION
+    s, w, n, e = [float(v) for v in match.groups()]
+    return "(%.*f,%.*f,%.*f,%.*f)" % (
+        BBOX_PRECISION, math.floor(s * scale) / scale,
+        BBOX_PRECISION, math.floor(w * scale) / scale,
+        BBOX_PRECISION, math.ceil(n * scale) / scale,
+        BBOX_PRECISION, math.ceil(e * scale) / scale,
+        )
+
+def response_cache():
+    """ The cache Overpass responses go in, or None if there isn't one. """
+    name = getattr(settings, 'LINZ2OSM_OVERPASS_CACHE', None)
+    if not name:
+        return None
+    try:
+        return get_cache(name)
+    except InvalidCacheBackendError:
+        return None
+
+def cache_key(query):
+    # mirrors all answer the same, so which one asked doesn't matter
+    return CACHE_KEY_PREFIX + hashlib.sha1(query).hexdigest()
+
+def cache_stats():
+    """ {'hits': n, 'misses': n} for the response cache since it was last cleared. """
+    from linz2osm.convert.models import OverpassCacheStats
+    stats = OverpassCacheStats.current()
+    return {'hits': stats.hits, 'misses': stats.misses}
+
+def clear_cache_stats():
+    from linz2osm.convert.models import OverpassCacheStats
+    OverpassCacheStats.reset()
+
+class EndpointLimit(object):
+    """ How many requests may be running against an endpoint, and how many may start a second. """
+    def __init__(self, concurrency, rate=None):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_start = 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire(self):
+        self.semaphore.acquire()
+        if self.interval:
+            with self.lock:
+                now = time.time()
+                wait = self.next_start - now
+                self.next_start = max(now, self.next_start) + self.interval
+            if wait > 0:
+                time.sleep(wait)
+
+    def release(self):
+        self.semaphore.release()
+
+_limits = {}
+_limits_lock = threading.Lock()
+
+def endpoint_limit(url, concurrency, rate=None):
+    """ The EndpointLimit every client of url with these settings shares. """
+    with _limits_lock:
+        key = (url, concurrency, rate)
+        if key not in _limits:
+            _limits[key] = EndpointLimit(concurrency, rate)
+        return _limits[key]
+
+class Endpoint(object):
+    """
+    An Overpass server, as the client wants it: OverpassEndpoint is the one
+    kept in the database, this is for a URL from settings (or a test).
+    """
+    def __init__(self, url, concurrency=None):
+        self.url = url
+        self.concurrency = concurrency
+        self.latency = None
+        self.consecutive_failures = 0
+        self.unhealthy_until_time = None
+
+    def record(self, requests, failures, latency, consecutive_failures, unhealthy_until):
+        self.latency = latency
+        self.consecutive_failures = consecutive_failures
+        self.unhealthy_until_time = unhealthy_until
+
+class EndpointStats(object):
+    """ What a client has seen of an endpoint, to choose by and to record when it's done. """
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.requests = 0
+        self.failures = 0
+        self.latency = endpoint.latency
+        self.consecutive_failures = endpoint.consecutive_failures
+        self.unhealthy_until = endpoint.unhealthy_until_time
+
+    def healthy(self, now):
+        return self.unhealthy_until is None or self.unhealthy_until <= now
+
+    def succeeded(self, latency):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.unhealthy_until = None
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_WEIGHT * (latency - self.latency)
+
+    def failed(self):
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= UNHEALTHY_AFTER:
+            self.unhealthy_until = time.time() + UNHEALTHY_FOR
+
+    def record(self):
+        if self.requests:
+            self.endpoint.record(self.requests, self.failures, self.latency, self.consecutive_failures, self.unhealthy_until)
+            self.requests = self.failures = 0
+
+class OverpassClient(object):
+    def __init__(self, endpoints, concurrency=None, rate=None, timeout=None, retries=None, backoff=None, cache=True):
+        """
+        endpoints is a URL, or a list of Endpoints or OverpassEndpoints.
+        concurrency, if given, is the limit for each endpoint; otherwise an
+        endpoint's own, or LINZ2OSM_OVERPASS_CONCURRENCY.
+        """
+        if isinstance(endpoints, basestring):
+            endpoints = [Endpoint(endpoints)]
+        if not endpoints:
+            raise ValueError("No Overpass endpoints to use")
+        self.cache = response_cache() if cache is True else cache
+        self.cache_max_size = getattr(settings, 'LINZ2OSM_OVERPASS_CACHE_MAX_SIZE', None)
+        self.cache_hits = self.cache_misses = 0
+        self.rate = rate if rate is not None else getattr(settings, 'LINZ2OSM_OVERPASS_RATE', None)
+        self.timeout = timeout if timeout is not None else getattr(settings, 'LINZ2OSM_OVERPASS_TIMEOUT', None)
+        self.retries = retries if retries is not None else getattr(settings, 'LINZ2OSM_OVERPASS_RETRIES', 0)
+        self.backoff = backoff if backoff is not None else getattr(settings, 'LINZ2OSM_OVERPASS_BACKOFF', 1)
+        self.stats = [EndpointStats(e) for e in endpoints]
+        self.limits = {}
+        self.concurrency = 0
+        for endpoint in endpoints:
+            endpoint_concurrency = concurrency or endpoint.concurrency or getattr(settings, 'LINZ2OSM_OVERPASS_CONCURRENCY', 1)
+            self.limits[endpoint.url] = endpoint_limit(endpoint.url, endpoint_concurrency, self.rate)
+            self.concurrency += endpoint_concurrency
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._sessions_lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+        self._local = threading.local()
+        with self._stats_lock:
+            for stats in self.stats:
+                stats.record()
+            if self.cache_hits or self.cache_misses:
+                # the database has them, so that every process adds to the same counts
+                from linz2osm.convert.models import OverpassCacheStats
+                OverpassCacheStats.record(self.cache_hits, self.cache_misses)
+                self.cache_hits = self.cache_misses = 0
+
+    def _session(self):
+        # sessions aren't safe to share between threads, so each gets its own
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.session()
+            with self._sessions_lock:
+                self._sessions.append(session)
+        return session
+
+    def choose(self, tried=()):
+        """
+        The endpoint stats for the next request: a healthy endpoint we haven't
+        tried for it if there is one, chosen at random weighted by speed.
+        """
+        now = time.time()
+        with self._stats_lock:
+            candidates = [s for s in self.stats if s.endpoint.url not in tried and s.healthy(now)]
+            if not candidates:
+                candidates = [s for s in self.stats if s.endpoint.url not in tried] or self.stats
+            weights = [1.0 / max(s.latency or DEFAULT_LATENCY, 0.001) for s in candidates]
+        pick = random.uniform(0, sum(weights))
+        for stats, weight in zip(candidates, weights):
+            pick -= weight
+            if pick <= 0:
+                return stats
+        return candidates[-1]
+
+    def query(self, query):
+        """ Run an Overpass QL query and return the decoded JSON response, from the cache if it's there. """
+        if self.cache is None:
+            return self._post(query).json()
+        query = normalise_query(query)
+        key = cache_key(query)
+        response = self.cache.get(key)
+        with self._stats_lock:
+            if response is not None:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+        if response is not None:
+            return response
+        r = self._post(query)
+        response = r.json()
+        # Overpass reports running out of time or memory in a remark on an
+        # otherwise ordinary response, which we mustn't keep; and a very big
+        # one (out geom, say) isn't worth pickling into the cache
+        too_big = self.cache_max_size is not None and len(r.content) > self.cache_max_size
+        if 'error' not in response.get('remark', '') and not too_big:
+            self.cache.set(key, response)
+        return response
+
+    def query_elements(self, query):
+        """
+        Run an Overpass QL query and return an ElementStream of the elements in
+        its response, for responses too big to read in one go.
+        """
+        r, close = self._post(query, stream=True)
+        return ElementStream(r.iter_content(STREAM_CHUNK_SIZE), close)
+
+    def _post(self, query, stream=False):
+        """
+        The requests response to query; with stream, the open response and the
+        function to close it with, which frees up its endpoint.
+        """
+        session = self._session()
+        attempt = 0
+        tries = 0
+        tried = set()
+        while True:
+            stats = self.choose(tried)
+            url = stats.endpoint.url
+            limit = self.limits[url]
+            tried.add(url)
+            tries += 1
+            limit.acquire()
+            start = time.time()
+            try:
+                r = session.post(url, data={'data': query}, timeout=self.timeout, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+                limit.release()
+                with self._stats_lock:
+                    stats.failed()
+                if len(tried) < len(self.stats):
+                    # fail over to another endpoint without waiting
+                    continue
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+            except:
+                limit.release()
+                raise
+            else:
+                if r.status_code not in RETRY_STATUS_CODES:
+                    if stream and r.ok:
+                        # a streamed request isn't over until its body has been read
+                        return r, self._stream_closer(r, stats, limit, start)
+                    latency = time.time() - start
+                    limit.release()
+                    with self._stats_lock:
+                        stats.succeeded(latency)
+                    if stream:
+                        r.close()
+                    r.raise_for_status()
+                    return r
+                r.close()
+                limit.release()
+                with self._stats_lock:
+                    stats.failed()
+                if len(tried) < len(self.stats):
+                    continue
+                if attempt >= self.retries:
+                    raise OverpassError("Overpass returned HTTP %d after %d attempts" % (r.status_code, tries))
+                delay = self.backoff * 2 ** attempt
+                retry_after = r.headers.get('retry-after', '')
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            # every endpoint has failed this time round, so back off and start again
+            tried = set()
+            time.sleep(delay)
+            attempt += 1
+
+    def _stream_closer(self, r, stats, limit, start):
+        """ Closes streamed response r, releasing its endpoint's limit and timing it the first time it's called. """
+        pending = [True]
+        def close():
+            try:
+                pending.pop()
+            except IndexError:
+                return
+            r.close()
+            latency = time.time() - start
+            limit.release()
+            with self._stats_lock:
+                stats.succeeded(latency)
+        return close
+
+    def query_many(self, queries):
+        """ query() each of queries, up to concurrency at a time; the responses come back in the same order. """
+        if self.concurrency <= 1 or len(queries) <= 1:
+            return [self.query(q) for q in queries]
+        pool = ThreadPool(min(self.concurrency, len(queries)))
+        try:
+            return pool.map(self.query, queries)
+        finally:
+            pool.terminate()
+            pool.join()
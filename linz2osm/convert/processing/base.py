@@ -22,6 +22,8 @@ class Error(Exception):
 class BaseProcessor(object):
     geom_types = None
     multi_geometries = True # can handle multi-geometries. False == process each component
+    field_names = () # fields read from the row, so get_data_table fetches them. None == all of them
+    parallel_safe = True # False if it needs the database, so can't run in an export worker process
 
     def __init__(self):
         self.warnings = []
@@ -27,6 +27,7 @@ class RiverDirection(BaseProcessor):
 
     geom_types = (geos.LineString, geos.MultiLineString)
     multi_geometries = False
+    parallel_safe = False
 
     def __init__(self, db, table, srid=2193, tolerance=500, elevation_field='elevation', geom_field='wkb_geometry'):
         self.db = db
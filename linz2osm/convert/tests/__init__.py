@@ -1 +1,3 @@
 from osm import *
+from overpass import *
+from osm_extract import *
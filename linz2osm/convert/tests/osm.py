@@ -14,6 +14,7 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from cStringIO import StringIO
 from django.test import TestCase
 from xml.etree import ElementTree
 import math
@@ -259,6 +260,136 @@ class TestWriter(TestCase):
         nodes = w.tree.findall('./create/node')
         self.assertEqual(len(nodes), 6)
 
+    def test_node_key(self):
+        self.assertEqual(osm.node_key(174.1 + 0.2, -41.3), osm.node_key(174.3, -41.3))
+        self.assertNotEqual(osm.node_key(174.3, -41.3), osm.node_key(174.3, -41.3000001))
+        self.assertNotEqual(osm.node_key(174.3, -41.3), osm.node_key(174.3000001, -41.3))
+        self.assertNotEqual(osm.node_key(-180, 90), osm.node_key(180, -90))
+
+        w = osm.OSMCreateWriter()
+        w.build_way(((0.1 + 0.2, 1.0), (2.0, 3.0)), None)
+        w.build_way(((2.0, 3.0), (0.3, 1.0), (0.3, 1.000001)), None)
+        self.assertEqual(len(w.tree.findall('./create/node')), 3)
+
+    def test_precision(self):
+        self.assertEqual(osm.format_coordinate(174.12345678912, 7), '174.1234568')
+        self.assertEqual(osm.format_coordinate(-41.5, 7), '-41.5')
+        self.assertEqual(osm.format_coordinate(-0.00000001, 7), '0')
+        self.assertEqual(osm.format_coordinate(12.0, 7), '12')
+        self.assertEqual(osm.format_coordinate(174.12345678912), str(174.12345678912))
+
+        w = osm.OSMCreateWriter(precision=3)
+        w.build_way(((174.12345, -41.12345), (174.12349, -41.12349), (174.5, -41.5)), None)
+        w.build_way(((174.12301, -41.12301), (174.6, -41.6)), None)
+        nodes = w.tree.findall('./create/node')
+        self.assertEqual(len(nodes), 3)
+        self.assertEqual((nodes[0].get('lon'), nodes[0].get('lat')), ('174.123', '-41.123'))
+        ways = w.tree.findall('./create/way')
+        self.assertEqual(len(ways[0].findall('nd')), 2)
+        self.assertEqual(ways[1].find('nd').get('ref'), nodes[0].get('id'))
+        self.assert_(w.bytes_saved > 0)
+
+        # nodes are keyed by the coordinates as written: round(2.5) is 3, but '%.1f' % 0.25 is '0.2'
+        w = osm.OSMCreateWriter(precision=1)
+        w.build_way(((0.25, 1.0), (0.2, 1.0), (5.0, 5.0)), None)
+        self.assertEqual(len(w.tree.findall('./create/node')), 2)
+
+        # ways that would be left with too few nodes keep their repeated ones
+        w = osm.OSMCreateWriter(precision=3)
+        w.build_way(((174.12345, -41.12345), (174.12349, -41.12349)), None)
+        w.build_way(((174.5, -41.5), (174.50001, -41.5), (174.6, -41.6), (174.5, -41.5)), None)
+        ways = w.tree.findall('./create/way')
+        self.assertEqual(len(ways[0].findall('nd')), 2)
+        self.assertEqual(len(ways[1].findall('nd')), 4)
+
+        w = osm.OSMDeleteWriter(precision=2)
+        w.remove_node({'version': 1, 'changeset': 2, 'id': 3, 'lat': -41.12345, 'lon': 174.12345})
+        self.assertEqual(w.tree.find('./delete/node').get('lat'), '-41.12')
+        self.assertEqual(w.bytes_saved, 6)
+
+    def test_merge_partitions(self):
+        rc = []
+        for i in range(6):
+            r = random.random()
+            rc.append((r*100.0, r*10.0))
+
+        data = (
+            ( (rc[0], rc[1], rc[2],), None),
+            ( (rc[4], rc[5],), []),
+            ( (rc[1], rc[2], rc[3],), []),
+            ( (rc[5], rc[3],), []),
+        )
+
+        single = osm.OSMCreateWriter()
+        for coords, tags in data:
+            single.build_way(coords, tags)
+
+        # partitions that share nodes across the boundary
+        merged = osm.OSMCreateWriter()
+        for n, part in enumerate((data[:2], data[2:])):
+            w = osm.OSMCreateWriter(id_offset=n * osm.EXPORT_ID_RANGE)
+            for coords, tags in part:
+                w.build_way(coords, tags)
+            merged.merge(w.partition())
+
+        nodes = merged.tree.findall('./create/node')
+        node_ids = set([n.get('id') for n in nodes])
+        self.assertEqual(len(node_ids), len(nodes))
+        self.assertEqual(len(nodes), len(single.tree.findall('./create/node')))
+
+        coords = dict([(n.get('id'), (float(n.get('lon')), float(n.get('lat')))) for n in nodes])
+        ways = merged.tree.findall('./create/way')
+        self.assertEqual(len(ways), 4)
+        for (way_coords, tags), way in zip(data, ways):
+            for c, nd in zip(way_coords, way.findall('nd')):
+                self.assert_(nd.get('ref') in node_ids)
+                self.assertAlmostEqual(coords[nd.get('ref')][0], c[0])
+                self.assertAlmostEqual(coords[nd.get('ref')][1], c[1])
+
+        # rounding savings are added up across partitions
+        merged = osm.OSMCreateWriter(precision=5)
+        bytes_saved = 0
+        for n, part in enumerate((data[:2], data[2:])):
+            w = osm.OSMCreateWriter(id_offset=n * osm.EXPORT_ID_RANGE, precision=5)
+            for coords, tags in part:
+                w.build_way(coords, tags)
+            merged.merge(w.partition())
+            bytes_saved += w.bytes_saved
+        self.assert_(bytes_saved > 0)
+        self.assertEqual(merged.bytes_saved, bytes_saved)
+
+    def test_stream(self):
+        class AnyTag(object):
+            def apply_for(self, object_type):
+                return True
+        tags = [(u'name', u'unicode: \xe4\xf6\xfc', AnyTag())]
+
+        def build(w):
+            w.build_way(((1.0, 2.0), (3.0, 4.0), (5.0, 6.0)), tags, True)
+            w.build_way(((3.0, 4.0), (7.0, 8.0)), None)
+            w.build_rel(tags, [('outer', 'way', '-1')])
+
+        w = osm.OSMCreateWriter('bob')
+        build(w)
+        s = StringIO()
+        streamed = osm.OSMCreateWriter('bob', stream=s)
+        build(streamed)
+        streamed.close()
+        self.assertEqual(s.getvalue(), w.xml())
+        self.assertEqual(len(streamed.tree.findall('.//node')), 0)
+
+        s = StringIO()
+        streamed = osm.OSMCreateWriter(stream=s)
+        streamed.close()
+        self.assertEqual(s.getvalue(), osm.OSMCreateWriter().xml())
+
+        s = StringIO()
+        streamed = osm.OSMCreateWriter('bob', stream=s, indent=False)
+        build(streamed)
+        streamed.close()
+        self.assertEqual(s.getvalue().count('\n'), 1)
+        self.assertEqual(len(ElementTree.fromstring(s.getvalue()).findall('./create/node')), 4)
+
     def test_way_circular(self):
         w = osm.OSMCreateWriter()
 
@@ -0,0 +1,102 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from linz2osm.convert import osm_extract
+
+EXTRACT = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="-41.0" lon="174.0" version="2" user="someone">
+    <tag k="man_made" v="beacon"/>
+    <tag k="name" v="Te &quot;Rae&quot;"/>
+  </node>
+  <node id="2" lat="-41.0" lon="174.1" version="1"/>
+  <node id="3" lat="-41.0" lon="176.0" version="1"/>
+  <node id="4" lat="-43.0" lon="172.0" version="1">
+    <tag k="man_made" v="mast"/>
+  </node>
+  <way id="10" version="1">
+    <nd ref="1"/>
+    <nd ref="2"/>
+    <tag k="highway" v="track"/>
+  </way>
+  <way id="11" version="1">
+    <nd ref="2"/>
+    <nd ref="3"/>
+    <tag k="highway" v="residential"/>
+  </way>
+  <relation id="20" version="1">
+    <member type="way" ref="11" role="outer"/>
+    <tag k="type" v="multipolygon"/>
+    <tag k="landuse" v="forest"/>
+  </relation>
+</osm>
+"""
+
+class TestExtract(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        osm_path = os.path.join(self.tmp_dir, 'extract.osm')
+        with open(osm_path, 'w') as f:
+            f.write(EXTRACT)
+        self.assertEqual(osm_extract.load(osm_path, os.path.join(self.tmp_dir, 'extract.db')), 7)
+        self.client = osm_extract.ExtractClient(os.path.join(self.tmp_dir, 'extract.db'))
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def keys(self, query):
+        return [(e['type'], e['id']) for e in self.client.query(query)['elements']]
+
+    def test_nodes(self):
+        r = self.client.query('[out:json];\n(\n\nnode\n["man_made"]\n(-41.1,173.9,-40.9,174.05);\n\n);\nout meta;\n')
+        self.assertEqual(r['elements'], [{
+            'type': 'node', 'id': 1, 'lat': -41.0, 'lon': 174.0, 'version': 2, 'user': 'someone',
+            'tags': {'man_made': 'beacon', 'name': 'Te "Rae"'},
+        }])
+        self.assertEqual(self.keys('[out:json];(node["name"="Te \\"Rae\\""](-41.1,173.9,-40.9,174.05););out;'), [('node', 1)])
+        self.assertEqual(self.keys('[out:json];(node["man_made"~"^ma"](-90,-180,90,180););out;'), [('node', 4)])
+        self.assertEqual(self.keys('[out:json];(node["man_made"="beacon"](-43.1,171.9,-42.9,172.1););out;'), [])
+
+    def test_ways(self):
+        # way 11 passes through the bbox without a node in it
+        self.assertEqual(self.keys('[out:json];((way["highway"](-41.1,175.0,-40.9,175.1);>;););out;'),
+                         [('node', 2), ('node', 3), ('way', 11)])
+        self.assertEqual(self.keys('[out:json];(way["highway"="track"](-41.1,173.9,-40.9,174.05););(._;>;);out;'),
+                         [('node', 1), ('node', 2), ('way', 10)])
+
+    def test_relations(self):
+        self.assertEqual(self.keys('[out:json];((rel["type"="multipolygon"]["landuse"](-41.1,175.0,-40.9,175.1);way["landuse"](-41.1,175.0,-40.9,175.1);>;););out;'),
+                         [('relation', 20)])
+        self.assertEqual(self.keys('[out:json];((rel["landuse"](-41.1,175.0,-40.9,175.1);>;););out;'),
+                         [('node', 2), ('node', 3), ('way', 11), ('relation', 20)])
+
+    def test_out_modes(self):
+        r = self.client.query('[out:json];(way["highway"](-41.1,173.9,-40.9,174.05););out geom;')
+        self.assertEqual(r['elements'], [{
+            'type': 'way', 'id': 10, 'nodes': [1, 2], 'tags': {'highway': 'track'},
+            'geometry': [{'lat': -41.0, 'lon': 174.0}, {'lat': -41.0, 'lon': 174.1}],
+            'bounds': {'minlat': -41.0, 'minlon': 174.0, 'maxlat': -41.0, 'maxlon': 174.1},
+        }])
+        r = self.client.query('[out:json];(way["highway"](-41.1,173.9,-40.9,176.05);node["man_made"](-90,-180,90,180););out count;')
+        self.assertEqual(r['elements'][0]['tags'], {'nodes': '2', 'ways': '2', 'relations': '0', 'areas': '0', 'total': '4'})
@@ -0,0 +1,357 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import BaseHTTPServer
+import SocketServer
+import json
+import threading
+import time
+import urlparse
+
+import requests
+
+from django.core.cache import get_cache
+from django.test import TestCase
+
+from linz2osm.convert import overpass, overpass_client
+from linz2osm.convert.models import OverpassEndpoint
+from linz2osm.convert.overpass_client import ElementStream, Endpoint, OverpassClient, OverpassError, normalise_query
+
+def node(id, lon, lat, **tags):
+    return {'type': 'node', 'id': id, 'lon': lon, 'lat': lat, 'tags': tags}
+
+def way(id, nodes, **tags):
+    return {'type': 'way', 'id': id, 'nodes': nodes, 'tags': tags}
+
+class TestDemultiplex(TestCase):
+    def test_parse_tag_filters(self):
+        self.assertEqual(overpass.parse_tag_filters('["name"="Foo \\"Bar\\""]\n["amenity"]\n["ref"~"^1"]'), [
+            ('name', '=', 'Foo "Bar"'),
+            ('amenity', None, None),
+            ('ref', '~', '^1'),
+        ])
+
+    def test_points(self):
+        elements = [
+            node(1, 174.0, -41.0, man_made='beacon'),
+            node(2, 174.0, -41.0, man_made='mast'),
+            node(3, 175.0, -42.0, man_made='beacon'),
+        ]
+        near_1 = overpass.bounds_for((173.99, -41.01, 174.01, -40.99), 0)
+        near_3 = overpass.bounds_for((174.99, -42.01, 175.01, -41.99), 0)
+        splits = overpass.demultiplex_elements('POINT', [
+            (near_1, overpass.parse_tag_filters('["man_made"="beacon"]')),
+            (near_1, overpass.parse_tag_filters('["man_made"~"^ma"]')),
+            (near_3, overpass.parse_tag_filters('["man_made"="mast"]')),
+            (near_3, []),
+        ], elements)
+        self.assertEqual([[e['id'] for e in s] for s in splits], [[1], [2], [], [3]])
+
+    def test_ways(self):
+        elements = [
+            way(10, [1, 2], highway='track'),
+            way(11, [2, 3], highway='track'),
+            node(1, 174.0, -41.0),
+            node(2, 174.1, -41.0),
+            node(3, 176.0, -41.0),
+        ]
+        # a bbox part-way along way 11 has none of its nodes in it, but still matches it
+        splits = overpass.demultiplex_elements('LINESTRING', [
+            (overpass.bounds_for((173.99, -41.01, 174.01, -40.99), 0), overpass.parse_tag_filters('["highway"]')),
+            (overpass.bounds_for((175.0, -41.01, 175.01, -40.99), 0), overpass.parse_tag_filters('["highway"]')),
+            (overpass.bounds_for((177.0, -41.01, 177.01, -40.99), 0), overpass.parse_tag_filters('["highway"]')),
+        ], elements)
+        self.assertEqual([[(e['type'], e['id']) for e in s] for s in splits], [
+            [('way', 10), ('node', 1), ('node', 2)],
+            [('way', 11), ('node', 2), ('node', 3)],
+            [],
+        ])
+
+
+class TestClustering(TestCase):
+    def test_cluster_bounds(self):
+        bounds = [
+            (-41.0031, 174.0001, -41.0029, 174.0003),
+            (-41.0051, 174.0041, -41.0049, 174.0043),
+            (-41.5031, 174.0001, -41.5029, 174.0003),
+        ]
+        self.assertEqual(overpass.cluster_bounds(bounds, 0.01), [
+            ((-41.5031, 174.0001, -41.5029, 174.0003), [2]),
+            ((-41.0051, 174.0001, -41.0029, 174.0043), [0, 1]),
+        ])
+
+    def test_elements_near(self):
+        bounds = [(-41.0001, 174.0001, -40.9999, 174.0003), (-41.0021, 174.0041, -41.0019, 174.0043)]
+        # node 2 is inside the covering box for both, but near neither
+        elements = [
+            node(1, 174.0002, -41.0),
+            node(2, 174.002, -41.001),
+            node(3, 174.0042, -41.002),
+        ]
+        self.assertEqual([e['id'] for e in overpass.elements_near('POINT', bounds, elements, 0.01)], [1, 3])
+        self.assertEqual([e['id'] for e in overpass.elements_near('POINT', bounds, elements, 0.0001)], [1, 3])
+
+        elements = [
+            way(10, [1, 2], highway='track'),
+            way(11, [2, 3], highway='track'),
+            node(1, 174.0, -41.0),
+            node(2, 174.002, -41.001),
+            node(3, 174.0025, -41.001),
+        ]
+        self.assertEqual([(e['type'], e['id']) for e in overpass.elements_near('LINESTRING', bounds, elements, 0.001)],
+                         [('way', 10), ('node', 1), ('node', 2)])
+
+        # ways output with "out geom" carry their own bounds, and no nodes follow them
+        elements = [
+            dict(way(10, [1, 2], highway='track'), bounds={'minlat': -41.001, 'minlon': 174.0, 'maxlat': -41.0, 'maxlon': 174.002}),
+            dict(way(11, [2, 3], highway='track'), bounds={'minlat': -41.001, 'minlon': 174.002, 'maxlat': -41.001, 'maxlon': 174.0025}),
+        ]
+        self.assertEqual([e['id'] for e in overpass.elements_near('LINESTRING', bounds, elements, 0.001)], [10])
+
+class TestElementStream(TestCase):
+    RESPONSE = json.dumps({
+        'version': 0.6,
+        'osm3s': {'copyright': "data from OSM"},
+        'elements': [node(1, 174.0, -41.0, name=u'M\u0101ori Bay'), way(10, [1, 2], highway='track')],
+        'remark': "runtime error: ran out of time",
+    }, indent=1, sort_keys=True)
+
+    def chunked(self, text, size):
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def test_chunks(self):
+        expected = json.loads(self.RESPONSE)
+        for size in (1, 7, 64, len(self.RESPONSE)):
+            stream = ElementStream(self.chunked(self.RESPONSE, size))
+            elements = []
+            # the elements come out, but the error at the end means they aren't all there are
+            try:
+                for element in stream:
+                    elements.append(element)
+            except OverpassError:
+                pass
+            else:
+                self.fail("no OverpassError for the error remark")
+            self.assertEqual(elements, expected['elements'])
+            self.assertEqual(stream.meta, {'version': 0.6, 'osm3s': {'copyright': "data from OSM"}, 'remark': "runtime error: ran out of time"})
+
+    def test_large_element(self):
+        relation = {'type': 'relation', 'id': 1, 'tags': {'name': 'a "}]\\ b'},
+                    'members': [{'type': 'way', 'ref': i, 'geometry': [{'lat': -41.0, 'lon': 174.0}] * 10} for i in range(500)]}
+        response = json.dumps({'version': 0.6, 'elements': [relation, node(2, 174.0, -41.0)]})
+        stream = ElementStream(self.chunked(response, 100))
+        self.assertEqual(list(stream), [relation, node(2, 174.0, -41.0)])
+        self.assertEqual(stream.meta, {'version': 0.6})
+
+    def test_no_elements(self):
+        stream = ElementStream(self.chunked('{"version": 0.6, "elements": []}', 5))
+        self.assertEqual(list(stream), [])
+        self.assertEqual(stream.meta, {'version': 0.6})
+
+        stream = ElementStream(['{"version": 0.6, "remark": "no"}'])
+        self.assertEqual(list(stream), [])
+        self.assertEqual(stream.meta['remark'], "no")
+
+    def test_truncated(self):
+        stream = ElementStream(self.chunked(self.RESPONSE[:150], 10))
+        self.assertRaises(OverpassError, list, stream)
+
+class StubOverpassHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.getheader('content-length')))
+        query = urlparse.parse_qs(body)['data'][0]
+        with server.lock:
+            server.queries.append(query)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            fail = server.failures > 0
+            if fail:
+                server.failures -= 1
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+
+        if fail:
+            self.send_response(429)
+            self.end_headers()
+            return
+        response = json.dumps({'query': query, 'elements': []})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubOverpassServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Stands in for an Overpass server, answering each query with the query it was sent. """
+    daemon_threads = True
+
+    def __init__(self, delay=0, failures=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubOverpassHandler)
+        self.lock = threading.Lock()
+        self.queries = []
+        self.active = 0
+        self.max_active = 0
+        self.delay = delay
+        self.failures = failures
+
+    def handle_error(self, request, client_address):
+        # the timeout test hangs up before we answer
+        pass
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/api/interpreter" % self.server_address[1]
+
+class TestOverpassClient(TestCase):
+    def start_server(self, **kwargs):
+        server = StubOverpassServer(**kwargs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_query_many(self):
+        server = self.start_server(delay=0.1)
+        queries = ["node(%d);out;" % i for i in range(9)]
+        with OverpassClient(server.url, concurrency=3, timeout=5, cache=None) as client:
+            responses = client.query_many(queries)
+        self.assertEqual([r['query'] for r in responses], queries)
+        self.assertEqual(server.max_active, 3)
+
+    def test_rate(self):
+        server = self.start_server()
+        t0 = time.time()
+        with OverpassClient(server.url, concurrency=4, rate=20, timeout=5, cache=None) as client:
+            client.query_many(["node(%d);out;" % i for i in range(4)])
+        self.assert_(time.time() - t0 >= 0.15)
+
+    def test_retry(self):
+        server = self.start_server(failures=2)
+        with OverpassClient(server.url, timeout=5, retries=2, backoff=0, cache=None) as client:
+            self.assertEqual(client.query("node(1);out;")['query'], "node(1);out;")
+        self.assertEqual(len(server.queries), 3)
+
+        server.failures = 3
+        with OverpassClient(server.url, timeout=5, retries=2, backoff=0, cache=None) as client:
+            self.assertRaises(OverpassError, client.query, "node(1);out;")
+
+    def test_timeout(self):
+        server = self.start_server(delay=0.5)
+        with OverpassClient(server.url, timeout=0.1, retries=1, backoff=0, cache=None) as client:
+            self.assertRaises(requests.exceptions.Timeout, client.query, "node(1);out;")
+        self.assertEqual(len(server.queries), 2)
+
+    def test_cache(self):
+        server = self.start_server()
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='overpass-test')
+        with OverpassClient(server.url, timeout=5, cache=cache) as client:
+            r1 = client.query('[out:json];\nnode\n  ["name"="A  B"]\n  (-41.1234561,174.1234561,-41.1,174.2);\nout;')
+            r2 = client.query('[out:json]; node ["name"="A  B"] (-41.123457,174.123457,-41.1,174.2); out;')
+        self.assertEqual(r1, r2)
+        self.assertEqual(server.queries, ['[out:json];node["name"="A  B"](-41.12346,174.12345,-41.10000,174.20000);out;'])
+        self.assertEqual(overpass_client.cache_stats(), {'hits': 1, 'misses': 1})
+        overpass_client.clear_cache_stats()
+        self.assertEqual(overpass_client.cache_stats(), {'hits': 0, 'misses': 0})
+
+    def test_cache_max_size(self):
+        server = self.start_server()
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='overpass-test-max-size')
+        with self.settings(LINZ2OSM_OVERPASS_CACHE_MAX_SIZE=10):
+            with OverpassClient(server.url, timeout=5, cache=cache) as client:
+                client.query("node(1);out;")
+                client.query("node(1);out;")
+        # too big to keep, so asked for both times
+        self.assertEqual(len(server.queries), 2)
+
+    def test_normalise_query(self):
+        self.assertEqual(normalise_query('(\n  way\n  ["ref"~"^1 2"]\n  (1.0,2.0,3.0,4.0);\n  >;\n);\nout meta;\n'),
+                         '(way["ref"~"^1 2"](1.00000,2.00000,3.00000,4.00000);>;);out meta;')
+
+    def test_endpoint_pool(self):
+        fast = self.start_server()
+        slow = self.start_server(delay=0.05)
+        endpoints = [Endpoint(fast.url, 2), Endpoint(slow.url, 2)]
+        with OverpassClient(endpoints, timeout=5, cache=None) as client:
+            client.query_many(["node(%d);out;" % i for i in range(40)])
+        self.assert_(endpoints[0].latency < endpoints[1].latency)
+        self.assert_(len(fast.queries) > len(slow.queries))
+
+    def test_endpoint_failover(self):
+        down = self.start_server(failures=100)
+        up = self.start_server()
+        endpoints = [Endpoint(down.url), Endpoint(up.url)]
+        # make the broken one look much quicker, so it's tried until it's given up on
+        endpoints[0].latency, endpoints[1].latency = 0.001, 1000
+        with OverpassClient(endpoints, timeout=5, retries=1, backoff=10, cache=None) as client:
+            for i in range(10):
+                self.assertEqual(client.query("node(%d);out;" % i)['query'], "node(%d);out;" % i)
+        # it stops trying the broken one once it's failed a few times in a row
+        self.assertEqual(len(up.queries), 10)
+        self.assertEqual(len(down.queries), 3)
+        self.assertEqual(endpoints[0].consecutive_failures, 3)
+        self.assert_(endpoints[0].unhealthy_until_time > time.time())
+
+    def test_failover_without_retries(self):
+        down = self.start_server(failures=100)
+        up = self.start_server()
+        endpoints = [Endpoint(down.url), Endpoint(up.url)]
+        endpoints[0].latency, endpoints[1].latency = 0.001, 1000
+        with OverpassClient(endpoints, timeout=5, retries=0, backoff=10, cache=None) as client:
+            self.assertEqual(client.query("node(1);out;")['query'], "node(1);out;")
+        self.assertEqual((len(down.queries), len(up.queries)), (1, 1))
+
+        up.failures = 100
+        with OverpassClient(endpoints, timeout=5, retries=0, backoff=10, cache=None) as client:
+            self.assertRaises(OverpassError, client.query, "node(2);out;")
+
+    def test_endpoint_stats_saved(self):
+        server = self.start_server()
+        endpoint = OverpassEndpoint.objects.create(url=server.url, concurrency=1)
+        with overpass.overpass_client() as client:
+            client.cache = None
+            client.query("node(1);out;")
+            client.query("node(2);out;")
+        endpoint = OverpassEndpoint.objects.get(pk=endpoint.pk)
+        self.assertEqual((endpoint.requests, endpoint.failures), (2, 0))
+        self.assert_(endpoint.latency is not None and endpoint.last_used_at is not None)
+
+    def test_query_elements(self):
+        server = self.start_server()
+        with OverpassClient(server.url, timeout=5, cache=None) as client:
+            stream = client.query_elements("node(1);out;")
+            # the request holds its endpoint until the stream's been read
+            semaphore = client.limits[server.url].semaphore
+            self.assertFalse(semaphore.acquire(False))
+            self.assertEqual(client.stats[0].requests, 0)
+            self.assertEqual(list(stream), [])
+            self.assert_(semaphore.acquire(False))
+            semaphore.release()
+            self.assertEqual(client.stats[0].requests, 1)
+
+            # or closed
+            client.query_elements("node(2);out;").close()
+            self.assert_(semaphore.acquire(False))
+            semaphore.release()
+            self.assertEqual(client.stats[0].requests, 2)
+        self.assertEqual(stream.meta['query'], "node(1);out;")
@@ -19,9 +19,9 @@ import re
 from django.contrib import admin
 from django.template.loader import render_to_string
 from django import forms
-import pydermonkey
 
 from linz2osm.data_dict.models import Layer, Tag, LayerInDataset, Dataset, Group, Member
+from linz2osm.data_dict import scripting
 
 class LayerInDatasetInline(admin.StackedInline):
     model = LayerInDataset
@@ -64,9 +64,9 @@ class TagInlineForm(forms.ModelForm):
     def clean_code(self):
         code_text = self.cleaned_data['code']
 
-        js = pydermonkey.Runtime().new_context()
+        js = scripting.get_context()
         try:
-            js.compile_script(code_text, '<Tag Code>', 1)
+            scripting.compile_script(code_text)
         except (Exception,), e:
             e_msg = js.get_property(e.args[0], 'message')
             e_lineno = js.get_property(e.args[0], 'lineNumber')
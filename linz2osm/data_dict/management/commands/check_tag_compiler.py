@@ -0,0 +1,60 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from linz2osm.convert import osm
+from linz2osm.data_dict.models import LayerInDataset, Tag
+
+class Command(BaseCommand):
+    args = '[layer_name ...]'
+    help = "Check that tags compiled to Python give the same values as the JS engine on sample rows"
+    option_list = BaseCommand.option_list + (
+        make_option('--sample', type='int', default=100, help='Number of rows to check from each layer in each dataset'),
+    )
+
+    def handle(self, *layer_names, **options):
+        lids = LayerInDataset.objects.all()
+        if layer_names:
+            lids = lids.filter(layer__name__in=layer_names)
+
+        mismatched = 0
+        for lid in lids:
+            feature_ids = osm.get_base_and_limit_feature_ids(lid, 0, options['sample'])
+            if not feature_ids:
+                continue
+            rows = [row_data for (row_data, row_geom) in osm.get_data_table(lid, feature_ids)]
+
+            for tag in lid.get_all_tags():
+                try:
+                    mismatches = Tag.objects.compare_backends(tag.code, rows)
+                except Tag.ScriptError, e:
+                    print "%s / %s / %s: JS error: %s" % (lid.dataset.name, lid.layer.name, tag.tag, e)
+                    continue
+                if mismatches is None:
+                    print "%s / %s / %s: JS only" % (lid.dataset.name, lid.layer.name, tag.tag)
+                elif mismatches:
+                    mismatched += 1
+                    print "%s / %s / %s: %d of %d rows differ" % (lid.dataset.name, lid.layer.name, tag.tag, len(mismatches), len(rows))
+                    for fields, python_value, js_value in mismatches[:5]:
+                        print "    python %r, js %r for %r" % (python_value, js_value, fields)
+                else:
+                    print "%s / %s / %s: OK" % (lid.dataset.name, lid.layer.name, tag.tag)
+
+        if mismatched:
+            raise CommandError("%d tags gave different results; set LINZ2OSM_TAG_COMPILER = False until they're fixed" % mismatched)
@@ -0,0 +1,42 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from linz2osm.convert import osm_extract
+
+class Command(BaseCommand):
+    args = '<extract.osm> [snapshot]'
+    help = "Load an OSM extract (.osm, .osm.gz or .osm.bz2) into a snapshot for LINZ2OSM_OSM_EXTRACT"
+
+    def handle(self, osm_path=None, db_path=None, *args, **options):
+        if osm_path is None or args:
+            raise CommandError("Usage: load_osm_extract %s" % self.args)
+        db_path = db_path or getattr(settings, 'LINZ2OSM_OSM_EXTRACT', None)
+        if not db_path:
+            raise CommandError("Give a snapshot path, or set LINZ2OSM_OSM_EXTRACT")
+
+        # build beside the old snapshot, so it's in use until the new one's ready
+        tmp_path = db_path + '.loading'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        count = osm_extract.load(osm_path, tmp_path)
+        os.rename(tmp_path, db_path)
+        print "Loaded %d elements from %s into %s" % (count, osm_path, db_path)
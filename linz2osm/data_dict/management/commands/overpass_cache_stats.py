@@ -0,0 +1,39 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from linz2osm.convert import overpass_client
+
+class Command(BaseCommand):
+    help = "Show how often Overpass queries have been answered from the response cache"
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', action='store_true', dest='reset', default=False,
+                    help='Start counting again from zero'),
+    )
+
+    def handle(self, *args, **options):
+        if overpass_client.response_cache() is None:
+            raise CommandError("LINZ2OSM_OVERPASS_CACHE doesn't name a cache in CACHES")
+
+        stats = overpass_client.cache_stats()
+        total = stats['hits'] + stats['misses']
+        print "%d hits, %d misses (%.1f%% hit rate)" % (stats['hits'], stats['misses'], 100.0 * stats['hits'] / total if total else 0)
+        if options['reset']:
+            overpass_client.clear_cache_stats()
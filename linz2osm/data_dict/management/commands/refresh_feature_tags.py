@@ -0,0 +1,39 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from linz2osm.convert import feature_tags
+from linz2osm.data_dict.models import LayerInDataset
+
+class Command(BaseCommand):
+    args = '[dataset_name ...]'
+    help = "Evaluate every layer's tags and store them in the feature tags table of each dataset database"
+
+    def handle(self, *dataset_names, **options):
+        if not feature_tags.enabled():
+            raise CommandError("LINZ2OSM_FEATURE_TAG_CACHE is off, so stored tags would never be used")
+
+        lids = LayerInDataset.objects.select_related('layer', 'dataset')
+        if dataset_names:
+            lids = lids.filter(dataset__name__in=dataset_names)
+
+        for lid in lids:
+            with transaction.commit_on_success(using=lid.dataset.name):
+                stored = feature_tags.refresh(lid)
+            print "%s / %s: %d tag values" % (lid.dataset.name, lid.layer.name, stored)
@@ -24,14 +24,15 @@ import sys
 from functools import total_ordering
 
 from django.db import models, connections, transaction
-from django.db.models import Sum
+from django.db.models import Q, Sum, signals
 from django.conf import settings
 from django.contrib.gis.db import models as geomodels
 from django.contrib.gis import geos
 from django.contrib.auth.models import User
 
 from linz2osm.utils.db_fields import JSONField
-from linz2osm.convert import processing, osm
+from linz2osm.convert import feature_tags, processing, osm
+from linz2osm.data_dict import scripting, tag_code, tag_memo
 
 processor_list_html = '<ul class="help">' + ''.join(['<li><strong>%s</strong>: %s</li>' % p for p in sorted(processing.get_available().items())]) + '</ul>'
 
@@ -202,6 +203,7 @@ class Layer(models.Model):
     pkey_name = models.CharField(max_length=255, default='ogc_fid', choices=PKEY_CHOICES, help_text='Changing this on an existing dataset requires an update to existing workslice features in database')
     tags_ql = models.TextField(blank=True, null=True, help_text=('What tags to include in the OSM search. Separated with whitespace. In OSM Overpass API format ["name"="value"] ["name"~"valueish"] ["name"="this|that"] ["name"!="not-this"] etc.'), verbose_name='tags for overpass QL')
     custom_feature_limit = models.IntegerField(blank=True, null=True, help_text=('Override the default feature limit for this layer (0 or blank = default)'))
+    coordinate_precision = models.IntegerField(blank=True, null=True, help_text=('Decimal places to write node coordinates to in exports (blank = the site default)'))
 
     # FIXME: do this with a flag on the relevant tags?
     # You really don't want to use these unless you know what you're doing.
@@ -224,6 +226,12 @@ class Layer(models.Model):
     def __unicode__(self):
         return unicode(self.name)
 
+    @property
+    def output_coordinate_precision(self):
+        if self.coordinate_precision is not None:
+            return self.coordinate_precision
+        return getattr(settings, 'LINZ2OSM_COORDINATE_PRECISION', None)
+
     # This should only be needed for data_dict migration 0011:
     # the authoritative version is the geometry_type field.
     def deduce_geometry_type(self):
@@ -493,7 +501,7 @@ class Member(models.Model):
 
 
 class TagManager(models.Manager):
-    def eval(self, code, fields):
+    def js_fields(self, fields):
         eval_fields = {}
         for fk, fv in fields.items():
             if isinstance(fv, decimal.Decimal):
@@ -501,10 +509,64 @@ class TagManager(models.Manager):
             elif isinstance(fv, datetime.date):
                 fv = str(fv)
             eval_fields[fk] = fv
-
-        js = pydermonkey.Runtime().new_context()
+        return eval_fields
+
+    def script_error(self, js, e, data):
+        e_msg = js.get_property(e.args[0], 'message')
+        e_lineno = js.get_property(e.args[0], 'lineNumber')
+        en = Tag.ScriptError("%s (line %d)" % (e_msg, e_lineno))
+        en.data = data
+        return en
+
+    def use_compiler(self, backend):
+        if backend is None:
+            return getattr(settings, 'LINZ2OSM_TAG_COMPILER', True)
+        return backend == 'python'
+
+    def eval(self, code, fields, backend=None):
+        """
+        Evaluate tag code against a dict of fields. backend is 'python' or
+        'js' to force one evaluator; by default simple code is run as Python
+        and everything else through the JS engine.
+        """
+        eval_fields = self.js_fields(fields)
+        if self.use_compiler(backend):
+            try:
+                return self.eval_python(code, [eval_fields])[0]
+            except tag_code.Unsupported:
+                if backend == 'python':
+                    raise
+        return self.eval_js(code, eval_fields)
+
+    def eval_python(self, code, eval_rows, fallback=None):
+        """
+        Evaluate compiled tag code against eval_rows. Without fallback, raises
+        Unsupported if any row can't be done in Python; with it, those rows
+        are passed to fallback (as one list) instead.
+        """
+        compiled = tag_code.compile_tag(code)
+        if compiled is None:
+            raise tag_code.Unsupported("tag code needs the JS engine")
+        values = []
+        fallback_indices = []
+        for i, fields in enumerate(eval_rows):
+            try:
+                values.append(compiled(fields))
+            except tag_code.Unsupported:
+                if fallback is None:
+                    raise
+                values.append(None)
+                fallback_indices.append(i)
+        if fallback_indices:
+            fallback_values = fallback([eval_rows[i] for i in fallback_indices])
+            for i, value in zip(fallback_indices, fallback_values):
+                values[i] = value
+        return values
+
+    def eval_js(self, code, eval_fields):
+        js = scripting.get_context()
         try:
-            script = js.compile_script(code, '<Tag Code>', 1)
+            script = scripting.compile_script(code)
 
             context = js.new_object()
             js.init_standard_classes(context)
@@ -525,14 +587,83 @@ class TagManager(models.Manager):
             return value
         except (Exception,), e:
             if isinstance(e.args[0], pydermonkey.Object):
-                e_msg = js.get_property(e.args[0], 'message')
-                e_lineno = js.get_property(e.args[0], 'lineNumber')
-                en = Tag.ScriptError("%s (line %d)" % (e_msg, e_lineno))
-                en.data = eval_fields
-                raise en
+                raise self.script_error(js, e, eval_fields)
             else:
                 raise
 
+    def eval_many(self, code, rows, backend=None):
+        """
+        Evaluate tag code against a list of field dicts, in one JS call if
+        the code can't be run as Python. Returns a list of values in the same
+        order as rows. Inside tag_memo.memoised(), rows whose fields have been
+        seen before aren't evaluated again.
+        """
+        if not rows:
+            return []
+        eval_rows = [self.js_fields(fields) for fields in rows]
+        memo = tag_memo.current()
+        if memo is not None and backend is None:
+            return memo.eval_many(code, eval_rows, lambda missing_rows: self.eval_many_uncached(code, missing_rows))
+        return self.eval_many_uncached(code, eval_rows, backend)
+
+    def eval_many_uncached(self, code, eval_rows, backend=None):
+        if self.use_compiler(backend):
+            # only the rows the compiled code can't manage go to the JS engine
+            fallback = None if backend == 'python' else lambda rows: self.eval_many_js(code, rows)
+            try:
+                return self.eval_python(code, eval_rows, fallback)
+            except tag_code.Unsupported:
+                if backend == 'python':
+                    raise
+        return self.eval_many_js(code, eval_rows)
+
+    def eval_many_js(self, code, eval_rows):
+        js = scripting.get_context()
+        context = None
+        try:
+            script = scripting.compile_batch_script(code)
+
+            context = js.new_object()
+            js.init_standard_classes(context)
+            js.define_property(context, '__rows', scripting.encode_rows(eval_rows))
+
+            js.execute_script(context, script)
+
+            return scripting.decode_values(js.get_property(context, '__values'))
+        except (Exception,), e:
+            if e.args and isinstance(e.args[0], pydermonkey.Object):
+                failed_row = None
+                if context is not None:
+                    row_index = js.get_property(context, '__row')
+                    if isinstance(row_index, int) and row_index < len(eval_rows):
+                        failed_row = eval_rows[row_index]
+                raise self.script_error(js, e, failed_row)
+            else:
+                raise
+
+    def compare_backends(self, code, rows):
+        """
+        Evaluate code over rows with both the Python and JS backends. Returns
+        a list of (fields, python_value, js_value) for every row where they
+        disagree, or None if the code can't be compiled to Python at all.
+        Rows the compiled code hands back to JS are not compared.
+        """
+        compiled = tag_code.compile_tag(code)
+        if compiled is None:
+            return None
+        eval_rows = [self.js_fields(fields) for fields in rows]
+        js_values = self.eval_many_js(code, eval_rows) if eval_rows else []
+
+        mismatches = []
+        for fields, js_value in zip(eval_rows, js_values):
+            try:
+                python_value = compiled(fields)
+            except tag_code.Unsupported:
+                continue
+            if not tag_code.same_result(python_value, js_value):
+                mismatches.append((fields, python_value, js_value))
+        return mismatches
+
     def default(self):
         return self.get_query_set().filter(layer__isnull=True, group__isnull=True)
 
@@ -588,26 +719,46 @@ class Tag(models.Model):
         else:
             return True
 
+    @property
+    def field_dependencies(self):
+        """ The names of the fields this tag's code reads, or None if we can't tell. """
+        return tag_code.field_dependencies(self.code)
+
+    def get_layers_in_dataset(self):
+        """ The layers in datasets this tag applies to, once more specific tags have overridden it. """
+        lids = LayerInDataset.objects.select_related('layer', 'dataset')
+        if self.layer_id:
+            lids = lids.filter(layer=self.layer_id)
+        elif self.group_id:
+            lids = lids.filter(Q(dataset__group=self.group_id) | Q(layer__group=self.group_id))
+        return [lid for lid in lids if self.pk in [t.pk for t in lid.get_all_tags()]]
+
     def eval(self, fields):
         return Tag.objects.eval(self.code, fields)
 
+    def eval_many(self, rows):
+        return Tag.objects.eval_many(self.code, rows)
+
     def eval_for_match_filter(self, fields):
-        v = Tag.objects.eval(self.code, fields)
-        return '["%s"="%s"]' % (self.tag, v)
+        return self.eval_many_for_match_filter([fields])[0]
+
+    def eval_many_for_match_filter(self, rows):
+        return ['["%s"="%s"]' % (self.tag, v) for v in self.eval_many(rows)]
 
     def eval_for_conflict_filter(self, fields):
+        return self.eval_many_for_conflict_filter([fields])[0]
+
+    def eval_many_for_conflict_filter(self, rows):
         if self.conflict_search_tag == 0:
-            return None
+            return [None] * len(rows)
         elif self.conflict_search_tag == 3:
-            return '["%s"]' % self.tag
+            return ['["%s"]' % self.tag] * len(rows)
+        elif self.conflict_search_tag == 1:
+            return ['["%s"="%s"]' % (self.tag, v) for v in self.eval_many(rows)]
+        elif self.conflict_search_tag == 2:
+            return ['["%s"~"%s"]' % (self.tag, v) for v in self.eval_many(rows)]
         else:
-            v = Tag.objects.eval(self.code, fields)
-            if self.conflict_search_tag == 1:
-                return '["%s"="%s"]' % (self.tag, v)
-            elif self.conflict_search_tag == 2:
-                return '["%s"~"%s"]' % (self.tag, v)
-            else:
-                return None
+            return [None] * len(rows)
 
     @property
     def is_conflict_search_tag(self):
@@ -627,3 +778,31 @@ class Tag(models.Model):
             if self.tag.startswith("LINZ:"):
                 return False
         return self.tag.__lt__(other.tag)
+
+
+def invalidate_tag_scripts(sender, instance, **kwargs):
+    scripting.invalidate()
+
+signals.post_save.connect(invalidate_tag_scripts, sender=Tag)
+signals.post_delete.connect(invalidate_tag_scripts, sender=Tag)
+
+def refresh_feature_tags(sender, instance, **kwargs):
+    # only the edited tag needs recomputing; its old values no longer match its code
+    if kwargs.get('raw'):
+        return
+    if feature_tags.enabled():
+        from linz2osm.data_dict import tasks
+        for lid in instance.get_layers_in_dataset():
+            tasks.refresh_feature_tags.delay(lid, [instance])
+
+def forget_feature_tags(sender, instance, **kwargs):
+    # whether or not the cache is on, so nothing is left if it's turned back
+    # on; it's one DELETE where the table exists, and nothing where it doesn't
+    if kwargs.get('raw'):
+        return
+    for dataset in Dataset.objects.all():
+        with transaction.commit_on_success(using=dataset.name):
+            feature_tags.forget_tag(dataset, instance.pk)
+
+signals.post_save.connect(refresh_feature_tags, sender=Tag)
+signals.post_delete.connect(forget_feature_tags, sender=Tag)
@@ -0,0 +1,128 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared SpiderMonkey state for evaluating tag code.
+
+Spinning up a pydermonkey Runtime and compiling a script costs far more than
+running a one-line tag, so each thread keeps one warm context and an LRU of
+compiled scripts keyed by a hash of the tag code.
+"""
+
+import hashlib
+import json
+import math
+import threading
+
+import pydermonkey
+
+from linz2osm.utils.lru import LRUCache
+
+SCRIPT_CACHE_SIZE = 512
+SCRIPT_FILENAME = '<Tag Code>'
+
+# Runs the tag body once per row inside a single script. Rows go in and values
+# come out as JSON strings, so only two properties cross the Python/JS boundary.
+# The loop's own variables are locals the tag body can't see, and any globals
+# a row's body creates are deleted before the next row, so each row starts as
+# it would in a fresh context. Fields JSON can't hold (NaN and the infinities)
+# come separately and are put back before any row runs. __row is only there
+# to say which row an error came from.
+# The header sits on one line so error line numbers still match the tag code.
+BATCH_SCRIPT = (
+    "var __row = null, __values = (function (run, input, json, toNumber) {"
+    " var global = this, values = [], globals = {}, i, k, f;"
+    " for (k in global) globals[k] = true;"
+    " for (i = 0; i < input.nonFinite.length; i++) { f = input.nonFinite[i]; input.rows[f[0]][f[1]] = toNumber(f[2]); }"
+    " for (i = 0; i < input.rows.length; i++) {"
+    " __row = i; values.push(run(input.rows[i]));"
+    " for (k in global) if (!globals.hasOwnProperty(k)) delete global[k];"
+    " } return json.stringify(values);"
+    " })(function (fields) { var value = null; %s\n; return value; }, JSON.parse(__rows), JSON, Number);"
+)
+
+# SpiderMonkey keeps integers in 31 bits and hands anything larger back as a double
+JS_INT_MIN = -2 ** 30
+JS_INT_MAX = 2 ** 30 - 1
+
+_local = threading.local()
+_generation = [0]
+
+
+def code_digest(code):
+    if isinstance(code, unicode):
+        code = code.encode('utf8')
+    return hashlib.sha1(code).hexdigest()
+
+def get_context():
+    """ Return this thread's JS context, creating a runtime on first use. """
+    if getattr(_local, 'context', None) is None:
+        _local.context = pydermonkey.Runtime().new_context()
+        _local.scripts = LRUCache(SCRIPT_CACHE_SIZE)
+        _local.generation = _generation[0]
+    elif _local.generation != _generation[0]:
+        _local.scripts.clear()
+        _local.generation = _generation[0]
+    return _local.context
+
+def compile_script(code):
+    """ Compile tag code in this thread's context, reusing a cached script if we have one. """
+    js = get_context()
+    key = code_digest(code)
+    script = _local.scripts.get(key)
+    if script is None:
+        script = js.compile_script(code, SCRIPT_FILENAME, 1)
+        _local.scripts.set(key, script)
+    return script
+
+def compile_batch_script(code):
+    """ As compile_script, but wrapped to run over the rows encode_rows gives as '__rows'. """
+    # compiled bare first, so it's refused for whatever a single row would be
+    # (a top-level return, say) rather than accepted inside the wrapper
+    compile_script(code)
+    return compile_script(BATCH_SCRIPT % code)
+
+def encode_rows(rows):
+    """
+    JSON for rows as the batch script reads them: the rows, with NaN and the
+    infinities (as SQL-computed tags give) listed apart to be rebuilt in JS.
+    """
+    encoded = []
+    non_finite = []
+    for i, row in enumerate(rows):
+        fields = {}
+        for k, v in row.items():
+            # Exclude e.g. member_feature_ids, as for single-row evaluation
+            if isinstance(v, dict):
+                continue
+            if isinstance(v, float) and (math.isnan(v) or math.isinf(v)):
+                non_finite.append([i, k, 'NaN' if math.isnan(v) else ('Infinity' if v > 0 else '-Infinity')])
+                v = None
+            fields[k] = v
+        encoded.append(fields)
+    return json.dumps({'rows': encoded, 'nonFinite': non_finite}, allow_nan=False)
+
+def decode_values(values_json):
+    """ Turn a JSON array of results into the values pydermonkey would have returned. """
+    values = json.loads(values_json)
+    for i, v in enumerate(values):
+        if isinstance(v, (int, long)) and not isinstance(v, bool) and not (JS_INT_MIN <= v <= JS_INT_MAX):
+            values[i] = float(v)
+    return values
+
+def invalidate():
+    """ Drop compiled scripts in every thread (each clears lazily on next use). """
+    _generation[0] += 1
@@ -0,0 +1,797 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compiles simple tag code straight to Python.
+
+Most tags are one-liners like "value = fields.name;" or a short if/else or
+switch on one field, and don't need SpiderMonkey at all. compile_tag() parses
+the small subset of JavaScript those use and returns a Python callable with the
+same semantics, or None if the code strays outside the subset, in which case
+the caller should use the JS engine instead.
+
+A compiled callable can still raise Unsupported for a particular row (say, a
+field value we can't represent exactly, or a result that JSON would mangle),
+and the caller should fall back to JS then too.
+"""
+
+import math
+import re
+import threading
+
+from linz2osm.utils.lru import LRUCache
+from linz2osm.data_dict import scripting
+
+COMPILE_CACHE_SIZE = 512
+
+
+class Unsupported(Exception):
+    """ The code (or this row) is outside what we can evaluate in Python. """
+    pass
+
+
+class _Undefined(object):
+    def __repr__(self):
+        return 'undefined'
+
+UNDEFINED = _Undefined()
+BREAK = object()
+NAN = float('nan')
+INF = float('inf')
+
+# Doubles hold integers exactly up to here
+MAX_EXACT_INT = 2 ** 53
+
+TOKEN_RE = re.compile(ur'''
+      (?P<space>[ \t\r\n\f\v]+|//[^\n\r]*|/\*(?:[^*]|\*(?!/))*\*/)
+    | (?P<number>(?:0|[1-9][0-9]*)(?:\.[0-9]*)?(?:[eE][+-]?[0-9]+)?|\.[0-9]+(?:[eE][+-]?[0-9]+)?)
+    | (?P<string>"(?:[^"\\\n\r\u2028\u2029]|\\[^\n\r\u2028\u2029])*"|'(?:[^'\\\n\r\u2028\u2029]|\\[^\n\r\u2028\u2029])*')
+    | (?P<name>[A-Za-z_$][A-Za-z0-9_$]*)
+    | (?P<punct>===|!==|==|!=|<=|>=|&&|\|\||\+\+|--|<<|>>|[-+*/%&|^]=|[-+*/%<>!=?:;,.(){}\[\]~&|^])
+''', re.VERBOSE)
+
+# A forgiving tokenizer for any tag code, used only to find what it reads
+SCAN_RE = re.compile(ur'''
+      (?P<space>[ \t\r\n\f\v]+|//[^\n\r]*|/\*(?:[^*]|\*(?!/))*\*/)
+    | (?P<string>"(?:[^"\\\n\r]|\\(?:\r\n|.))*"|'(?:[^'\\\n\r]|\\(?:\r\n|.))*')
+    | (?P<name>[A-Za-z_$][A-Za-z0-9_$]*)
+    | (?P<number>[0-9][0-9A-Za-z_.]*|\.[0-9][0-9A-Za-z_]*)
+    | (?P<punct>.)
+''', re.VERBOSE | re.DOTALL)
+
+# Code mentioning any of these may give different answers for the same fields
+IMPURE_NAMES = set(['Date', 'random', 'this', 'eval', 'Function', 'arguments', '__row', '__input', '__values', '__rows'])
+
+NUMBER_RE = re.compile(r'^[+-]?(?:Infinity|(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)$')
+HEX_RE = re.compile(r'^0[xX][0-9a-fA-F]+$')
+FIELD_NAME_RE = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+
+STRING_ESCAPES = {
+    'b': u'\b', 't': u'\t', 'n': u'\n', 'v': u'\v', 'f': u'\f', 'r': u'\r',
+}
+
+# Things every JS object inherits: 'fields.constructor' is not a missing field
+OBJECT_PROPERTIES = set([
+    'constructor', 'toString', 'toLocaleString', 'toSource', 'valueOf',
+    'hasOwnProperty', 'isPrototypeOf', 'propertyIsEnumerable', 'watch', 'unwatch',
+])
+
+_compiled = LRUCache(COMPILE_CACHE_SIZE)
+_compiled_lock = threading.Lock()
+_analysed = LRUCache(COMPILE_CACHE_SIZE)
+_analysed_lock = threading.Lock()
+
+
+# JS value semantics. Inside a compiled tag, numbers are always floats, strings
+# always unicode, null is None and undefined is UNDEFINED.
+
+def js_type(v):
+    if v is UNDEFINED:
+        return 'undefined'
+    elif v is None:
+        return 'null'
+    elif isinstance(v, bool):
+        return 'boolean'
+    elif isinstance(v, float):
+        return 'number'
+    elif isinstance(v, unicode):
+        return 'string'
+    raise Unsupported("no JS type for %r" % (v,))
+
+def from_field(v):
+    """ Convert a (js_fields) field value to what JSON.parse would have made of it. """
+    if v is None or isinstance(v, (bool, unicode)):
+        return v
+    elif isinstance(v, (int, long)):
+        if abs(v) > MAX_EXACT_INT:
+            raise Unsupported("integer %d can't be held exactly in JS" % v)
+        return float(v)
+    elif isinstance(v, float):
+        if math.isnan(v) or math.isinf(v):
+            raise Unsupported("non-finite field value")
+        return v
+    elif isinstance(v, str):
+        try:
+            return v.decode('utf8')
+        except UnicodeDecodeError:
+            raise Unsupported("field value is not UTF-8")
+    elif isinstance(v, dict):
+        # excluded from the JS fields object
+        return UNDEFINED
+    raise Unsupported("can't convert field value %r" % (v,))
+
+def to_result(v):
+    """ Convert a value to what the JS engine would have handed back for it. """
+    if v is UNDEFINED:
+        return None
+    elif isinstance(v, float):
+        if math.isnan(v) or math.isinf(v) or (v == 0 and math.copysign(1.0, v) < 0):
+            # JSON can't carry these, so the batch and single-row JS paths disagree
+            raise Unsupported("non-JSON number result")
+        if v == math.floor(v) and scripting.JS_INT_MIN <= v <= scripting.JS_INT_MAX:
+            return int(v)
+    return v
+
+def same_result(a, b):
+    """ Whether two evaluated tag values are identical, type included (1 is not 1.0 or True). """
+    if isinstance(a, basestring) and isinstance(b, basestring):
+        return a == b
+    return type(a) is type(b) and a == b
+
+def to_boolean(v):
+    t = js_type(v)
+    if t == 'boolean':
+        return v
+    elif t == 'number':
+        return not (v == 0 or math.isnan(v))
+    elif t == 'string':
+        return len(v) > 0
+    return False
+
+def to_number(v):
+    t = js_type(v)
+    if t == 'number':
+        return v
+    elif t == 'undefined':
+        return NAN
+    elif t == 'null':
+        return 0.0
+    elif t == 'boolean':
+        return 1.0 if v else 0.0
+    s = v.strip(u' \t\n\r\v\f')
+    if s and (s[0].isspace() or s[-1].isspace() or u'\ufeff' in (s[0], s[-1])):
+        raise Unsupported("non-ASCII whitespace around number")
+    if not s:
+        return 0.0
+    elif NUMBER_RE.match(s):
+        return float(s)
+    elif HEX_RE.match(s):
+        return float(int(s, 16))
+    return NAN
+
+def number_to_string(x):
+    """ ECMA-262 Number.prototype.toString() for radix 10. """
+    if math.isnan(x):
+        return u'NaN'
+    elif x == 0:
+        return u'0'
+    elif math.isinf(x):
+        return u'Infinity' if x > 0 else u'-Infinity'
+    elif x < 0:
+        return u'-' + number_to_string(-x)
+
+    # repr() gives the shortest digits that round-trip, which is what JS wants;
+    # only the placement of the decimal point and exponent differ.
+    mantissa, _, exponent = repr(x).partition('e')
+    int_part, _, frac_part = mantissa.partition('.')
+    all_digits = int_part + frac_part
+    digits = all_digits.lstrip('0')
+    n = len(int_part) + int(exponent or 0) - (len(all_digits) - len(digits))
+    digits = digits.rstrip('0')
+    k = len(digits)
+
+    if k <= n <= 21:
+        s = digits + '0' * (n - k)
+    elif 0 < n <= 21:
+        s = digits[:n] + '.' + digits[n:]
+    elif -6 < n <= 0:
+        s = '0.' + '0' * -n + digits
+    else:
+        e = n - 1
+        s = digits[0]
+        if k > 1:
+            s += '.' + digits[1:]
+        s += 'e%s%d' % ('+' if e >= 0 else '-', abs(e))
+    return unicode(s)
+
+def to_string(v):
+    t = js_type(v)
+    if t == 'string':
+        return v
+    elif t == 'number':
+        return number_to_string(v)
+    elif t == 'boolean':
+        return u'true' if v else u'false'
+    return unicode(t)
+
+def strict_equals(a, b):
+    ta, tb = js_type(a), js_type(b)
+    if ta != tb:
+        return False
+    elif ta in ('undefined', 'null'):
+        return True
+    return a == b
+
+def loose_equals(a, b):
+    ta, tb = js_type(a), js_type(b)
+    if ta == tb:
+        return strict_equals(a, b)
+    elif set([ta, tb]) == set(['undefined', 'null']):
+        return True
+    elif ta == 'boolean':
+        return loose_equals(to_number(a), b)
+    elif tb == 'boolean':
+        return loose_equals(a, to_number(b))
+    elif (ta, tb) == ('number', 'string'):
+        return a == to_number(b)
+    elif (ta, tb) == ('string', 'number'):
+        return to_number(a) == b
+    return False
+
+def less_than(a, b):
+    """ Abstract relational comparison: True, False, or None for undefined. """
+    if isinstance(a, unicode) and isinstance(b, unicode):
+        # Python compares code points and JS compares UTF-16 code units; they
+        # only agree below the surrogate range.
+        if any(ord(c) >= 0xd800 for c in a + b):
+            raise Unsupported("can't compare non-BMP strings")
+        return a < b
+    x, y = to_number(a), to_number(b)
+    if math.isnan(x) or math.isnan(y):
+        return None
+    return x < y
+
+def js_add(a, b):
+    if isinstance(a, unicode) or isinstance(b, unicode):
+        return to_string(a) + to_string(b)
+    return to_number(a) + to_number(b)
+
+def js_divide(x, y):
+    if y == 0:
+        if x == 0 or math.isnan(x):
+            return NAN
+        return math.copysign(INF, x) * math.copysign(1.0, y)
+    try:
+        return x / y
+    except OverflowError:
+        raise Unsupported("overflow")
+
+def js_modulo(x, y):
+    if math.isnan(x) or math.isnan(y) or math.isinf(x) or y == 0:
+        return NAN
+    elif math.isinf(y):
+        return x
+    return math.fmod(x, y)
+
+BINARY_OPERATORS = {
+    '==': loose_equals,
+    '!=': lambda a, b: not loose_equals(a, b),
+    '===': strict_equals,
+    '!==': lambda a, b: not strict_equals(a, b),
+    '<': lambda a, b: less_than(a, b) is True,
+    '>': lambda a, b: less_than(b, a) is True,
+    '<=': lambda a, b: less_than(b, a) is False,
+    '>=': lambda a, b: less_than(a, b) is False,
+    '+': js_add,
+    '-': lambda a, b: to_number(a) - to_number(b),
+    '*': lambda a, b: to_number(a) * to_number(b),
+    '/': lambda a, b: js_divide(to_number(a), to_number(b)),
+    '%': lambda a, b: js_modulo(to_number(a), to_number(b)),
+}
+
+# lowest to highest
+BINARY_PRECEDENCE = [
+    ('==', '!=', '===', '!=='),
+    ('<', '>', '<=', '>='),
+    ('+', '-'),
+    ('*', '/', '%'),
+]
+
+
+class Token(object):
+    def __init__(self, kind, text, newline_before):
+        self.kind = kind
+        self.text = text
+        self.newline_before = newline_before
+
+    def __repr__(self):
+        return "%s(%r)" % (self.kind, self.text)
+
+def tokenize(code):
+    if isinstance(code, str):
+        code = code.decode('utf8')
+    tokens = []
+    pos = 0
+    newline = False
+    while pos < len(code):
+        m = TOKEN_RE.match(code, pos)
+        if m is None:
+            raise Unsupported("unexpected character %r" % code[pos])
+        pos = m.end()
+        if m.lastgroup == 'space':
+            newline = newline or ('\n' in m.group() or '\r' in m.group())
+        else:
+            tokens.append(Token(m.lastgroup, m.group(), newline))
+            newline = False
+    tokens.append(Token('eof', None, newline))
+    return tokens
+
+def decode_string(text):
+    chars = []
+    body = text[1:-1]
+    i = 0
+    while i < len(body):
+        c = body[i]
+        i += 1
+        if c != '\\':
+            chars.append(c)
+            continue
+        c = body[i]
+        i += 1
+        if c in STRING_ESCAPES:
+            chars.append(STRING_ESCAPES[c])
+        elif c in 'xu':
+            width = 2 if c == 'x' else 4
+            hex_digits = body[i:i + width]
+            if len(hex_digits) != width or not re.match(r'^[0-9a-fA-F]+$', hex_digits):
+                raise Unsupported("bad escape")
+            chars.append(unichr(int(hex_digits, 16)))
+            i += width
+        elif c == '0' and not body[i:i + 1].isdigit():
+            chars.append(u'\0')
+        elif c.isdigit():
+            raise Unsupported("octal escape")
+        else:
+            chars.append(c)
+    return u''.join(chars)
+
+
+class Parser(object):
+    """
+    Recursive-descent parser for the tag subset, producing a tuple tree:
+
+    statements: ('assign', expr), ('if', test, then, else_or_None),
+        ('switch', discriminant, [(test_or_None, [statement, ...]), ...]),
+        ('block', [statement, ...]), ('break',), ('empty',)
+    expressions: ('literal', value), ('field', name), ('value',),
+        ('not', e), ('neg', e), ('pos', e), ('binary', op, left, right),
+        ('and', left, right), ('or', left, right), ('cond', test, a, b)
+    """
+
+    def __init__(self, code):
+        self.tokens = tokenize(code)
+        self.pos = 0
+        self.switch_depth = 0
+        self.field_names = set()
+
+    @property
+    def token(self):
+        return self.tokens[self.pos]
+
+    def peek(self, *texts):
+        t = self.token
+        return t.kind in ('punct', 'name') and t.text in texts
+
+    def take(self, *texts):
+        if not self.peek(*texts):
+            raise Unsupported("expected %s, got %r" % (" or ".join(texts), self.token))
+        t = self.token
+        self.pos += 1
+        return t
+
+    def end_statement(self):
+        # explicit semicolon, or one automatically inserted
+        if self.peek(';'):
+            self.pos += 1
+        elif not (self.peek('}') or self.token.kind == 'eof' or self.token.newline_before):
+            raise Unsupported("expected ';', got %r" % self.token)
+
+    def parse_program(self):
+        body = []
+        while self.token.kind != 'eof':
+            body.append(self.parse_statement())
+        return ('block', body)
+
+    def parse_statement(self):
+        if self.peek(';'):
+            self.pos += 1
+            return ('empty',)
+        elif self.peek('{'):
+            self.pos += 1
+            body = []
+            while not self.peek('}'):
+                body.append(self.parse_statement())
+            self.pos += 1
+            return ('block', body)
+        elif self.peek('if'):
+            return self.parse_if()
+        elif self.peek('switch'):
+            return self.parse_switch()
+        elif self.peek('break'):
+            if not self.switch_depth:
+                raise Unsupported("break outside switch")
+            self.pos += 1
+            self.end_statement()
+            return ('break',)
+        elif self.peek('value'):
+            self.pos += 1
+            self.take('=')
+            expr = self.parse_expression()
+            self.end_statement()
+            return ('assign', expr)
+        raise Unsupported("unsupported statement at %r" % self.token)
+
+    def parse_if(self):
+        self.take('if')
+        self.take('(')
+        test = self.parse_expression()
+        self.take(')')
+        then_branch = self.parse_statement()
+        else_branch = None
+        if self.peek('else'):
+            self.pos += 1
+            else_branch = self.parse_statement()
+        return ('if', test, then_branch, else_branch)
+
+    def parse_switch(self):
+        self.take('switch')
+        self.take('(')
+        discriminant = self.parse_expression()
+        self.take(')')
+        self.take('{')
+
+        self.switch_depth += 1
+        clauses = []
+        has_default = False
+        while not self.peek('}'):
+            if self.peek('default'):
+                if has_default:
+                    raise Unsupported("duplicate default")
+                self.pos += 1
+                test = None
+                has_default = True
+            else:
+                self.take('case')
+                test = self.parse_expression()
+            self.take(':')
+            body = []
+            while not self.peek('case', 'default', '}'):
+                body.append(self.parse_statement())
+            clauses.append((test, body))
+        self.pos += 1
+        self.switch_depth -= 1
+        return ('switch', discriminant, clauses)
+
+    def parse_expression(self):
+        test = self.parse_logical_or()
+        if not self.peek('?'):
+            return test
+        self.pos += 1
+        if_true = self.parse_expression()
+        self.take(':')
+        if_false = self.parse_expression()
+        return ('cond', test, if_true, if_false)
+
+    def parse_logical_or(self):
+        left = self.parse_logical_and()
+        while self.peek('||'):
+            self.pos += 1
+            left = ('or', left, self.parse_logical_and())
+        return left
+
+    def parse_logical_and(self):
+        left = self.parse_binary(0)
+        while self.peek('&&'):
+            self.pos += 1
+            left = ('and', left, self.parse_binary(0))
+        return left
+
+    def parse_binary(self, level):
+        if level == len(BINARY_PRECEDENCE):
+            return self.parse_unary()
+        left = self.parse_binary(level + 1)
+        while self.token.kind == 'punct' and self.token.text in BINARY_PRECEDENCE[level]:
+            op = self.token.text
+            self.pos += 1
+            left = ('binary', op, left, self.parse_binary(level + 1))
+        return left
+
+    def parse_unary(self):
+        for op, node in (('!', 'not'), ('-', 'neg'), ('+', 'pos')):
+            if self.peek(op):
+                self.pos += 1
+                return (node, self.parse_unary())
+        expr = self.parse_primary()
+        if self.peek('(', '[', '.'):
+            raise Unsupported("unsupported member access or call at %r" % self.token)
+        return expr
+
+    def parse_primary(self):
+        t = self.token
+        self.pos += 1
+        if t.kind == 'number':
+            return ('literal', float(t.text))
+        elif t.kind == 'string':
+            return ('literal', decode_string(t.text))
+        elif t.kind == 'punct' and t.text == '(':
+            expr = self.parse_expression()
+            self.take(')')
+            return expr
+        elif t.kind == 'name':
+            if t.text in ('true', 'false'):
+                return ('literal', t.text == 'true')
+            elif t.text == 'null':
+                return ('literal', None)
+            elif t.text == 'undefined':
+                return ('literal', UNDEFINED)
+            elif t.text == 'value':
+                return ('value',)
+            elif t.text == 'fields':
+                return self.parse_field()
+        raise Unsupported("unsupported expression at %r" % t)
+
+    def parse_field(self):
+        if self.peek('.'):
+            self.pos += 1
+            t = self.token
+            if t.kind != 'name':
+                raise Unsupported("expected field name, got %r" % t)
+            name = t.text
+        elif self.peek('['):
+            self.pos += 1
+            t = self.token
+            if t.kind != 'string':
+                raise Unsupported("only literal field names are supported")
+            name = decode_string(t.text)
+            self.pos += 1
+            if not self.peek(']'):
+                raise Unsupported("expected ']', got %r" % self.token)
+        else:
+            raise Unsupported("'fields' must be followed by a field name")
+        self.pos += 1
+
+        if not FIELD_NAME_RE.match(name) or name in OBJECT_PROPERTIES:
+            raise Unsupported("can't look up field %r" % name)
+        name = str(name)
+        self.field_names.add(name)
+        return ('field', name)
+
+
+def parse(code):
+    """ Returns (tree, field names read) for code, or raises Unsupported. """
+    parser = Parser(code)
+    try:
+        tree = parser.parse_program()
+    except IndexError:
+        raise Unsupported("unexpected end of code")
+    return tree, frozenset(parser.field_names)
+
+
+class _Frame(object):
+    __slots__ = ('fields', 'value')
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.value = None
+
+
+def build_statement(node):
+    """ Turn a statement node into a closure over a _Frame, returning BREAK or None. """
+    kind = node[0]
+    if kind == 'empty':
+        return lambda frame: None
+    elif kind == 'break':
+        return lambda frame: BREAK
+    elif kind == 'block':
+        return build_sequence(node[1])
+    elif kind == 'assign':
+        expr = build_expression(node[1])
+        def assign(frame):
+            frame.value = expr(frame)
+        return assign
+    elif kind == 'if':
+        test = build_expression(node[1])
+        then_branch = build_statement(node[2])
+        else_branch = build_statement(node[3]) if node[3] is not None else None
+        def run_if(frame):
+            if to_boolean(test(frame)):
+                return then_branch(frame)
+            elif else_branch is not None:
+                return else_branch(frame)
+        return run_if
+    elif kind == 'switch':
+        return build_switch(node[1], node[2])
+    raise Unsupported("unknown statement %r" % (kind,))
+
+def build_sequence(statements):
+    statements = [build_statement(s) for s in statements]
+    def run(frame):
+        for s in statements:
+            if s(frame) is BREAK:
+                return BREAK
+    return run
+
+def build_switch(discriminant_node, clause_nodes):
+    discriminant = build_expression(discriminant_node)
+    clauses = []
+    default_index = None
+    for i, (test, body) in enumerate(clause_nodes):
+        if test is None:
+            default_index = i
+        else:
+            test = build_expression(test)
+        clauses.append((test, build_sequence(body)))
+
+    def run(frame):
+        d = discriminant(frame)
+        start = default_index
+        for i, (test, body) in enumerate(clauses):
+            if test is not None and strict_equals(d, test(frame)):
+                start = i
+                break
+        if start is not None:
+            for test, body in clauses[start:]:
+                if body(frame) is BREAK:
+                    break
+    return run
+
+def build_expression(node):
+    """ Turn an expression node into a closure over a _Frame, returning a JS value. """
+    kind = node[0]
+    if kind == 'literal':
+        v = node[1]
+        return lambda frame: v
+    elif kind == 'value':
+        return lambda frame: frame.value
+    elif kind == 'field':
+        name = node[1]
+        def lookup(frame):
+            if name in frame.fields:
+                return from_field(frame.fields[name])
+            return UNDEFINED
+        return lookup
+    elif kind == 'not':
+        operand = build_expression(node[1])
+        return lambda frame: not to_boolean(operand(frame))
+    elif kind == 'neg':
+        operand = build_expression(node[1])
+        return lambda frame: -to_number(operand(frame))
+    elif kind == 'pos':
+        operand = build_expression(node[1])
+        return lambda frame: to_number(operand(frame))
+    elif kind == 'binary':
+        op = BINARY_OPERATORS[node[1]]
+        left, right = build_expression(node[2]), build_expression(node[3])
+        return lambda frame: op(left(frame), right(frame))
+    elif kind == 'and':
+        left, right = build_expression(node[1]), build_expression(node[2])
+        def run_and(frame):
+            v = left(frame)
+            return right(frame) if to_boolean(v) else v
+        return run_and
+    elif kind == 'or':
+        left, right = build_expression(node[1]), build_expression(node[2])
+        def run_or(frame):
+            v = left(frame)
+            return v if to_boolean(v) else right(frame)
+        return run_or
+    elif kind == 'cond':
+        test, if_true, if_false = [build_expression(n) for n in node[1:]]
+        return lambda frame: if_true(frame) if to_boolean(test(frame)) else if_false(frame)
+    raise Unsupported("unknown expression %r" % (kind,))
+
+
+class CompiledTag(object):
+    """ Tag code compiled to Python: call it with a js_fields() dict. """
+
+    def __init__(self, code):
+        tree, self.field_names = parse(code)
+        self.body = build_statement(tree)
+
+    def __call__(self, fields):
+        frame = _Frame(fields)
+        self.body(frame)
+        return to_result(frame.value)
+
+
+def compile_tag(code):
+    """
+    Return a CompiledTag for code, or None if it needs the JS engine.
+    Results are cached by code digest, including the failures.
+    """
+    key = scripting.code_digest(code)
+    with _compiled_lock:
+        if key in _compiled:
+            return _compiled.get(key)
+    try:
+        compiled = CompiledTag(code)
+    except Unsupported:
+        compiled = None
+    with _compiled_lock:
+        _compiled.set(key, compiled)
+    return compiled
+
+
+def _analyse(code):
+    if isinstance(code, str):
+        code = code.decode('utf8')
+    tokens = []
+    for m in SCAN_RE.finditer(code):
+        if m.lastgroup != 'space':
+            tokens.append((m.lastgroup, m.group()))
+
+    field_names = set()
+    pure = True
+    for i, (kind, text) in enumerate(tokens):
+        if kind == 'punct' and text in '/\\':
+            # a regex literal or escaped identifier could hide anything
+            return None, False
+        elif kind != 'name':
+            continue
+        if text in IMPURE_NAMES:
+            if text in ('eval', 'Function', 'this'):
+                return None, False
+            pure = False
+        if text != 'fields' or (i > 0 and tokens[i - 1] == ('punct', '.')):
+            continue
+        following = tokens[i + 1:i + 4]
+        if len(following) >= 2 and following[0] == ('punct', '.') and following[1][0] == 'name':
+            field_names.add(str(following[1][1]))
+        elif len(following) == 3 and following[0] == ('punct', '[') and following[1][0] == 'string' and following[2] == ('punct', ']'):
+            try:
+                field_names.add(str(decode_string(following[1][1])))
+            except (Unsupported, UnicodeEncodeError):
+                return None, pure
+        else:
+            # fields passed around or indexed by a variable
+            return None, pure
+    return frozenset(field_names), pure
+
+def analyse(code):
+    """
+    Returns (field names, pure) for any tag code, not just the compilable
+    subset. field names is the set of fields the code reads, or None if we
+    can't tell. pure is False if it might give different values for the same
+    fields (Date, Math.random).
+    """
+    key = scripting.code_digest(code)
+    with _analysed_lock:
+        if key in _analysed:
+            return _analysed.get(key)
+    result = _analyse(code)
+    with _analysed_lock:
+        _analysed.set(key, result)
+    return result
+
+def field_dependencies(code):
+    return analyse(code)[0]
+
+def memo_fields(code):
+    """ The fields to memoise code's results on, or None if it can't be memoised. """
+    field_names, pure = analyse(code)
+    if not pure:
+        return None
+    return field_names
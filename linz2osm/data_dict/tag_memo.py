@@ -0,0 +1,118 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Memoised tag results.
+
+Most tags only read a couple of fields, and across a layer those fields take
+few distinct values (think dataset_name, or a road's surface type), so most
+evaluations repeat one we've already done. Inside a memoised() block,
+Tag.objects.eval_many() keys each row on the code and the values of just the
+fields it reads, and only evaluates rows it hasn't seen before.
+
+The memo belongs to the thread, so wrap a whole task in memoised() to share
+it between export_custom, featureset_conflicts and featureset_matches.
+"""
+
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from linz2osm.utils.lru import LRUCache
+from linz2osm.data_dict import scripting, tag_code
+
+TAG_MEMO_SIZE = 100000
+
+_local = threading.local()
+
+
+class TagMemo(object):
+    def __init__(self, max_size=TAG_MEMO_SIZE):
+        self.values = LRUCache(max_size)
+        self.hits = 0
+        self.misses = 0
+
+    def eval_many(self, code, eval_rows, evaluate):
+        """
+        As evaluate(eval_rows), which should return a value per row, but
+        only passing it one row for each distinct key not already memoised.
+        """
+        field_names = tag_code.memo_fields(code)
+        if field_names is None:
+            return evaluate(eval_rows)
+        field_names = sorted(field_names)
+        digest = scripting.code_digest(code)
+
+        values = [None] * len(eval_rows)
+        missing = OrderedDict()
+        for i, fields in enumerate(eval_rows):
+            key = memo_key(digest, field_names, fields)
+            if key is None:
+                # can't be keyed, so evaluate it on its own
+                missing[(None, i)] = [i]
+            elif key in self.values:
+                values[i] = self.values.get(key)
+                self.hits += 1
+            else:
+                missing.setdefault(key, []).append(i)
+
+        if missing:
+            results = evaluate([eval_rows[indexes[0]] for indexes in missing.itervalues()])
+            for (key, indexes), v in zip(missing.iteritems(), results):
+                if key[0] is not None:
+                    self.values.set(key, v)
+                self.misses += 1
+                self.hits += len(indexes) - 1
+                for i in indexes:
+                    values[i] = v
+        return values
+
+
+def memo_key(digest, field_names, fields):
+    key = [digest]
+    for name in field_names:
+        if name not in fields:
+            key.append(('missing',))
+            continue
+        v = fields[name]
+        if isinstance(v, float):
+            # keeps -0.0 and 0.0 apart, and lets NaN match itself
+            key.append(('float', repr(v)))
+        elif isinstance(v, dict):
+            # not passed to the tag code
+            key.append(('missing',))
+        elif v is None or isinstance(v, (basestring, bool, int, long)):
+            key.append((type(v).__name__, v))
+        else:
+            return None
+    return tuple(key)
+
+def current():
+    """ The memo for the enclosing memoised() block, or None. """
+    return getattr(_local, 'memo', None)
+
+@contextmanager
+def memoised(max_size=TAG_MEMO_SIZE):
+    """ Memoise tag results until the block ends. Nested blocks share the outermost memo. """
+    if current() is not None:
+        yield current()
+        return
+    _local.memo = TagMemo(max_size)
+    try:
+        yield _local.memo
+    finally:
+        _local.memo = None
@@ -0,0 +1,398 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Translates simple tag code into a PostgreSQL expression.
+
+get_data_table() can then select each tag's value alongside the feature's
+columns instead of evaluating it per row afterwards. This works from the same
+parse tree as tag_code, but only covers what SQL can reproduce exactly:
+string, integer and boolean columns (floats can only be passed straight
+through), null-safe comparisons, string concatenation, if/else, ?: and
+switch statements without fall-through into a break. translate_tag() returns
+None for anything else and the tag is evaluated in Python or JS as before.
+"""
+
+import decimal
+import math
+
+from linz2osm.data_dict import tag_code
+from linz2osm.data_dict.tag_code import Unsupported, UNDEFINED
+
+STRING_TYPES = ('text', 'varchar', 'bpchar')
+INTEGER_TYPES = ('int2', 'int4')
+# psycopg2 hands these back rounded, so we can return them but not compare them
+PASSTHROUGH_NUMBER_TYPES = ('float8', 'numeric')
+BOOLEAN_TYPES = ('bool',)
+
+# Whatever unicode.strip() removes, so btrim() matches osm.clean_data()
+PYTHON_WHITESPACE = u''.join([unichr(i) for i in xrange(0x3001) if unichr(i).isspace()])
+
+SQL_INT_MAX = 2 ** 31 - 1
+
+_NOT_CONSTANT = object()
+
+
+def sql_string(s):
+    """ A PostgreSQL escape-string literal, independent of standard_conforming_strings. """
+    chars = []
+    for c in s:
+        if c == u'\0':
+            raise Unsupported("NUL in string")
+        elif c in u"'\\":
+            chars.append(c * 2)
+        elif u' ' <= c <= u'~':
+            chars.append(c)
+        elif ord(c) > 0xffff:
+            chars.append(u'\\U%08x' % ord(c))
+        else:
+            chars.append(u'\\u%04x' % ord(c))
+    return u"E'%s'" % u''.join(chars)
+
+
+class SqlExpr(object):
+    """
+    A SQL expression with what we know about the JS value it stands for.
+    js_type is 'string', 'number', 'boolean', 'null' or 'undefined'.
+    """
+
+    def __init__(self, sql, js_type, nullable=True, integer=False, opaque=False, maybe_undefined=False, constant=_NOT_CONSTANT):
+        self.sql = sql
+        self.js_type = js_type
+        self.nullable = nullable
+        self.integer = integer
+        # a number we can hand back but not compute with
+        self.opaque = opaque
+        # NULL might be JS undefined rather than null
+        self.maybe_undefined = maybe_undefined
+        self.constant = constant
+
+    @property
+    def is_constant(self):
+        return self.constant is not _NOT_CONSTANT
+
+def literal(v):
+    t = tag_code.js_type(v)
+    if t == 'undefined':
+        return SqlExpr('NULL', t, maybe_undefined=True, constant=v)
+    elif t == 'null':
+        return SqlExpr('NULL', t, constant=v)
+    elif t == 'boolean':
+        return SqlExpr('TRUE' if v else 'FALSE', t, nullable=False, constant=v)
+    elif t == 'number':
+        if math.isnan(v) or math.isinf(v):
+            raise Unsupported("non-finite number")
+        if v == math.floor(v) and abs(v) <= SQL_INT_MAX:
+            return SqlExpr('%d' % v, t, nullable=False, integer=True, constant=v)
+        return SqlExpr("'%r'::float8" % v, t, nullable=False, constant=v)
+    return SqlExpr(sql_string(v), t, nullable=False, constant=v)
+
+def condition(sql):
+    """ A non-null boolean. """
+    return SqlExpr(sql, 'boolean', nullable=False)
+
+
+class Translator(object):
+    def __init__(self, table_name, column_types, constants):
+        self.table_name = table_name
+        self.column_types = column_types
+        self.constants = constants
+
+    def field(self, name):
+        if name in self.constants:
+            return literal(tag_code.from_field(self.constants[name]))
+        elif name not in self.column_types:
+            return literal(UNDEFINED)
+
+        ref = '"%s"."%s"' % (self.table_name, name)
+        udt_name = self.column_types[name]
+        if udt_name in STRING_TYPES:
+            return SqlExpr('btrim(%s, %s)' % (ref, sql_string(PYTHON_WHITESPACE)), 'string')
+        elif udt_name in INTEGER_TYPES:
+            return SqlExpr(ref, 'number', integer=True)
+        elif udt_name in PASSTHROUGH_NUMBER_TYPES:
+            return SqlExpr(ref, 'number', opaque=True)
+        elif udt_name in BOOLEAN_TYPES:
+            return SqlExpr(ref, 'boolean')
+        raise Unsupported("can't use %s column %s" % (udt_name, name))
+
+    # statements: each takes the current value and returns the new one
+
+    def statement(self, node, value):
+        kind = node[0]
+        if kind == 'empty':
+            return value
+        elif kind == 'block':
+            for s in node[1]:
+                value = self.statement(s, value)
+            return value
+        elif kind == 'assign':
+            return self.expression(node[1], value)
+        elif kind == 'if':
+            test = self.condition(node[1], value)
+            then_value = self.statement(node[2], value)
+            else_value = self.statement(node[3], value) if node[3] is not None else value
+            return self.case([(test, then_value)], else_value)
+        elif kind == 'switch':
+            return self.switch(node[1], node[2], value)
+        raise Unsupported("can't translate %s" % kind)
+
+    def switch(self, discriminant_node, clauses, value):
+        bodies = []
+        for test, body in clauses:
+            ends_with_break = bool(body) and body[-1] == ('break',)
+            if ends_with_break:
+                body = body[:-1]
+            if contains_break(body):
+                raise Unsupported("break in the middle of a case")
+            bodies.append((body, ends_with_break))
+
+        def run_from(start):
+            v = value
+            for body, ends_with_break in bodies[start:]:
+                v = self.statement(('block', body), v)
+                if ends_with_break:
+                    break
+            return v
+
+        discriminant = self.expression(discriminant_node, value)
+        whens = []
+        default_value = value
+        for i, (test, body) in enumerate(clauses):
+            if test is None:
+                default_value = run_from(i)
+            else:
+                whens.append((self.equality('===', discriminant, self.expression(test, value)), run_from(i)))
+        return self.case(whens, default_value)
+
+    def case(self, whens, default):
+        """ CASE WHEN cond THEN expr ... ELSE default END, folding constant conditions. """
+        live = []
+        for cond, expr in whens:
+            if cond.is_constant:
+                if cond.constant:
+                    default = expr
+                    break
+            else:
+                live.append((cond, expr))
+        if not live:
+            return default
+
+        exprs = [expr for cond, expr in live] + [default]
+        if len(set([e.sql for e in exprs])) == 1:
+            return default
+        types = set([e.js_type for e in exprs if e.js_type not in ('null', 'undefined')])
+        if len(types) > 1:
+            raise Unsupported("branches give different types")
+        return SqlExpr(
+            'CASE %s ELSE %s END' % (' '.join(['WHEN %s THEN %s' % (c.sql, e.sql) for c, e in live]), default.sql),
+            types.pop() if types else 'null',
+            nullable=any([e.nullable for e in exprs]),
+            integer=all([e.integer for e in exprs if e.js_type == 'number']),
+            opaque=any([e.opaque for e in exprs]),
+            maybe_undefined=any([e.maybe_undefined for e in exprs]),
+        )
+
+    # expressions
+
+    def expression(self, node, value):
+        kind = node[0]
+        if kind == 'literal':
+            return literal(node[1])
+        elif kind == 'value':
+            return value
+        elif kind == 'field':
+            return self.field(node[1])
+        elif kind == 'not':
+            return self.negate(self.condition(node[1], value))
+        elif kind in ('neg', 'pos'):
+            operand = self.expression(node[1], value)
+            if operand.is_constant:
+                n = tag_code.to_number(operand.constant)
+                return literal(-n if kind == 'neg' else n)
+        elif kind == 'binary':
+            return self.binary(node[1], self.expression(node[2], value), self.expression(node[3], value))
+        elif kind in ('and', 'or'):
+            left = self.expression(node[1], value)
+            right = self.expression(node[2], value)
+            test = self.truthy(left)
+            if kind == 'and':
+                return self.case([(test, right)], left)
+            else:
+                return self.case([(test, left)], right)
+        elif kind == 'cond':
+            return self.case([(self.condition(node[1], value), self.expression(node[2], value))], self.expression(node[3], value))
+        raise Unsupported("can't translate %s" % kind)
+
+    def condition(self, node, value):
+        """ Translate node where only its truthiness matters, as a non-null SQL boolean. """
+        kind = node[0]
+        if kind in ('and', 'or'):
+            left = self.condition(node[1], value)
+            right = self.condition(node[2], value)
+            if left.is_constant:
+                if left.constant == (kind == 'and'):
+                    return right
+                return left
+            return condition('(%s %s %s)' % (left.sql, kind.upper(), right.sql))
+        elif kind == 'not':
+            return self.negate(self.condition(node[1], value))
+        return self.truthy(self.expression(node, value))
+
+    def negate(self, cond):
+        if cond.is_constant:
+            return literal(not cond.constant)
+        return condition('(NOT %s)' % cond.sql)
+
+    def truthy(self, e):
+        if e.is_constant:
+            return literal(tag_code.to_boolean(e.constant))
+        elif e.js_type in ('null', 'undefined'):
+            return literal(False)
+        elif e.js_type == 'boolean':
+            return condition('COALESCE(%s, FALSE)' % e.sql) if e.nullable else e
+        elif e.js_type == 'string':
+            return condition("COALESCE(%s <> '', FALSE)" % e.sql)
+        elif e.js_type == 'number' and e.integer and not e.opaque:
+            return condition('COALESCE(%s <> 0, FALSE)' % e.sql)
+        raise Unsupported("can't test %s" % e.js_type)
+
+    def binary(self, op, a, b):
+        if a.is_constant and b.is_constant:
+            return literal(tag_code.BINARY_OPERATORS[op](a.constant, b.constant))
+        elif op in ('==', '!=', '===', '!=='):
+            return self.equality(op, a, b)
+        elif op in ('<', '>', '<=', '>='):
+            return condition('(%s %s %s)' % (self.comparable_number(a), op, self.comparable_number(b)))
+        elif op == '+' and 'string' in (a.js_type, b.js_type):
+            return SqlExpr('(%s || %s)' % (self.text(a), self.text(b)), 'string', nullable=False)
+        raise Unsupported("can't translate %s on %s and %s" % (op, a.js_type, b.js_type))
+
+    def equality(self, op, a, b):
+        strict = op in ('===', '!==')
+        if a.is_constant and b.is_constant:
+            result = literal(tag_code.BINARY_OPERATORS['===' if strict else '=='](a.constant, b.constant))
+        else:
+            if a.is_constant:
+                a, b = b, a
+            result = self.equal(a, b, strict)
+        if op in ('!=', '!=='):
+            return self.negate(result)
+        return result
+
+    def equal(self, a, b, strict):
+        """ a == b (or a === b), where a is not a constant. """
+        if a.opaque or b.opaque:
+            raise Unsupported("can't compare passed-through numbers")
+        if (a.maybe_undefined and a.nullable) or (b.maybe_undefined and b.nullable):
+            if strict:
+                raise Unsupported("can't tell null from undefined")
+
+        if b.js_type in ('null', 'undefined'):
+            # only null and undefined are loosely equal to null or undefined
+            if strict and b.js_type == 'undefined':
+                return literal(False)
+            return condition('(%s IS NULL)' % a.sql) if a.nullable else literal(False)
+
+        if a.js_type == b.js_type:
+            return condition('(%s IS NOT DISTINCT FROM %s)' % (a.sql, b.sql))
+
+        if strict:
+            if a.nullable and b.nullable:
+                return condition('(%s IS NULL AND %s IS NULL)' % (a.sql, b.sql))
+            return literal(False)
+
+        if a.js_type == 'number' and b.js_type == 'string' and b.is_constant:
+            n = tag_code.to_number(b.constant)
+            if math.isnan(n):
+                return literal(False)
+            return condition('(%s IS NOT DISTINCT FROM %s)' % (a.sql, literal(n).sql))
+        raise Unsupported("can't compare %s with %s" % (a.js_type, b.js_type))
+
+    def comparable_number(self, e):
+        """ SQL for ToNumber(e), where that's a plain (non-null) number. """
+        if e.is_constant:
+            n = tag_code.to_number(e.constant)
+            if math.isnan(n):
+                raise Unsupported("NaN comparison")
+            return literal(n).sql
+        elif e.js_type == 'number' and e.integer and not e.opaque and not e.maybe_undefined:
+            return 'COALESCE(%s, 0)' % e.sql if e.nullable else e.sql
+        raise Unsupported("can't compare %s numerically" % e.js_type)
+
+    def text(self, e):
+        """ SQL for ToString(e). """
+        if e.is_constant:
+            return sql_string(tag_code.to_string(e.constant))
+        elif e.maybe_undefined and e.nullable:
+            raise Unsupported("can't tell null from undefined")
+        elif e.js_type == 'null':
+            return "'null'"
+        elif e.js_type == 'string':
+            return "COALESCE(%s, 'null')" % e.sql if e.nullable else e.sql
+        elif e.js_type == 'number' and e.integer and not e.opaque:
+            return "COALESCE((%s)::text, 'null')" % e.sql
+        elif e.js_type == 'boolean':
+            return "(CASE WHEN %s THEN 'true' WHEN NOT %s THEN 'false' ELSE 'null' END)" % (e.sql, e.sql)
+        raise Unsupported("can't convert %s to a string" % e.js_type)
+
+    def translate(self, tree):
+        result = self.statement(tree, literal(None))
+        if result.js_type == 'string':
+            return '(%s)::text' % result.sql
+        elif result.js_type in ('null', 'undefined'):
+            return 'NULL::text'
+        return result.sql
+
+
+def contains_break(statements):
+    for s in statements:
+        if s[0] == 'break':
+            return True
+        elif s[0] == 'block' and contains_break(s[1]):
+            return True
+        elif s[0] == 'if' and contains_break([b for b in s[2:] if b is not None]):
+            return True
+    # breaks inside a nested switch belong to it
+    return False
+
+def translate_tag(code, table_name, column_types, constants):
+    """
+    A SQL expression for the value of tag code, or None if it can't be done
+    exactly. column_types maps the table's column names to their udt_name,
+    and constants holds any other fields that are the same for every row.
+    """
+    try:
+        tree, field_names = tag_code.parse(code)
+        return Translator(table_name, column_types, constants).translate(tree)
+    except Unsupported:
+        return None
+
+def result_value(v):
+    """ Turn a value selected by a translated tag into what evaluating the tag would give. """
+    if isinstance(v, decimal.Decimal):
+        v = float(v)
+    if isinstance(v, float):
+        if math.isnan(v) or math.isinf(v):
+            # JSON has no way to say these, so JS evaluation gives null
+            return None
+        # no negative zero in JSON either
+        v += 0.0
+    elif isinstance(v, (int, long)) and not isinstance(v, bool):
+        v = float(v)
+    elif isinstance(v, str):
+        v = v.decode('utf8')
+    return tag_code.to_result(v)
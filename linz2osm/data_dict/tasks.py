@@ -17,7 +17,9 @@
 from __future__ import absolute_import
 
 from django.conf import settings
-from linz2osm.convert import osm
+from django.db import transaction
+from linz2osm.convert import feature_tags, osm
+from linz2osm.data_dict import tag_memo
 from linz2osm.data_dict.celery import Celery
 from datetime import datetime
 import time
@@ -40,34 +42,35 @@ def deletions_export(dataset):
 
     try:
         layers_in_dataset = dataset.layerindataset_set.all()
-        for lid in layers_in_dataset:
-            nodes = []
-            ways = []
-            relations = []
+        with tag_memo.memoised():
+            for lid in layers_in_dataset:
+                nodes = []
+                ways = []
+                relations = []
 
-            matches = osm.featureset_matches(lid, lid.workslicefeature_set.filter(dirty=1))
-            for (wf, osm_results) in matches:
-                for elem in osm_results['elements']:
-                    if elem['type'] == 'node':
-                        nodes.append(elem)
-                    elif elem['type'] == 'way':
-                        ways.append(elem)
-                    elif elem['type'] == 'relation':
-                        relations.append(elem)
-                    else:
-                        raise osm.Error("Unsupported element type %s" % elem['type'])
+                matches = osm.featureset_matches(lid, lid.workslicefeature_set.filter(dirty=1))
+                for (wf, osm_results) in matches:
+                    for elem in osm_results['elements']:
+                        if elem['type'] == 'node':
+                            nodes.append(elem)
+                        elif elem['type'] == 'way':
+                            ways.append(elem)
+                        elif elem['type'] == 'relation':
+                            relations.append(elem)
+                        else:
+                            raise osm.Error("Unsupported element type %s" % elem['type'])
 
-            data = osm.export_delete(lid, nodes, ways, relations)
-            filename = lid.export_deletes_name()
+                data = osm.export_delete(lid, nodes, ways, relations)
+                filename = lid.export_deletes_name()
 
-            filepath = "%s/%s.osc" % (settings.MEDIA_ROOT, filename)
-            f = open(filepath, 'w')
-            f.write(data)
-            f.close()
+                filepath = "%s/%s.osc" % (settings.MEDIA_ROOT, filename)
+                f = open(filepath, 'w')
+                f.write(data)
+                f.close()
 
-            lid.last_deletions_dump_filename = filename
-            lid.save()
-            print "For %s - generated %s.osc" % (lid.layer_id, filename)
+                lid.last_deletions_dump_filename = filename
+                lid.save()
+                print "For %s - generated %s.osc" % (lid.layer_id, filename)
     except:
         raise
     finally:
@@ -76,3 +79,11 @@ def deletions_export(dataset):
 
     finish_t = time.time()
     print "MISSION COMPLETE - generated %d layers in %f sec" % (len(layers_in_dataset), finish_t - start_t)
+
+@celery.task
+def refresh_feature_tags(layer_in_dataset, tags=None):
+    start_t = time.time()
+    with transaction.commit_on_success(using=layer_in_dataset.dataset.name):
+        stored = feature_tags.refresh(layer_in_dataset, tags)
+    finish_t = time.time()
+    print "Stored %d tag values for %s in %f sec" % (stored, layer_in_dataset, finish_t - start_t)
@@ -14,12 +14,17 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import shutil
+import tempfile
+
 from django.contrib.auth.models import User
 from django.contrib.gis import geos
 from django.db import connections
 from django.test import TestCase
-from linz2osm.convert import osm
+from linz2osm.convert import cell_counts, export_cache, feature_tags, osm, overpass
 from linz2osm.data_dict.models import *
+from linz2osm.data_dict import tag_code, tag_memo, tag_sql
 from linz2osm.workslices.models import *
 
 class WFSUpdateTestCase(TestCase):
@@ -79,6 +84,164 @@ class WFSUpdateTestCase(TestCase):
         self.assertEqual(geom_column, "wkb_geometry")
         self.assertEqual(sorted(data_columns), [u"__change__", u"id", u"name"])
 
+    def test_tags_computed_in_sql(self):
+        layer_in_dataset = LayerInDataset.objects.get(pk=1)
+        tags = layer_in_dataset.get_all_tags()
+        self.assertEqual(tag_sql.translate_tag(Tag.objects.get(pk=1).code, 'sign_pnt', {'id': 'int4', 'name': 'text'}, {}),
+                         "(btrim(\"sign_pnt\".\"name\", %s))::text" % tag_sql.sql_string(tag_sql.PYTHON_WHITESPACE))
+
+        data_table = osm.get_data_table(layer_in_dataset, tags=tags)
+        self.assertEqual(sorted(data_table[0][0]['tag_values'].keys()), [1, 2, 3])
+        self.assertEqual(data_table[1][0]['tag_values'], {1: u'Beaverburg', 2: 2, 3: u'sign'})
+
+        plain_data_table = osm.get_data_table(layer_in_dataset)
+        self.assertFalse('tag_values' in plain_data_table[0][0])
+        self.assertEqual(osm.evaluate_tags(tags, data_table), osm.evaluate_tags(tags, plain_data_table))
+
+    def test_column_pruning(self):
+        layer_in_dataset = LayerInDataset.objects.get(pk=1)
+        name_tag = Tag.objects.get(pk=1)
+        self.assertEqual(osm.get_needed_columns(layer_in_dataset.layer), set(['id']))
+        self.assertEqual(osm.get_needed_columns(layer_in_dataset.layer, tags=[name_tag]), set(['id', 'name']))
+
+        data_table = osm.get_data_table(layer_in_dataset, columns=set(['id']))
+        self.assertEqual(sorted(data_table[0][0].keys()), ['dataset_name', 'dataset_version', 'id', 'layer_name'])
+
+        # a tag computed in SQL doesn't need its columns fetched; one evaluated afterwards does
+        data_table = osm.get_data_table(layer_in_dataset, tags=[name_tag], columns=set(['id']))
+        self.assertFalse('name' in data_table[0][0])
+        with self.settings(LINZ2OSM_TAG_SQL=False):
+            data_table = osm.get_data_table(layer_in_dataset, tags=[name_tag], columns=set(['id']))
+            self.assertEqual(data_table[0][0]['name'], 'Aardvarkville')
+
+    def test_feature_tag_cache(self):
+        layer_in_dataset = LayerInDataset.objects.get(pk=1)
+        tags = layer_in_dataset.get_all_tags()
+        feature_ids = osm.get_layer_feature_ids(layer_in_dataset)
+        with self.settings(LINZ2OSM_FEATURE_TAG_CACHE=True):
+            try:
+                self.assertEqual(feature_tags.load(layer_in_dataset, tags, feature_ids), {})
+                self.assertEqual(feature_tags.refresh(layer_in_dataset), 3 * len(feature_ids))
+
+                stored = feature_tags.load(layer_in_dataset, tags, feature_ids)
+                self.assertEqual(sorted(stored.keys()), [1, 2, 3])
+                self.assertEqual(stored[2][feature_ids[1]], feature_ids[1])
+
+                data_table = osm.get_tagged_data_table(layer_in_dataset, feature_ids, None, tags, osm.get_needed_columns(layer_in_dataset.layer))
+                self.assertEqual(osm.evaluate_tags(tags, data_table), osm.evaluate_tags(tags, osm.get_data_table(layer_in_dataset, feature_ids)))
+
+                # an edited tag's stored values are ignored until it's refreshed
+                name_tag = [t for t in tags if t.pk == 1][0]
+                name_tag.code = 'value = fields.name + "!";'
+                self.assertEqual(sorted(feature_tags.load(layer_in_dataset, tags, feature_ids).keys()), [2, 3])
+                feature_tags.refresh(layer_in_dataset, [name_tag])
+                self.assertEqual(feature_tags.load(layer_in_dataset, tags, feature_ids)[1][feature_ids[0]], u'Aardvarkville!')
+
+                # so is a feature that's gone missing
+                feature_tags.forget_features(layer_in_dataset, feature_ids[:1])
+                self.assertEqual(feature_tags.load(layer_in_dataset, tags, feature_ids), {})
+                self.assertEqual(len(feature_tags.load(layer_in_dataset, tags, feature_ids[1:])), 3)
+            finally:
+                connections['lds_sample'].cursor().execute("DROP TABLE IF EXISTS %s;" % feature_tags.FEATURE_TAGS_TABLE)
+
+    def test_feature_tags_forgotten_while_off(self):
+        layer_in_dataset = LayerInDataset.objects.get(pk=1)
+        tags = layer_in_dataset.get_all_tags()
+        try:
+            with self.settings(LINZ2OSM_FEATURE_TAG_CACHE=True):
+                feature_tags.refresh(layer_in_dataset)
+
+            dataset_update = DatasetUpdate.objects.create(dataset=layer_in_dataset.dataset, from_version="2012-01-01", to_version="2012-07-01", seq=1, owner=User.objects.get(username='root'))
+            osm.apply_changeset_to_dataset(dataset_update, "sign_pnt_update_2012_07_01", layer_in_dataset)
+
+            with self.settings(LINZ2OSM_FEATURE_TAG_CACHE=True):
+                self.assertEqual(len(feature_tags.load(layer_in_dataset, tags, [1, 4])), 3)
+                self.assertEqual(feature_tags.load(layer_in_dataset, tags, [2]), {})
+        finally:
+            connections['lds_sample'].cursor().execute("DROP TABLE IF EXISTS %s;" % feature_tags.FEATURE_TAGS_TABLE)
+
+    def test_export_cache(self):
+        layer_in_dataset = LayerInDataset.objects.get(pk=1)
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(LINZ2OSM_EXPORT_CACHE_DIR=cache_dir):
+                key = export_cache.export_key(layer_in_dataset, [1, 2], 77)
+                self.assertEqual(export_cache.get(key), None)
+                data = osm.export_custom(layer_in_dataset, [1, 2], 77)
+                self.assertEqual(sorted(os.listdir(cache_dir)), [key + '.json', key + '.osc'])
+                self.assertEqual(open(export_cache.path_for(key)).read(), data)
+                self.assertEqual(osm.export_custom(layer_in_dataset, [1, 2], 78), data)
+
+                # the tags are part of the key
+                tag = Tag.objects.get(pk=3)
+                tag.code = "value = 'signpost'"
+                tag.save()
+                self.assertNotEqual(export_cache.export_key(layer_in_dataset, [1, 2], 77), key)
+                self.assertTrue('signpost' in osm.export_custom(layer_in_dataset, [1, 2], 77))
+
+                export_cache.evict(0)
+                self.assertEqual(os.listdir(cache_dir), [])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_feature_extents(self):
+        layer_in_dataset = LayerInDataset.objects.get(pk=1)
+        extents = osm.get_feature_extents(layer_in_dataset, [2, 4, 6])
+        self.assertEqual(extents, {2: (169.0, -41.0, 169.0, -41.0), 4: (168.0, -42.0, 168.0, -42.0), 6: (170.0, -42.0, 170.0, -42.0)})
+        self.assertEqual(osm.get_feature_extents(layer_in_dataset, []), {})
+
+        wfs = [WorksliceFeature(layer_in_dataset=layer_in_dataset, feature_id=fid) for fid in [6, 2]]
+        self.assertEqual(overpass.feature_extents(wfs), [wf.wgs_bounds().extent for wf in wfs])
+
+    def test_allocate_workslice_features(self):
+        layer_in_dataset = LayerInDataset.objects.get(pk=1)
+        WorksliceFeature.objects.filter(feature_id=3).update(dirty=1)
+        self.assertEqual(WorksliceFeature.objects.unallocated_feature_ids(layer_in_dataset, [1, 2, 3, 4, 5, 6]), [3, 4, 5, 6])
+        self.assertEqual(WorksliceFeature.objects.unallocated_feature_ids(layer_in_dataset, []), [])
+
+        workslice = Workslice.objects.get(pk=77)
+        workslice.pk = None
+        workslice.save()
+        extent = geos.Polygon.from_bbox((167.0, -45.0, 175.0, -40.0))
+        extent.srid = 4326
+        WorksliceFeature.objects.allocate_workslice_features(workslice, extent, AllFilter(layer_in_dataset))
+        self.assertEqual(workslice.feature_count, 4)
+        self.assertEqual(sorted(workslice.workslicefeature_set.values_list('feature_id', flat=True)), [3, 4, 5, 6])
+
+        # the cached bitmap predates the allocation until it's forgotten
+        self.assertEqual(list(WorksliceFeature.objects.allocated_features(layer_in_dataset)), [1, 2])
+        WorksliceFeature.objects.forget_allocated_features(layer_in_dataset)
+        self.assertEqual(list(WorksliceFeature.objects.allocated_features(layer_in_dataset)), [1, 2, 3, 4, 5, 6])
+
+        self.assertRaises(WorksliceInsufficientlyFeaturefulError, WorksliceFeature.objects.allocate_workslice_features, workslice, extent, AllFilter(layer_in_dataset))
+
+    def test_cell_counts(self):
+        layer_in_dataset = LayerInDataset.objects.get(pk=1)
+        cells = lambda *names: [Cell(name) for name in names]
+        with self.settings(LINZ2OSM_CELL_COUNTS=True, LINZ2OSM_CELL_COUNT_RESOLUTIONS=(1, 4)):
+            try:
+                self.assertEqual(cell_counts.count(layer_in_dataset, cells('X168Y-41C1')), None)
+                self.assertEqual(cell_counts.refresh(layer_in_dataset), 12)
+
+                # features 1-3 are checked out
+                self.assertEqual(cell_counts.count(layer_in_dataset, cells('X168Y-41C1')), (1, 1))
+                self.assertEqual(cell_counts.count(layer_in_dataset, cells('X168Y-42C1', 'X169Y-42C1')), (2, 0))
+                self.assertEqual(cell_counts.count(layer_in_dataset, cells('X672Y-164C4')), (1, 1))
+                # counted from the 4 cells per degree resolution
+                self.assertEqual(cell_counts.count(layer_in_dataset, cells('X336Y-82C2')), (1, 1))
+                self.assertEqual(cell_counts.count(layer_in_dataset, cells('X337Y-82C2')), (0, 0))
+
+                # too small, or mixed sizes
+                self.assertEqual(cell_counts.count(layer_in_dataset, cells('X1344Y-328C8')), None)
+                self.assertEqual(cell_counts.count(layer_in_dataset, cells('X168Y-41C1', 'X672Y-168C4')), None)
+
+                cell_counts.adjust_allocated(layer_in_dataset, [4], 1)
+                cell_counts.adjust_allocated(layer_in_dataset, [1], -1)
+                self.assertEqual(cell_counts.count(layer_in_dataset, cells('X168Y-42C1', 'X168Y-41C1')), (2, 1))
+            finally:
+                connections['lds_sample'].cursor().execute("DROP TABLE IF EXISTS %s;" % cell_counts.CELL_COUNTS_TABLE)
+                cell_counts.tables_seen.clear()
+
     def test_application_of_changeset(self):
         c = connections['lds_sample'].cursor()
 
@@ -178,3 +341,181 @@ class TagFetchingTestCase(TestCase):
         nzopengps_road_tags = self.nzopengps_road_in_mainland.get_all_tags()
         self.assertEqual(len(nzopengps_road_tags), 4)
         self.assertItemsEqual([t.id for t in nzopengps_road_tags], [5, 6, 7, 11])
+
+class TagCompilerTestCase(TestCase):
+    SAMPLE_ROWS = [
+        {'name': u'Mount Eden', 'road_surface': 'sealed', 'lanes': 2, 'height': 196.5, 'id': 1},
+        {'name': None, 'road_surface': 'metalled', 'lanes': 0, 'height': 0.1, 'id': 2000000000},
+        {'name': u'', 'road_surface': 'unmetalled', 'lanes': '3', 'height': -12, 'id': 3},
+        {'name': u'Te Ika-a-M\u0101ui', 'road_surface': None, 'lanes': None, 'height': 1e-7},
+    ]
+
+    SUPPORTED_CODE = [
+        "value = fields.name",
+        "value = 'yes';",
+        'value = "V16"',
+        "if (fields.name) {\n  value = 'named';\n} else value = fields.id",
+        "if (fields.lanes > 0 && fields.lanes != 2) { value = fields.lanes + ' lanes' }",
+        "switch (fields.road_surface) {\n  case \"sealed\":\n    value = 'paved'; break;\n  case \"metalled\":\n    value = 'gravel';\n  default:\n    value = value + '?';\n}",
+        "value = fields['height'] * 2 + '|' + fields.height / 3 + '|' + (fields.lanes === '3')",
+        "value = fields.name == null ? 'unnamed' : fields.name + ' ' + fields.id",
+        "// comment\nvalue = fields.lanes >= fields.height\nvalue = !value",
+    ]
+
+    UNSUPPORTED_CODE = [
+        "value = fields.name.toUpperCase();",
+        "var x = fields.name; value = x;",
+        "value = fields.constructor",
+        "for (var i = 0; i < 3; i++) { value = i; }",
+        "value = 1 break",
+        "break;",
+        "value = fields[fields.name]",
+    ]
+
+    def test_compiles_simple_code(self):
+        for code in self.SUPPORTED_CODE:
+            self.assertNotEqual(tag_code.compile_tag(code), None, code)
+
+    def test_falls_back_for_other_code(self):
+        for code in self.UNSUPPORTED_CODE:
+            self.assertEqual(tag_code.compile_tag(code), None, code)
+            self.assertRaises(tag_code.Unsupported, Tag.objects.eval_many, code, self.SAMPLE_ROWS, backend='python')
+
+    def test_compiled_values(self):
+        self.assertEqual(Tag.objects.eval_many("value = fields.name", self.SAMPLE_ROWS, backend='python'), [u'Mount Eden', None, u'', u'Te Ika-a-M\u0101ui'])
+        self.assertEqual(Tag.objects.eval_many("value = fields.id", self.SAMPLE_ROWS, backend='python'), [1, 2000000000.0, 3, None])
+        self.assertEqual(Tag.objects.eval_many("value = fields.height + ''", self.SAMPLE_ROWS, backend='python'), [u'196.5', u'0.1', u'-12', u'1e-7'])
+        self.assertEqual(Tag.objects.eval_many(self.SUPPORTED_CODE[5], self.SAMPLE_ROWS, backend='python'), [u'paved', u'gravel?', u'null?', u'null?'])
+
+    def test_number_to_string(self):
+        for n, s in [(0.0, '0'), (-0.0, '0'), (1.0, '1'), (-1.5, '-1.5'), (1e21, '1e+21'), (1e20, '100000000000000000000'),
+                     (0.000001, '0.000001'), (1.5e-7, '1.5e-7'), (0.1 + 0.2, '0.30000000000000004'), (float('nan'), 'NaN')]:
+            self.assertEqual(tag_code.number_to_string(n), s)
+
+    def test_matches_js(self):
+        for code in self.SUPPORTED_CODE:
+            self.assertEqual(Tag.objects.compare_backends(code, self.SAMPLE_ROWS), [], code)
+
+    def test_falls_back_per_row(self):
+        rows = [{'id': 1}, {'id': 2 ** 60}, {'id': 3}]
+        js_rows = []
+        eval_many_js = Tag.objects.eval_many_js
+        def recording_eval_many_js(code, eval_rows):
+            js_rows.extend(eval_rows)
+            return eval_many_js(code, eval_rows)
+        Tag.objects.eval_many_js = recording_eval_many_js
+        try:
+            values = Tag.objects.eval_many("value = fields.id", rows)
+        finally:
+            del Tag.objects.eval_many_js
+        # only the row the compiled code can't hold exactly goes to the JS engine
+        self.assertEqual(js_rows, [rows[1]])
+        self.assertEqual(values, [1, float(2 ** 60), 3])
+        self.assertRaises(tag_code.Unsupported, Tag.objects.eval_many, "value = fields.id", rows, backend='python')
+
+    def assert_batch_matches_single(self, code, rows):
+        values = [Tag.objects.eval(code, fields, backend='js') for fields in rows]
+        self.assertEqual(Tag.objects.eval_many_js(code, rows), values, code)
+        return values
+
+    def test_non_finite_fields(self):
+        rows = [{'height': float('nan')}, {'height': float('inf')}, {'height': float('-inf')}, {'height': 1.5}]
+        code = "value = isNaN(fields.height) ? 'nan' : fields.height + ''"
+        self.assertEqual(self.assert_batch_matches_single(code, rows), [u'nan', u'Infinity', u'-Infinity', u'1.5'])
+
+    def test_batch_rows_kept_apart(self):
+        rows = [{'name': u'A'}, {'name': None}]
+        # a global one row leaves behind isn't there for the next
+        code = "if (fields.name) { x = fields.name; } value = typeof x == 'undefined' ? 'none' : x;"
+        self.assertEqual(self.assert_batch_matches_single(code, rows), [u'A', u'none'])
+        # and the loop's own variables are out of reach
+        self.assertEqual(self.assert_batch_matches_single("__input = null; __values = 1; value = fields.name", rows), [u'A', None])
+        for code in ["return 1;", "x = undefined_name + 1;"]:
+            self.assertRaises(Tag.ScriptError, Tag.objects.eval, code, rows[0], backend='js')
+            self.assertRaises(Tag.ScriptError, Tag.objects.eval_many_js, code, rows)
+
+class TagSQLTestCase(TestCase):
+    COLUMN_TYPES = {'name': 'varchar', 'lanes': 'int4', 'height': 'float8', 'surface': 'text', 'sealed': 'bool'}
+    CONSTANTS = {'layer_name': 'road_cl', 'dataset_name': 'mainland', 'dataset_version': '2012-07-01'}
+
+    def translate(self, code):
+        return tag_sql.translate_tag(code, 'road_cl', self.COLUMN_TYPES, self.CONSTANTS)
+
+    def test_translates_simple_code(self):
+        self.assertEqual(self.translate("value = fields.lanes"), '"road_cl"."lanes"')
+        self.assertEqual(self.translate("value = 'road'"), "(E'road')::text")
+        self.assertEqual(self.translate("value = fields.dataset_name + ':' + fields.missing"), "(E'mainland:undefined')::text")
+        self.assertEqual(self.translate("value = fields.lanes == '2'"), '("road_cl"."lanes" IS NOT DISTINCT FROM 2)')
+        self.assertEqual(self.translate("if (fields.lanes > 1) value = 'yes'"),
+                         "(CASE WHEN (COALESCE(\"road_cl\".\"lanes\", 0) > 1) THEN E'yes' ELSE NULL END)::text")
+        self.assertEqual(self.translate("value = fields.sealed ? 'paved' : 'unpaved'"),
+                         "(CASE WHEN COALESCE(\"road_cl\".\"sealed\", FALSE) THEN E'paved' ELSE E'unpaved' END)::text")
+
+    def test_switch(self):
+        sql = self.translate("switch (fields.lanes) {\n  case 1:\n  case 2:\n    value = 'narrow'; break;\n  default:\n    value = 'wide';\n}")
+        self.assertEqual(sql, "(CASE WHEN (\"road_cl\".\"lanes\" IS NOT DISTINCT FROM 1) THEN E'narrow' WHEN (\"road_cl\".\"lanes\" IS NOT DISTINCT FROM 2) THEN E'narrow' ELSE E'wide' END)::text")
+        self.assertEqual(self.translate("switch (fields.lanes) { case 1: if (fields.name) break; value = 'x' }"), None)
+
+    def test_leaves_the_rest_to_evaluate_tags(self):
+        for code in [
+                "value = fields.name.toUpperCase()",
+                "value = fields.height > 2",
+                "value = fields.height + ' m'",
+                "value = fields.surface > 'a'",
+                "value = fields.name || fields.lanes",
+                "value = fields.surface == 1",
+                ]:
+            self.assertEqual(self.translate(code), None, code)
+
+class TagMemoTestCase(TestCase):
+    CAP_FIRST = """function capFirst(s) {
+  s = s.toLowerCase();
+  return s.substr(0,1).toUpperCase() + s.substr(1);
+}
+
+if (fields.name === null) {
+  value = null;
+} else {
+  var words = fields['name'].split(" ");
+  value = words.map(capFirst).join(" ") + ' ' + fields.dataset_name;
+}"""
+
+    def test_field_dependencies(self):
+        self.assertEqual(tag_code.field_dependencies("value = 'sign'"), frozenset())
+        self.assertEqual(tag_code.field_dependencies("value = fields.name; // fields.ignored"), frozenset(['name']))
+        self.assertEqual(tag_code.field_dependencies(self.CAP_FIRST), frozenset(['name', 'dataset_name']))
+        self.assertEqual(tag_code.field_dependencies("value = 'fields.x' + other.fields"), frozenset())
+        self.assertEqual(tag_code.field_dependencies("for (var k in fields) { value = k; }"), None)
+        self.assertEqual(tag_code.field_dependencies("value = fields[fields.key]"), None)
+        self.assertEqual(tag_code.field_dependencies("value = fields.name.replace(/ +/g, ' ')"), None)
+
+    def test_impure_code_is_not_memoised(self):
+        self.assertEqual(tag_code.memo_fields("value = fields.name"), frozenset(['name']))
+        self.assertEqual(tag_code.memo_fields("value = new Date().getFullYear()"), None)
+        self.assertEqual(tag_code.memo_fields("value = Math.random() > 0.5 ? fields.a : fields.b"), None)
+
+    def test_memo_evaluates_each_key_once(self):
+        evaluated = []
+        def evaluate(rows):
+            evaluated.extend(rows)
+            return [(r.get('surface') or '').upper() for r in rows]
+
+        memo = tag_memo.TagMemo()
+        code = "value = fields.surface.toUpperCase()"
+        rows = [{'surface': 'sealed', 'id': 1}, {'surface': 'metalled', 'id': 2}, {'surface': 'sealed', 'id': 3}, {'id': 4}]
+        self.assertEqual(memo.eval_many(code, rows, evaluate), ['SEALED', 'METALLED', 'SEALED', ''])
+        self.assertEqual(len(evaluated), 3)
+
+        self.assertEqual(memo.eval_many(code, [{'surface': 'metalled', 'id': 5}], evaluate), ['METALLED'])
+        self.assertEqual(len(evaluated), 3)
+        self.assertEqual(memo.eval_many(code, [{'surface': None, 'id': 6}], evaluate), [''])
+        self.assertEqual(len(evaluated), 4)
+        self.assertEqual((memo.hits, memo.misses), (2, 4))
+
+    def test_memoised_blocks_nest(self):
+        self.assertEqual(tag_memo.current(), None)
+        with tag_memo.memoised() as outer:
+            with tag_memo.memoised() as inner:
+                self.assertTrue(inner is outer)
+            self.assertTrue(tag_memo.current() is outer)
+        self.assertEqual(tag_memo.current(), None)
@@ -132,10 +132,79 @@ INSTALLED_APPS = (
 
 COMMENTS_APP = 'linz2osm.linz2osm_comments'
 
-CACHE_BACKEND = 'db://django_cache'
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
+    },
+    # Overpass responses: TIMEOUT is how long one is trusted for, and
+    # MAX_ENTRIES how many are kept
+    'overpass': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'overpass_cache',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
 BROKER_URL = 'amqp://guest@localhost//'
 LINZ_DATA_SERVICE_API_KEY = 'ENTER API KEY'
 
+# Run simple tag code as Python rather than through the JS engine.
+# Check both give the same results with ./manage.py check_tag_compiler
+LINZ2OSM_TAG_COMPILER = True
+# Compute tags that translate to SQL in the export query itself
+LINZ2OSM_TAG_SQL = True
+# Keep evaluated tags per feature in each dataset database, so exports reuse
+# them. Fill it with ./manage.py refresh_feature_tags
+LINZ2OSM_FEATURE_TAG_CACHE = False
+# Count features per selector grid cell in each dataset database, so
+# selection counts are a sum over cells. Fill it with
+# ./manage.py refresh_cell_counts
+LINZ2OSM_CELL_COUNTS = False
+# Cells per degree the counts are kept at; a selection is counted from the
+# coarsest resolution that fits exactly into its cells
+LINZ2OSM_CELL_COUNT_RESOLUTIONS = (1, 4, 16, 64, 256)
+# Export big workslices and previews with this many processes
+LINZ2OSM_EXPORT_PROCESSES = 1
+# Decimal places for node coordinates in .osc files, unless a layer says
+# otherwise. OSM stores 7; None writes them in full
+LINZ2OSM_COORDINATE_PRECISION = 7
+# Compressed copies of each workslice export to write ('gz', 'bz2'), and
+# whether to keep the uncompressed .osc as well
+LINZ2OSM_EXPORT_COMPRESSION = ('gz',)
+LINZ2OSM_EXPORT_RAW = True
+# Let the web server send export downloads: None, 'x-sendfile', or
+# 'x-accel-redirect' (nginx; LINZ2OSM_SENDFILE_URL is the internal location
+# for MEDIA_ROOT)
+LINZ2OSM_SENDFILE = None
+LINZ2OSM_SENDFILE_URL = '/protected-media/'
+# Directory to keep generated exports in, so the same export again is a
+# copy (None turns it off), and how many bytes it may hold
+LINZ2OSM_EXPORT_CACHE_DIR = None
+LINZ2OSM_EXPORT_CACHE_SIZE = 1024 ** 3
+# How many features' conflict and match searches to send to Overpass in one
+# union query (1 sends a query per feature)
+LINZ2OSM_OVERPASS_BATCH_SIZE = 50
+# How many Overpass queries may run at once on an endpoint (unless its
+# admin entry says otherwise), how many may start a second
+# (None for no limit), how long to wait for one, and how often to retry
+# one that times out or is turned away, backing off from
+# LINZ2OSM_OVERPASS_BACKOFF seconds
+LINZ2OSM_OVERPASS_CONCURRENCY = 2
+LINZ2OSM_OVERPASS_RATE = None
+LINZ2OSM_OVERPASS_TIMEOUT = 300
+LINZ2OSM_OVERPASS_RETRIES = 3
+LINZ2OSM_OVERPASS_BACKOFF = 5
+# The cache (from CACHES) to keep Overpass responses in, or None, and the
+# biggest response (in bytes) to keep there (None for no limit)
+LINZ2OSM_OVERPASS_CACHE = 'overpass'
+LINZ2OSM_OVERPASS_CACHE_MAX_SIZE = 1024 * 1024
+# Answer conflict and match queries from an OSM extract snapshot rather than
+# Overpass. Make one with ./manage.py load_osm_extract
+LINZ2OSM_OSM_EXTRACT = None
+
 LOGIN_URL = '/login/'
 
 # Override anything here with a settings_site.py file
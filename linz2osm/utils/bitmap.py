@@ -0,0 +1,115 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from bisect import bisect_left
+
+# Ids are split into chunks of 2**CHUNK_BITS on their high bits. A chunk
+# holds its low bits as a sorted array of shorts until it has more than
+# ARRAY_MAX of them (8KB either way), then as a bitmap.
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+ARRAY_MAX = 4096
+BITMAP_BYTES = (1 << CHUNK_BITS) / 8
+
+
+def _to_bitmap(lows):
+    chunk = bytearray(BITMAP_BYTES)
+    for low in lows:
+        chunk[low >> 3] |= 1 << (low & 7)
+    return chunk
+
+def _bitmap_lows(chunk):
+    for byte, bits in enumerate(chunk):
+        if bits:
+            for bit in xrange(8):
+                if bits & (1 << bit):
+                    yield (byte << 3) | bit
+
+
+class FeatureBitmap(object):
+    """ A compact set of non-negative integer ids, in the manner of a roaring bitmap. """
+
+    def __init__(self, ids=()):
+        self._chunks = {}
+        # sizes of the chunks held as bitmaps
+        self._sizes = {}
+        self.update(ids)
+
+    def __len__(self):
+        return sum(self._sizes[key] if key in self._sizes else len(chunk) for (key, chunk) in self._chunks.iteritems())
+
+    def __contains__(self, i):
+        chunk = self._chunks.get(i >> CHUNK_BITS)
+        if chunk is None:
+            return False
+        low = i & CHUNK_MASK
+        if isinstance(chunk, bytearray):
+            return bool(chunk[low >> 3] & (1 << (low & 7)))
+        pos = bisect_left(chunk, low)
+        return pos < len(chunk) and chunk[pos] == low
+
+    def __iter__(self):
+        for key in sorted(self._chunks):
+            chunk = self._chunks[key]
+            lows = _bitmap_lows(chunk) if isinstance(chunk, bytearray) else chunk
+            for low in lows:
+                yield (key << CHUNK_BITS) | low
+
+    def add(self, i):
+        key, low = i >> CHUNK_BITS, i & CHUNK_MASK
+        chunk = self._chunks.get(key)
+        if chunk is None:
+            self._chunks[key] = array('H', [low])
+        elif isinstance(chunk, bytearray):
+            if not chunk[low >> 3] & (1 << (low & 7)):
+                chunk[low >> 3] |= 1 << (low & 7)
+                self._sizes[key] += 1
+        else:
+            pos = bisect_left(chunk, low)
+            if pos < len(chunk) and chunk[pos] == low:
+                return
+            chunk.insert(pos, low)
+            if len(chunk) > ARRAY_MAX:
+                self._chunks[key] = _to_bitmap(chunk)
+                self._sizes[key] = len(chunk)
+
+    def discard(self, i):
+        key, low = i >> CHUNK_BITS, i & CHUNK_MASK
+        chunk = self._chunks.get(key)
+        if chunk is None:
+            return
+        if isinstance(chunk, bytearray):
+            if chunk[low >> 3] & (1 << (low & 7)):
+                chunk[low >> 3] &= ~(1 << (low & 7)) & 0xff
+                self._sizes[key] -= 1
+                if self._sizes[key] <= ARRAY_MAX:
+                    self._chunks[key] = array('H', _bitmap_lows(chunk))
+                    del self._sizes[key]
+        else:
+            pos = bisect_left(chunk, low)
+            if pos < len(chunk) and chunk[pos] == low:
+                del chunk[pos]
+                if not chunk:
+                    del self._chunks[key]
+
+    def update(self, ids):
+        for i in ids:
+            self.add(i)
+
+    def difference_update(self, ids):
+        for i in ids:
+            self.discard(i)
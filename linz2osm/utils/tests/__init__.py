@@ -0,0 +1 @@
+from bitmap import *
@@ -0,0 +1,46 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from django.test import TestCase
+
+from linz2osm.utils.bitmap import FeatureBitmap
+
+class FeatureBitmapTestCase(TestCase):
+    def test_sparse_and_dense_chunks(self):
+        ids = set(range(0, 200000, 7)) | set(range(70000, 80000))
+        bitmap = FeatureBitmap(ids)
+        self.assertEqual(len(bitmap), len(ids))
+        self.assertEqual(list(bitmap), sorted(ids))
+        self.assertTrue(70001 in bitmap)
+        self.assertFalse(1 in bitmap)
+
+        bitmap.difference_update(range(70000, 80000))
+        ids -= set(range(70000, 80000))
+        self.assertEqual(len(bitmap), len(ids))
+        self.assertEqual(list(bitmap), sorted(ids))
+        self.assertFalse(70001 in bitmap)
+
+    def test_add_and_discard(self):
+        bitmap = FeatureBitmap()
+        bitmap.add(5)
+        bitmap.add(5)
+        bitmap.add(1 << 20)
+        self.assertEqual(list(bitmap), [5, 1 << 20])
+        bitmap.discard(5)
+        bitmap.discard(6)
+        self.assertEqual(list(bitmap), [1 << 20])
+        self.assertEqual(len(bitmap), 1)
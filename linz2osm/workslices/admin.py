@@ -22,7 +22,7 @@ from linz2osm.workslices.models import Workslice
 class WorksliceAdmin(admin.ModelAdmin):
     list_display = ('name', 'state', 'checked_out_at', 'layer', 'user', 'dataset',)
     ordering = ('id',)
-    readonly_fields = ('name', 'checked_out_at', 'status_changed_at', 'layer_in_dataset','checkout_extent','feature_count', 'file_size',)
+    readonly_fields = ('name', 'checked_out_at', 'status_changed_at', 'layer_in_dataset','checkout_extent','feature_count', 'file_size', 'compressed_file_size', 'bytes_saved',)
     save_on_top = True
 
     def layer(self, obj):
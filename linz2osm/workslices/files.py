@@ -0,0 +1,142 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import bz2
+import gzip
+import os
+import re
+
+from django.conf import settings
+
+def open_gzip(path, name):
+    # so the header has the real file name rather than the partial one
+    return gzip.GzipFile(filename=name, mode='wb', fileobj=open(path, 'wb'))
+
+def open_bz2(path, name):
+    return bz2.BZ2File(path, 'w')
+
+# suffix -> opener for each compressed copy of an export we can write
+COMPRESSIONS = {
+    'gz': open_gzip,
+    'bz2': open_bz2,
+}
+CONTENT_ENCODINGS = {
+    'gz': 'gzip',
+}
+CONTENT_TYPES = {
+    'gz': 'application/x-gzip',
+    'bz2': 'application/x-bzip2',
+}
+
+def export_path(name, compression=None):
+    path = "%s/%s.osc" % (settings.MEDIA_ROOT, name)
+    if compression:
+        path += "." + compression
+    return path
+
+class ExportFiles(object):
+    """
+    A stream that writes an export to its .osc file and to the compressed
+    copies in LINZ2OSM_EXPORT_COMPRESSION at once. They are written under
+    other names, and only replace the previous export on commit().
+    """
+    def __init__(self, name):
+        self.name = name
+        self.compressions = list(getattr(settings, 'LINZ2OSM_EXPORT_COMPRESSION', ()))
+        self.raw = getattr(settings, 'LINZ2OSM_EXPORT_RAW', True) or not self.compressions
+        self.size = 0
+        self.files = []
+        if self.raw:
+            self.files.append((None, open(self.partial_path(None), 'wb')))
+        for compression in self.compressions:
+            f = COMPRESSIONS[compression](self.partial_path(compression), os.path.basename(export_path(name)))
+            self.files.append((compression, f))
+
+    def partial_path(self, compression):
+        return export_path(self.name, compression) + ".partial"
+
+    def write(self, data):
+        self.size += len(data)
+        for compression, f in self.files:
+            f.write(data)
+
+    def close(self):
+        for compression, f in self.files:
+            # GzipFile leaves a file it was given open
+            fileobj = getattr(f, 'fileobj', None)
+            f.close()
+            if fileobj is not None:
+                fileobj.close()
+
+    def commit(self):
+        """ Moves the finished files into place, removing any we no longer write. """
+        written = [compression for (compression, f) in self.files]
+        for compression in [None] + sorted(COMPRESSIONS.keys()):
+            path = export_path(self.name, compression)
+            if compression in written:
+                os.rename(self.partial_path(compression), path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def discard(self):
+        for compression, f in self.files:
+            if os.path.exists(self.partial_path(compression)):
+                os.remove(self.partial_path(compression))
+
+    def compressed_size(self, compression):
+        return os.path.getsize(export_path(self.name, compression))
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+class UnsatisfiableRange(Exception):
+    pass
+
+def parse_range(header, size):
+    """
+    Returns (first, last) byte positions for a single-range Range header, or
+    None to send the whole file (no header, or one we don't handle).
+    """
+    if not header:
+        return None
+    m = RANGE_RE.match(header.strip())
+    if not m or m.group(1) == m.group(2) == '':
+        return None
+    if m.group(1) == '':
+        # the last n bytes
+        length = int(m.group(2))
+        if length == 0:
+            raise UnsatisfiableRange()
+        return (max(size - length, 0), size - 1)
+    first = int(m.group(1))
+    last = int(m.group(2)) if m.group(2) else size - 1
+    if last < first:
+        return None
+    if first >= size:
+        raise UnsatisfiableRange()
+    return (first, min(last, size - 1))
+
+def file_chunks(f, first, length, chunk_size=65536):
+    try:
+        f.seek(first)
+        while length > 0:
+            data = f.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
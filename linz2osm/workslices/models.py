@@ -28,11 +28,13 @@ from django.conf import settings
 from django.utils import text
 from django.contrib import auth
 from django.contrib.gis import geos
+from django.core.cache import cache
 from django.contrib.gis.db import models
 
 from linz2osm.data_dict.models import Layer, Dataset, LayerInDataset
 from linz2osm.workslices import tasks
-from linz2osm.convert import osm, overpass
+from linz2osm.convert import cell_counts, osm, overpass
+from linz2osm.utils.bitmap import FeatureBitmap
 
 CELL_RE = re.compile(r'\AX(?P<x>[0-9-]+)Y(?P<y>[0-9-]+)C(?P<cpd>[0-9]+)\Z')
 
@@ -119,6 +121,9 @@ class WorksliceManager(models.GeoManager):
         except WorksliceInsufficientlyFeaturefulError, e:
             raise e
         else:
+            feature_ids = list(workslice.workslicefeature_set.values_list('feature_id', flat=True))
+            WorksliceFeature.objects.forget_allocated_features(layer_in_dataset)
+            cell_counts.adjust_allocated(layer_in_dataset, feature_ids, 1)
             tasks.osm_export.delay(workslice)
             return workslice
 
@@ -151,6 +156,8 @@ class Workslice(models.Model):
     checkout_extent = models.MultiPolygonField()
     feature_count = models.IntegerField(null=True)
     file_size = models.IntegerField(null=True)
+    compressed_file_size = models.IntegerField(null=True)
+    bytes_saved = models.IntegerField(null=True)
     # FIXME: store file name so changes won't mess it up
 
     @property
@@ -200,6 +207,11 @@ class Workslice(models.Model):
     objects = WorksliceManager()
 
 
+# Cache key for each LayerInDataset's FeatureBitmap of allocated feature ids.
+# An entry is only ever added, never updated, so it lives for the cache's
+# TIMEOUT from when it was built; changes to allocation delete it
+ALLOCATION_CACHE_KEY = 'allocated-features:%d'
+
 class WorksliceTooFeaturefulError(Exception):
     pass
 
@@ -207,6 +219,40 @@ class WorksliceInsufficientlyFeaturefulError(Exception):
     pass
 
 class WorksliceFeatureManager(models.Manager):
+    def allocated_features(self, layer_in_dataset):
+        """
+        FeatureBitmap of the layer's feature ids held clean by workslices,
+        kept in the default cache. It may lag other processes, so use it for
+        display only; unallocated_feature_ids is the one to trust.
+        """
+        key = ALLOCATION_CACHE_KEY % layer_in_dataset.pk
+        allocated = cache.get(key)
+        if allocated is None:
+            allocated = FeatureBitmap(self.filter(layer_in_dataset=layer_in_dataset, dirty=0).values_list('feature_id', flat=True))
+            cache.add(key, allocated)
+        return allocated
+
+    def forget_allocated_features(self, layer_in_dataset):
+        """ Call once changes to the layer's allocation are committed. """
+        cache.delete(ALLOCATION_CACHE_KEY % layer_in_dataset.pk)
+
+    def unallocated_feature_ids(self, layer_in_dataset, feature_ids):
+        """ Those of feature_ids not held clean by any workslice, as one anti-join against the given ids. """
+        cursor = connections[self.db].cursor()
+        cursor.execute("""
+            SELECT fid
+            FROM unnest(%s::integer[]) AS fid
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM workslices_workslicefeature wf
+                WHERE wf.layer_in_dataset_id = %s
+                AND wf.feature_id = fid
+                AND wf.dirty = 0
+            )
+            ORDER BY fid
+            """, [list(feature_ids), layer_in_dataset.pk])
+        return [r[0] for r in cursor.fetchall()]
+
     def allocate_workslice_features(self, workslice, extent, feature_filter):
         layer_in_dataset = workslice.layer_in_dataset
         covered_fids = osm.get_layer_feature_ids(layer_in_dataset, extent)
@@ -221,12 +267,7 @@ class WorksliceFeatureManager(models.Manager):
                 layer_in_dataset=layer_in_dataset,
                 feature_id=fid
                 ) for fid
-            in covered_fids
-            if not self.filter(
-                layer_in_dataset=layer_in_dataset,
-                feature_id=fid,
-                dirty=0
-                ).exists()
+            in self.unallocated_feature_ids(layer_in_dataset, covered_fids)
             ]
         if len(ws_feats) > layer_in_dataset.layer.feature_limit:
             raise WorksliceTooFeaturefulError
@@ -251,6 +292,11 @@ class WorksliceFeature(models.Model):
             (2, 'updated',),
             ))
 
+    class Meta:
+        index_together = [
+            ('layer_in_dataset', 'feature_id', 'dirty'),
+        ]
+
     def wgs_geom(self, expression = "ST_Transform(%s, 4326)"):
         cursor = connections[self.layer_in_dataset.dataset.name].cursor()
         layer = self.layer_in_dataset.layer
@@ -284,10 +330,19 @@ class WorksliceFeature(models.Model):
             }
         } """ % geom.geojson
 
-    def osm_individual_conflict_query_ql(self, query_data):
-        return self.osm_conflicts_query_ql(query_data, INDIV_CONFLICT_PROXIMITY)
+    def osm_conflicts_bounds(self, proximity = overpass.OVERPASS_PROXIMITY, extent = None):
+        """ The bbox to search OSM in, from extent if we've fetched it already (see overpass.feature_extents). """
+        if extent is None:
+            extent = self.wgs_bounds().extent
+        return overpass.bounds_for(extent, proximity)
+
+    def osm_individual_conflict_bounds(self, extent = None):
+        return self.osm_conflicts_bounds(INDIV_CONFLICT_PROXIMITY, extent)
+
+    def osm_individual_conflict_query_ql(self, query_data, bounds = None):
+        return self.osm_conflicts_query_ql(query_data, INDIV_CONFLICT_PROXIMITY, bounds)
 
-    def osm_conflicts_query_ql(self, tags_ql, proximity = overpass.OVERPASS_PROXIMITY):
+    def osm_conflicts_query_ql(self, tags_ql, proximity = overpass.OVERPASS_PROXIMITY, bounds = None, recurse = True):
         geotype = self.layer_in_dataset.layer.geometry_type
         if geotype == "POINT":
             query = dedent("""
@@ -301,7 +356,7 @@ class WorksliceFeature(models.Model):
                 way
                 %(tags)s
                 %(bounds)s;
-                >;
+                %(recurse)s
                 );""")
         elif geotype == "POLYGON":
             query = dedent("""
@@ -313,7 +368,7 @@ class WorksliceFeature(models.Model):
                 way
                 %(tags)s
                 %(bounds)s;
-                >;
+                %(recurse)s
                 );""")
         elif geotype == "RELATION":
             query = dedent("""
@@ -321,16 +376,18 @@ class WorksliceFeature(models.Model):
                 rel
                 %(tags)s
                 %(bounds)s;
-                >;
+                %(recurse)s
                 );""")
         else:
             raise ValueError("Unsupported geometry type %s" % geotype)
 
-        geobounds = self.wgs_bounds().extent
-        str_bounds = overpass.str_bounds_for(geobounds, proximity)
+        if bounds is None:
+            bounds = self.osm_conflicts_bounds(proximity)
+        str_bounds = overpass.str_bounds(bounds)
 
         return query % {
             'tags': tags_ql,
             'bounds': str_bounds,
+            'recurse': '>;' if recurse else '',
             }
 
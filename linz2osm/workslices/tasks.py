@@ -18,6 +18,8 @@ from __future__ import absolute_import
 
 from django.conf import settings
 from linz2osm.convert import osm
+from linz2osm.data_dict import tag_memo
+from linz2osm.workslices import files
 from linz2osm.workslices.celery import Celery
 from datetime import datetime
 import time
@@ -28,16 +30,25 @@ celery = Celery('tasks', broker = settings.BROKER_URL)
 @celery.task
 def osm_export(workslice):
     start_t = time.time()
-    data = osm.export(workslice)
-
-    filepath = "%s/%s.osc" % (settings.MEDIA_ROOT, workslice.name)
-    f = open(filepath, 'w')
-    f.write(data)
-    f.close()
+    export_files = files.ExportFiles(workslice.name)
+    try:
+        with tag_memo.memoised():
+            writer = osm.export(workslice, export_files)
+    except:
+        export_files.close()
+        export_files.discard()
+        raise
+    export_files.close()
+    export_files.commit()
 
     workslice.state = 'out'
     workslice.status_changed_at = datetime.now()
-    workslice.file_size = os.path.getsize(filepath)
+    workslice.file_size = export_files.size
+    if export_files.compressions:
+        workslice.compressed_file_size = export_files.compressed_size(export_files.compressions[0])
+    else:
+        workslice.compressed_file_size = None
+    workslice.bytes_saved = writer.bytes_saved
     workslice.save()
     finish_t = time.time()
     print "MISSION COMPLETE - generated %s.osc (%d bytes) in %f sec" % (workslice.name, workslice.file_size, finish_t - start_t)
@@ -0,0 +1 @@
+from download import *
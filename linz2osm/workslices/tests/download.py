@@ -0,0 +1,112 @@
+#  LINZ-2-OSM
+#  Copyright (C) Koordinates Ltd.
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import gzip
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from linz2osm.workslices.models import Workslice
+from linz2osm.workslices import files, views
+
+class WorksliceDownloadTestCase(TestCase):
+    fixtures = ['lds_update_test.json']
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.workslice = Workslice.objects.get(pk=77)
+        self.url = '/workslices/77/download/'
+        self.data = '<osmChange generator="linz2osm" version="0.6">%s</osmChange>\n' % ('<create />' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root)
+
+    def export(self, **kwargs):
+        with self.settings(MEDIA_ROOT=self.media_root, **kwargs):
+            export_files = files.ExportFiles(self.workslice.name)
+            export_files.write(self.data)
+            export_files.close()
+            export_files.commit()
+        return export_files
+
+    def test_export_files(self):
+        export_files = self.export(LINZ2OSM_EXPORT_COMPRESSION=('gz', 'bz2'))
+        self.assertEqual(export_files.size, len(self.data))
+        with self.settings(MEDIA_ROOT=self.media_root):
+            self.assertEqual(open(files.export_path(self.workslice.name)).read(), self.data)
+            self.assertEqual(gzip.open(files.export_path(self.workslice.name, 'gz')).read(), self.data)
+            self.assertTrue(export_files.compressed_size('gz') < len(self.data))
+
+        # re-exporting without the raw file removes it, and the bz2 copy
+        self.export(LINZ2OSM_EXPORT_COMPRESSION=('gz',), LINZ2OSM_EXPORT_RAW=False)
+        with self.settings(MEDIA_ROOT=self.media_root):
+            self.assertFalse(os.path.exists(files.export_path(self.workslice.name)))
+            self.assertFalse(os.path.exists(files.export_path(self.workslice.name, 'bz2')))
+            self.assertTrue(os.path.exists(files.export_path(self.workslice.name, 'gz')))
+
+    def test_parse_range(self):
+        self.assertEqual(files.parse_range(None, 100), None)
+        self.assertEqual(files.parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(files.parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(files.parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(files.parse_range('bytes=50-500', 100), (50, 99))
+        self.assertEqual(files.parse_range('bytes=0-1,5-6', 100), None)
+        self.assertRaises(files.UnsatisfiableRange, files.parse_range, 'bytes=100-', 100)
+
+    def test_download(self):
+        self.export()
+        with self.settings(MEDIA_ROOT=self.media_root):
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(''.join(response.streaming_content), self.data)
+            self.assertFalse(response.has_header('Content-Encoding'))
+
+            response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+            response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], 'bytes 10-19/%d' % len(self.data))
+            self.assertEqual(''.join(response.streaming_content), self.data[10:20])
+
+            response = self.client.get(self.url, HTTP_RANGE='bytes=%d-' % len(self.data))
+            self.assertEqual(response.status_code, 416)
+
+            response = self.client.get(self.url + '?compression=gz')
+            self.assertTrue(response['Content-Disposition'].endswith('.osc.gz"'))
+            self.assertFalse(response.has_header('Content-Encoding'))
+
+            with self.settings(LINZ2OSM_SENDFILE='x-accel-redirect'):
+                response = self.client.get(self.url)
+                self.assertEqual(response['X-Accel-Redirect'], '/protected-media/%s.osc' % self.workslice.name)
+
+    def test_accepts_gzip(self):
+        factory = RequestFactory()
+        for header, accepted in [('gzip', True), ('deflate, gzip;q=0.5', True), ('GZIP', True), ('gzip;q=0', False),
+                                 ('gzip; q=0.0', False), ('gzip;q=0.000', False), ('gzip;q=bogus', False), ('deflate', False)]:
+            request = factory.get(self.url, HTTP_ACCEPT_ENCODING=header)
+            self.assertEqual(views.accepts_gzip(request), accepted, header)
+
+    def test_download_without_raw_file(self):
+        self.export(LINZ2OSM_EXPORT_RAW=False)
+        with self.settings(MEDIA_ROOT=self.media_root):
+            response = self.client.get(self.url)
+            self.assertEqual(''.join(response.streaming_content), self.data)
@@ -17,6 +17,8 @@
 
 from datetime import datetime
 
+import gzip
+import os
 import re
 import json
 import django.db
@@ -24,7 +26,9 @@ import django.db
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404, StreamingHttpResponse
+from django.core.urlresolvers import reverse
+from django.utils.http import http_date
 from django.conf import settings
 from django.contrib.gis.geos import MultiPolygon, Polygon
 from django.contrib.auth.models import User
@@ -32,7 +36,8 @@ from django import forms
 
 from linz2osm.data_dict.models import *
 from linz2osm.workslices.models import *
-from linz2osm.convert import osm, overpass
+from linz2osm.convert import cell_counts, osm, overpass
+from linz2osm.workslices import files
 from linz2osm.utils.forms import BootstrapErrorList
 
 def show_workslice(request, workslice_id=None):
@@ -46,12 +51,102 @@ def show_workslice(request, workslice_id=None):
         'status_name': workslice.friendly_status(),
         'post_checkout_status': workslice.post_checkout_status(),
         'file_name': "%s.osc" % workslice.name,
-        'file_path': "%s%s.osc" % (settings.MEDIA_URL, workslice.name),
+        'file_path': reverse('linz2osm.workslices.views.download_workslice', kwargs={'workslice_id': workslice.id}),
         'form': WorksliceUpdateForm(error_class=BootstrapErrorList),
     }
 
     return render_to_response('workslices/show.html', ctx, context_instance=RequestContext(request))
 
+OSC_CONTENT_TYPE = 'text/xml'
+
+def accepts_gzip(request):
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = [p.strip() for p in coding.split(';')]
+        if params[0].lower() != 'gzip':
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        return q > 0
+    return False
+
+def download_workslice(request, workslice_id=None):
+    """
+    Serves a workslice's .osc file: gzip-encoded if the client can take it
+    and we have it, or ?compression=gz|bz2 for the compressed file itself.
+    Handles single byte ranges, or hands the file to the web server with
+    LINZ2OSM_SENDFILE = 'x-sendfile' or 'x-accel-redirect'.
+    """
+    workslice = get_object_or_404(Workslice, pk=workslice_id)
+    compression = request.GET.get('compression')
+    if compression and compression not in files.COMPRESSIONS:
+        raise Http404
+
+    file_name = "%s.osc" % workslice.name
+    content_type = OSC_CONTENT_TYPE
+    content_encoding = None
+    decompress = False
+    if compression:
+        path = files.export_path(workslice.name, compression)
+        file_name += "." + compression
+        content_type = files.CONTENT_TYPES[compression]
+    else:
+        path = files.export_path(workslice.name)
+        gz_path = files.export_path(workslice.name, 'gz')
+        if os.path.exists(gz_path) and (accepts_gzip(request) or not os.path.exists(path)):
+            path = gz_path
+            if accepts_gzip(request):
+                content_encoding = files.CONTENT_ENCODINGS['gz']
+            else:
+                decompress = True
+    if not os.path.exists(path):
+        raise Http404
+
+    sendfile = getattr(settings, 'LINZ2OSM_SENDFILE', None)
+    if decompress:
+        response = StreamingHttpResponse(gzip.open(path, 'rb'), content_type=content_type)
+    elif sendfile:
+        # the web server does the rest, ranges included
+        response = HttpResponse(content_type=content_type)
+        if sendfile == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = settings.LINZ2OSM_SENDFILE_URL + os.path.basename(path)
+        else:
+            response['X-Sendfile'] = os.path.abspath(path)
+    else:
+        size = os.path.getsize(path)
+        last_modified = http_date(os.path.getmtime(path))
+        byte_range = None
+        if request.META.get('HTTP_IF_RANGE', last_modified) == last_modified:
+            try:
+                byte_range = files.parse_range(request.META.get('HTTP_RANGE'), size)
+            except files.UnsatisfiableRange:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % size
+                return response
+
+        first, last = byte_range or (0, size - 1)
+        response = StreamingHttpResponse(files.file_chunks(open(path, 'rb'), first, last - first + 1), content_type=content_type)
+        response['Content-Length'] = str(last - first + 1)
+        response['Accept-Ranges'] = 'bytes'
+        response['Last-Modified'] = last_modified
+        if byte_range:
+            response.status_code = 206
+            response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+            # GZipMiddleware would otherwise compress the part
+            content_encoding = content_encoding or 'identity'
+
+    response['Content-Disposition'] = 'attachment; filename="%s"' % file_name
+    if content_encoding:
+        response['Content-Encoding'] = content_encoding
+    if not compression:
+        response['Vary'] = 'Accept-Encoding'
+    return response
+
 class WorksliceUpdateForm(forms.Form):
     transition = forms.CharField(widget=forms.HiddenInput(), required=True)
 
@@ -66,7 +161,7 @@ def update_workslice(request, workslice_id=None):
         'status_name': workslice.friendly_status(),
         'post_checkout_status': workslice.post_checkout_status(),
         'file_name': "%s.osc" % workslice.name,
-        'file_path': "%s%s.osc" % (settings.MEDIA_URL, workslice.name),
+        'file_path': reverse('linz2osm.workslices.views.download_workslice', kwargs={'workslice_id': workslice.id}),
     }
 
     if request.method == 'POST':
@@ -83,7 +178,11 @@ def update_workslice(request, workslice_id=None):
                         workslice.state = transition
                         workslice.status_changed_at = datetime.now()
                         if transition == "abandoned":
+                            # dirty features were already released when they were marked
+                            feature_ids = list(workslice.workslicefeature_set.filter(dirty=0).values_list('feature_id', flat=True))
                             workslice.workslicefeature_set.all().delete()
+                            WorksliceFeature.objects.forget_allocated_features(workslice.layer_in_dataset)
+                            cell_counts.adjust_allocated(workslice.layer_in_dataset, feature_ids, -1)
                         workslice.save()
                         return HttpResponseRedirect(workslice.get_absolute_url())
                 form._errors["__all__"] = form.error_class([u"Not allowed to make this workslice '%s'" % transition])
@@ -183,6 +282,7 @@ class WorksliceForm(forms.Form):
         cells = [Cell(t) for t in data.split("_")]
         self.extent = MultiPolygon([c.as_polygon() for c in cells]).cascaded_union
         self.extent.srid = 4326
+        self.cells = cells
         self.num_cells = len(cells)
         if not (isinstance(self.extent, Polygon)):
             raise forms.ValidationError('Extent must be contiguous and not cross anti-meridian.')
@@ -237,7 +337,15 @@ def workslice_info(request, layer_in_dataset_id):
 
     form = WorksliceForm(request.POST, error_class=BootstrapErrorList, hide_filters=layer_in_dataset.hide_filters)
     if form.is_valid():
-        feature_count = osm.get_layer_feature_count(dataset.name, layer, form.extent)
+        counts = cell_counts.count(layer_in_dataset, form.cells)
+        feature_ids = None
+        if counts is None:
+            # the ids are needed for the checked-out count anyway, so count them
+            # too; no more than one over the limit, which is enough to refuse
+            feature_ids = osm.get_layer_feature_ids(layer_in_dataset, form.extent, layer.feature_limit)
+            feature_count = len(feature_ids)
+        else:
+            feature_count, taken_count = counts
         if feature_count > layer.feature_limit:
             ctx['info'] = "Too many features (over %d): please reduce selection." % layer.feature_limit
             ctx['osm_conflict_info'] = ""
@@ -251,33 +359,45 @@ def workslice_info(request, layer_in_dataset_id):
             else:
                 ctx['info'] = "Serious error calculating features."
 
+            if counts is None:
+                allocated = WorksliceFeature.objects.allocated_features(layer_in_dataset)
+                taken_count = len([feat_id for feat_id in feature_ids if feat_id in allocated])
+            if taken_count:
+                ctx['info'] += " %d available, %d already checked out." % (feature_count - taken_count, taken_count)
+
             if form.cleaned_data['show_conflicting_features'] in ['yes', 'count'] or form.cleaned_data['show_features_in_selection'] in ['yes', 'centroids']:
-                feature_ids = osm.get_layer_feature_ids(layer_in_dataset, form.extent)
+                if feature_ids is None:
+                    feature_ids = osm.get_layer_feature_ids(layer_in_dataset, form.extent)
                 workslice_features = [WorksliceFeature(feature_id=feat_id, layer_in_dataset=layer_in_dataset) for feat_id in feature_ids]
 
             if form.cleaned_data['show_conflicting_features'] in ['yes', 'count']:
                 if layer.tags_ql:
-                    osm_conflicts = overpass.osm_conflicts_json(workslice_features, layer.tags_ql)['elements'] # FIXME: tagging
-
-                    nodes = dict([(n['id'], n) for n in osm_conflicts if n['type'] == 'node'])
-                    ways = dict([(n['id'], n) for n in osm_conflicts if n['type'] == 'way'])
-                    rels = dict([(n['id'], n) for n in osm_conflicts if n['type'] == 'rel'])
-
-                    if layer.geometry_type == 'POINT':
-                        conflict_count = len(nodes)
-                        if form.cleaned_data['show_conflicting_features'] == 'yes':
+                    if form.cleaned_data['show_conflicting_features'] == 'count':
+                        # only the count comes back from Overpass, not the features
+                        conflict_count = overpass.osm_conflicts_count(workslice_features, layer.tags_ql) # FIXME: tagging
+                    else:
+                        nodes = {}
+                        ways = {}
+                        rels = {}
+                        for n in overpass.osm_conflicts_elements(workslice_features, layer.tags_ql): # FIXME: tagging
+                            if n['type'] == 'node':
+                                nodes[n['id']] = n
+                            elif n['type'] == 'way':
+                                ways[n['id']] = n
+                            elif n['type'] == 'rel':
+                                rels[n['id']] = n
+
+                        if layer.geometry_type == 'POINT':
+                            conflict_count = len(nodes)
                             ctx['osm_conflict_geometry'] = overpass.osm_geojson(nodes.values())
-                    elif layer.geometry_type == 'LINESTRING':
-                        conflict_count = len(ways)
-                        if form.cleaned_data['show_conflicting_features'] == 'yes':
+                        elif layer.geometry_type == 'LINESTRING':
+                            conflict_count = len(ways)
                             ctx['osm_conflict_geometry'] = overpass.osm_geojson(ways.values(), nodes)
-                    elif layer.geometry_type == 'POLYGON':
-                        conflict_count = len(ways) # FIXME: count rels too.
-                        if form.cleaned_data['show_conflicting_features'] == 'yes':
+                        elif layer.geometry_type == 'POLYGON':
+                            conflict_count = len(ways) # FIXME: count rels too.
                             ctx['osm_conflict_geometry'] = overpass.osm_geojson(rels.values(), nodes, ways)
-                    elif layer.geometry_type == 'RELATION':
-                        conflict_count = len(rels)
-                        if form.cleaned_data['show_conflicting_features'] == 'yes':
+                        elif layer.geometry_type == 'RELATION':
+                            conflict_count = len(rels)
                             ctx['osm_conflict_geometry'] = overpass.osm_geojson(rels.values(), nodes, ways)
 
                     if conflict_count > 1: